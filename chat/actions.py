@@ -0,0 +1,123 @@
+"""Schemas of the actions clients send over the WebSocket.
+
+Each action maps its fields to ``(check, required, default)``. ``validate``
+runs the checks in memory and returns the cleaned fields, so unknown actions,
+missing or mistyped fields and oversized values are rejected before any
+database work (or thread hop) is scheduled. A check returns the cleaned value
+or raises ``InvalidFrame``.
+"""
+from django.conf import settings
+
+from .clientids import MAX_LENGTH as CLIENT_MSG_ID_MAX_LENGTH
+
+
+class InvalidFrame(ValueError):
+    def __init__(self, code, field=None):
+        super().__init__(f"{code}: {field}" if field else code)
+        self.code = code
+        self.field = field
+
+
+def positive_int(value):
+    """An id: a positive int, or its decimal string (data attributes are strings)."""
+    if isinstance(value, str) and value.isascii() and value.isdigit():
+        value = int(value)
+    if isinstance(value, int) and not isinstance(value, bool) and value > 0:
+        return value
+    raise InvalidFrame("invalid_field")
+
+
+def non_negative_int(value):
+    return 0 if value == 0 else positive_int(value)
+
+
+def boolean(value):
+    if isinstance(value, bool):
+        return value
+    raise InvalidFrame("invalid_field")
+
+
+def text(max_length):
+    """Non-empty string of at most ``max_length`` characters (a callable reads a setting)."""
+    def check(value):
+        limit = max_length() if callable(max_length) else max_length
+        if not isinstance(value, str) or not value:
+            raise InvalidFrame("invalid_field")
+        if len(value) > limit:
+            raise InvalidFrame("too_large")
+        return value
+    return check
+
+
+def id_list(max_items):
+    def check(value):
+        limit = max_items() if callable(max_items) else max_items
+        if not isinstance(value, list):
+            raise InvalidFrame("invalid_field")
+        if len(value) > limit:
+            raise InvalidFrame("too_large")
+        return [positive_int(item) for item in value]
+    return check
+
+
+def message_max_length():
+    return getattr(settings, "CHAT_MESSAGE_MAX_LENGTH", 4096)
+
+
+def max_subscriptions():
+    return getattr(settings, "CHAT_PRESENCE_MAX_SUBSCRIPTIONS", 500)
+
+
+def required(check):
+    return check, True, None
+
+
+def optional(check, default=None):
+    return check, False, default
+
+
+SCHEMAS = {
+    "heartbeat": {},
+    "subscribe_presence": {
+        "add": optional(id_list(max_subscriptions), ()),
+        "remove": optional(id_list(max_subscriptions), ()),
+    },
+    "get_presence": {"target_user_id": required(positive_int)},
+    "get_presence_bulk": {"user_ids": required(id_list(max_subscriptions))},
+    "send_message": {
+        "receiver_id": required(positive_int),
+        "message": required(text(message_max_length)),
+        "client_msg_id": optional(text(CLIENT_MSG_ID_MAX_LENGTH)),
+    },
+    "receiver_connected": {},
+    "mark_read": {"other_user_id": required(positive_int)},
+    "delete_message": {
+        "msg_id": required(positive_int),
+        "for_everyone": optional(boolean, False),
+    },
+    "resume": {"since": optional(non_negative_int, 0)},
+    "typing": {
+        "receiver_id": required(positive_int),
+        "typing": optional(boolean, True),
+    },
+}
+
+
+def validate(action, data):
+    """Cleaned fields of ``data`` for ``action``; raises InvalidFrame."""
+    schema = SCHEMAS.get(action) if isinstance(action, str) else None
+    if schema is None:
+        raise InvalidFrame("unknown_action")
+    fields = {}
+    for name, (check, is_required, default) in schema.items():
+        value = data.get(name)
+        if value is None:
+            if is_required:
+                raise InvalidFrame("missing_field", name)
+            fields[name] = default
+            continue
+        try:
+            fields[name] = check(value)
+        except InvalidFrame as exc:
+            raise InvalidFrame(exc.code, name)
+    return fields
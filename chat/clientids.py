@@ -0,0 +1,57 @@
+"""Recently stored client message ids.
+
+Clients tag each ``send_message`` with a ``client_msg_id`` and resend it when
+the echo does not arrive in time. Retries of recent sends are answered from
+this bounded LRU without a query; older ones (or ones first handled by another
+worker) hit the ``unique_client_msg_id`` constraint and are resolved with one
+lookup. Either way the client gets the ``msg_id`` that was already assigned.
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .models import ChatMessage
+
+MAX_LENGTH = ChatMessage._meta.get_field("client_msg_id").max_length
+
+
+class RecentClientIds:
+    def __init__(self, max_size=None):
+        self.max_size = max_size or getattr(settings, "CHAT_CLIENT_MSG_ID_CACHE_SIZE", 10000)
+        self.ids = OrderedDict()
+
+    def get(self, sender_id, client_msg_id):
+        """msg_id already stored for this send, or None if not remembered."""
+        key = (int(sender_id), client_msg_id)
+        msg_id = self.ids.get(key)
+        if msg_id is not None:
+            self.ids.move_to_end(key)
+        return msg_id
+
+    def add(self, sender_id, client_msg_id, msg_id):
+        key = (int(sender_id), client_msg_id)
+        self.ids[key] = msg_id
+        self.ids.move_to_end(key)
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+
+recent_client_ids = RecentClientIds()
+
+
+def find_client_message(sender_id, client_msg_id):
+    """msg_id stored for ``(sender_id, client_msg_id)``, or None."""
+    return (
+        ChatMessage.objects.filter(sender_id=sender_id, client_msg_id=client_msg_id)
+        .values_list("id", flat=True)
+        .first()
+    )
+
+
+async def afind_client_message(sender_id, client_msg_id):
+    """``find_client_message`` through the async ORM, for consumers."""
+    return await (
+        ChatMessage.objects.filter(sender_id=sender_id, client_msg_id=client_msg_id)
+        .values_list("id", flat=True)
+        .afirst()
+    )
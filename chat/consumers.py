@@ -1,309 +1,582 @@
-import json
+import asyncio
+import time
+from django.conf import settings
 from django.utils import timezone
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import ChatUser, ChatMessage
-
-
-# ======================== MIXINS ========================
-import json
-from django.utils import timezone
-from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async
-from .models import ChatUser, ChatMessage
+from .models import ChatMessage
+from django.db import IntegrityError, transaction
+from .conversations import record_message, mark_conversation_read, mark_conversations_delivered, record_deletion
+from .changefeed import changes_since, record_change, record_changes, record_message_changes
+from .clientids import afind_client_message, recent_client_ids
+from .dbexec import db_sync_to_async
+from .groups import user_group_name, presence_group_name, send_to_users
+from .writer import get_message_writer, write_behind_enabled
+from .presence import get_connection_counter, registry as presence_registry, ensure_flusher
+from .usercache import user_cache
+from .outbound import OutboundQueue
+from .ratelimit import BucketSet, RateLimiter
+from . import actions
+from . import metrics
+from . import frames
 
 
 # ======================== MIXINS ========================
 
 class PresenceMixin:
-    @database_sync_to_async
-    def set_user_online(self, user_id, is_online):
-        """Mark user online/offline + update last_seen."""
-        try:
-            user = ChatUser.objects.get(id=user_id)
-            user.is_online = is_online
-            if not is_online:
-                user.last_seen = timezone.now()
-            user.save()
-        except ChatUser.DoesNotExist:
-            pass
-
-    @database_sync_to_async
-    def touch(self, user_id):
-        """Update last_seen when user sends heartbeat."""
-        try:
-            user = ChatUser.objects.get(id=user_id)
-            user.last_seen = timezone.now()
-            user.save()
-        except ChatUser.DoesNotExist:
-            pass
+    async def set_user_online(self, user_id, is_online):
+        """Mark user online/offline + update last_seen (in memory, flushed later; Redis if shared)."""
+        ensure_flusher()
+        presence_registry.set_online(user_id, is_online)
+        await presence_registry.apublish(self.channel_layer, user_id)
+
+    async def touch(self, user_id):
+        """Update last_seen when user sends heartbeat (in memory, flushed later; Redis if shared)."""
+        ensure_flusher()
+        presence_registry.touch(user_id)
+        await presence_registry.apublish(self.channel_layer, user_id)
+
+    async def get_presence(self, user_id):
+        """(is_online, last_seen) from the registry (Redis if shared); hits the DB only on first sight."""
+        return await presence_registry.aload(user_id, self.channel_layer)
+
+    async def get_presence_bulk(self, user_ids):
+        """``{user_id: (is_online, last_seen)}`` from the registry (Redis if shared), DB for the rest."""
+        return await presence_registry.aload_many(user_ids, self.channel_layer)
+
+    async def publish_presence(self, user_id, is_online):
+        """Fan a presence change out to the sockets subscribed to ``user_id``."""
+        last_seen = str(timezone.now())
+        event = frames.build_event("presence_update", {
+            "event": "presence_update",
+            "user_id": user_id,
+            "is_online": is_online,
+            "last_seen": last_seen,
+        }, coalesce=f"presence:{user_id}")
+        event["presence"] = [user_id, is_online, last_seen]  # for digesting subscribers
+        await self.channel_layer.group_send(presence_group_name(user_id), event)
+
+    async def subscribe_presence(self, add=(), remove=()):
+        """Incrementally change which users' presence this socket follows."""
+        for user_id in remove:
+            if user_id in self.presence_subscriptions:
+                self.presence_subscriptions.discard(user_id)
+                await self.channel_layer.group_discard(presence_group_name(user_id), self.channel_name)
+        limit = getattr(settings, "CHAT_PRESENCE_MAX_SUBSCRIPTIONS", 500)
+        for user_id in add:
+            if user_id in self.presence_subscriptions or len(self.presence_subscriptions) >= limit:
+                continue
+            self.presence_subscriptions.add(user_id)
+            await self.channel_layer.group_add(presence_group_name(user_id), self.channel_name)
 
     async def presence_update(self, event):
-        """Send presence updates to frontend."""
-        await self.send(text_data=json.dumps({
-            "event": "presence_update",
-            "user_id": event.get("user_id"),
-            "is_online": event.get("is_online"),
-            "last_seen": event.get("last_seen", None),
-        }))
+        """Collect presence changes into one ``presence_digest`` frame per window.
+
+        Only the latest state per user is kept, so a reconnect storm costs each
+        subscriber one frame per ``CHAT_PRESENCE_DIGEST_WINDOW`` seconds. With a
+        window of 0 every change is sent as its own ``presence_update``.
+        """
+        window = getattr(settings, "CHAT_PRESENCE_DIGEST_WINDOW", 0.25)
+        if not window or "presence" not in event:
+            await self.send_event(event)
+            return
+        user_id, is_online, last_seen = event["presence"]
+        self.presence_pending[user_id] = (is_online, last_seen)
+        if self.presence_timer is None:
+            self.presence_timer = asyncio.get_running_loop().call_later(
+                window, lambda: asyncio.ensure_future(self.flush_presence_digest())
+            )
+
+    async def flush_presence_digest(self):
+        self.presence_timer = None
+        if not self.presence_pending:
+            return
+        pending, self.presence_pending = self.presence_pending, {}
+        metrics.incr("presence.digests")
+        await self.send_payload({
+            "event": "presence_digest",
+            "users": [[user_id, is_online, last_seen] for user_id, (is_online, last_seen) in pending.items()],
+        })
+
+    def cancel_presence_digest(self):
+        if self.presence_timer is not None:
+            self.presence_timer.cancel()
+            self.presence_timer = None
+        self.presence_pending = {}
 
 
 class MessagingMixin:
-    @database_sync_to_async
-    def save_message(self, sender_id, receiver_id, message):
-        """Save chat message to database."""
-        sender = ChatUser.objects.get(id=sender_id)
-        receiver = ChatUser.objects.get(id=receiver_id)
-        msg = ChatMessage.objects.create(
-            sender=sender,
-            receiver=receiver,
-            content=message,
-            status="sent",
-        )
+    async def users_exist(self, *user_ids):
+        """Validate ids against the user-id cache; queries only for unknown ids."""
+        missing = user_cache.missing(user_ids)
+        return not missing or await user_cache.aload(missing)
+
+    async def save_message(self, sender_id, receiver_id, message, client_msg_id=None):
+        """Save chat message, batched through the write-behind buffer if enabled.
+
+        Raises IntegrityError if ``client_msg_id`` was already used by this sender.
+        """
+        if write_behind_enabled():
+            return await get_message_writer().save(ChatMessage(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=message,
+                status="sent",
+                client_msg_id=client_msg_id,
+            ))
+        return await self.create_message(sender_id, receiver_id, message, client_msg_id)
+
+    @db_sync_to_async
+    def create_message(self, sender_id, receiver_id, message, client_msg_id=None):
+        """Save chat message (one INSERT, written by FK id), its chat-list summary and change entry."""
+        with transaction.atomic():
+            msg = ChatMessage.objects.create(
+                sender_id=sender_id,
+                receiver_id=receiver_id,
+                content=message,
+                status="sent",
+                client_msg_id=client_msg_id,
+            )
+            record_message(msg)
+            record_message_changes([msg])
         return msg
 
+    async def ack_duplicate(self, client_msg_id, msg_id):
+        """Answer a retried send with the msg_id it was already stored under."""
+        metrics.incr("send_message.duplicates")
+        await self.send_payload({
+            "event": "message_ack",
+            "client_msg_id": client_msg_id,
+            "msg_id": msg_id,
+            "duplicate": True,
+        })
+
     async def chat_message(self, event):
         """Forward chat message (text or attachment) to WebSocket client."""
-        await self.send(text_data=json.dumps({
-            "event": "chat_message",
-            "message": event.get("message"),
-            "sender_id": event.get("sender_id"),
-            "receiver_id": event.get("receiver_id"),
-            "timestamp": event.get("timestamp"),
-            "status": event.get("status"),
-            "msg_id": event.get("msg_id"),
-            "attachment_url": event.get("attachment_url", None),
-            "attachment_type": event.get("attachment_type", None),
-        }))
+        await self.send_event(event)
 
 
 
 class StatusMixin:
-    @database_sync_to_async
+    @db_sync_to_async
     def mark_messages_delivered(self, receiver_id):
-        """Mark messages delivered for given receiver."""
-        qs = ChatMessage.objects.filter(receiver_id=receiver_id, status="sent")
-        ids = list(qs.values_list("id", flat=True))
-        if ids:
-            now = timezone.now()
-            qs.update(status="delivered", delivered_at=now)
-        return ids
-
-    @database_sync_to_async
+        return self.deliver_pending(receiver_id)
+
+    def deliver_pending(self, receiver_id):
+        """Advance the receiver's delivered watermarks (sync, runs in a DB thread).
+
+        Returns ``{sender_id: status_update payload}`` so each sender gets only their ticks.
+        """
+        receiver_id = int(receiver_id)
+        with transaction.atomic():
+            moved = mark_conversations_delivered(receiver_id)
+            payloads = record_changes([
+                (receiver_id, sender_id, {
+                    "event": "status_update",
+                    "user_id": receiver_id,
+                    "up_to": up_to,
+                    "new_status": "delivered",
+                })
+                for sender_id, up_to in moved.items()
+            ])
+        return dict(zip(moved, payloads))
+
+    @db_sync_to_async
     def mark_messages_read(self, reader_id, other_user_id):
-        """Mark messages read between two users."""
-        qs = ChatMessage.objects.filter(
-            sender_id=other_user_id,
-            receiver_id=reader_id
-        ).exclude(status="read")
-        ids = list(qs.values_list("id", flat=True))
-        if ids:
-            now = timezone.now()
-            qs.update(status="read", seen_at=now)
-        return ids
+        """Advance the reader's read watermark; returns the status_update payload, or None if unchanged."""
+        with transaction.atomic():
+            up_to = mark_conversation_read(reader_id, other_user_id)
+            if not up_to:
+                return None
+            return record_change(reader_id, other_user_id, {
+                "event": "status_update",
+                "user_id": int(reader_id),
+                "up_to": up_to,
+                "new_status": "read",
+            })
+
+    async def publish_delivered(self, receiver_id, delivered):
+        """Send each sender the delivered watermark returned by ``deliver_pending``."""
+        for sender_id, payload in delivered.items():
+            await send_to_users(
+                self.channel_layer,
+                [sender_id],
+                frames.build_event("status_update", payload, coalesce=f"status:delivered:{receiver_id}"),
+            )
 
     async def status_update(self, event):
         """Send message status updates to client."""
-        await self.send(text_data=json.dumps({
-            "event": "status_update",
-            "msg_ids": event.get("msg_ids", []),
-            "new_status": event.get("new_status"),
-        }))
+        await self.send_event(event)
 
 
 class DeleteupdateMixin:
-    @database_sync_to_async
-    def delete_message(self, msg_id, for_everyone=False):
-        """Soft-delete message."""
+    async def delete_message(self, msg_id, user_id, for_everyone=False):
+        """Soft-delete message. Returns the message (or None if missing).
+
+        Only its participants may delete it, and only the sender for everyone.
+        """
         try:
-            msg = ChatMessage.objects.get(id=msg_id)
-            if for_everyone:
-                msg.content = "[This message was deleted]"
-            else:
-                msg.deleted_for_receiver = True
-            msg.save()
-            return msg.id
+            msg = await ChatMessage.objects.aget(id=msg_id)
         except ChatMessage.DoesNotExist:
             return None
+        if user_id not in (msg.sender_id, msg.receiver_id):
+            return None
+        return await self.store_deletion(msg, for_everyone and msg.sender_id == user_id)
+
+    @db_sync_to_async
+    def store_deletion(self, msg, for_everyone):
+        """Save the soft delete with its summary update and change entry in one transaction."""
+        if for_everyone:
+            msg.content = "[This message was deleted]"
+        else:
+            msg.deleted_for_receiver = True
+        with transaction.atomic():
+            msg.save()
+            if for_everyone:
+                record_deletion(msg)
+            msg.change_payload = record_change(msg.sender_id, msg.receiver_id, {
+                "event": "delete_message",
+                "msg_id": msg.id,
+                "for_everyone": for_everyone,
+            })
+        return msg
 
     async def delete_message_event(self, event):
         """Notify frontend about deleted message."""
-        await self.send(text_data=json.dumps({
-            "event": "delete_message",
-            "msg_id": event.get("msg_id"),
-            "for_everyone": event.get("for_everyone"),
-        }))
+        await self.send_event(event)
+
+
+# (sender, receiver) typing throttles, shared by the sockets of this process.
+typing_throttle = BucketSet()
+
+
+class TypingMixin:
+    async def publish_typing(self, receiver_id, typing):
+        """Forward a typing indicator to the counterpart only; no database work.
+
+        Starts are throttled to one per ``CHAT_TYPING_INTERVAL`` seconds per
+        sender and conversation; clients drop an indicator after ``expires_in``
+        seconds, so a lost stop frame cannot leave it stuck.
+        """
+        if receiver_id == self.user_id:
+            return
+        if typing:
+            interval = getattr(settings, "CHAT_TYPING_INTERVAL", 2)
+            if interval and typing_throttle.take(self.user_id, receiver_id, 1 / interval, 1):
+                metrics.incr("typing.throttled")
+                return
+        await send_to_users(
+            self.channel_layer,
+            [receiver_id],
+            frames.build_event("typing_event", {
+                "event": "typing",
+                "user_id": self.user_id,
+                "typing": typing,
+                "expires_in": getattr(settings, "CHAT_TYPING_TTL", 5),
+            }, coalesce=f"typing:{self.user_id}"),
+        )
+
+    async def typing_event(self, event):
+        """Send a typing indicator to the client."""
+        await self.send_event(event)
+
+
+class ResumeMixin:
+    async def resume(self, since):
+        """Replay the changes this user missed after ``since``, or ask for a resync."""
+        changes = await db_sync_to_async(changes_since)(self.user_id, since)
+        if changes is None:
+            metrics.incr("resume.resync")
+            await self.send_payload({"event": "resync"})
+            return
+        for payload in changes:
+            await self.send_payload(payload)
+        await self.send_payload({"event": "resumed", "seq": changes[-1]["seq"] if changes else since})
 
 
 # ======================== MAIN CONSUMER ========================
 
+# Close code sent to clients whose outbound queue stays over the limit.
+SLOW_CONSUMER_CLOSE_CODE = 4008
+
+
 class ChatConsumer(
-    PresenceMixin, MessagingMixin, StatusMixin, DeleteupdateMixin, AsyncWebsocketConsumer
+    PresenceMixin, MessagingMixin, StatusMixin, DeleteupdateMixin, TypingMixin, ResumeMixin,
+    AsyncWebsocketConsumer,
 ):
     async def connect(self):
-        """Client connects → join chat + presence groups."""
-    # ✅ No room_name needed anymore
-        self.room_group_name = "global_chat"
-        self.presence_group_name = "presence_updates"
+        """Client connects → identified from its session, online, pending messages delivered."""
+        self.user_group_name = None
+        self.presence_subscriptions = set()
+        self.presence_pending = {}  # user_id -> (is_online, last_seen) for the next digest
+        self.presence_timer = None
 
         self.user_id = None
+        user_id, delivered = await self.open_session()
+        if not user_id:
+            await self.close()  # not logged in: reject the handshake
+            return
 
-        # Join both chat room & global presence group
-        await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-        await self.channel_layer.group_add(self.presence_group_name, self.channel_name)
-        await self.accept()
+        # Optional compact binary encoding; JSON text frames otherwise.
+        self.binary = (
+            frames.MSGPACK_SUBPROTOCOL in self.scope.get("subprotocols", [])
+            and frames.msgpack_enabled()
+        )
+        await self.accept(subprotocol=frames.MSGPACK_SUBPROTOCOL if self.binary else None)
+        self.outbound = OutboundQueue(self.send)
+        self.rate_limiter = RateLimiter(self.channel_layer)
+        metrics.gauge_add("connections", 1)
+
+        await self.join_user_group(user_id)
+        await self.set_user_online(user_id, True)
+        if await get_connection_counter().open(self.channel_layer, user_id, self.channel_name):
+            await self.publish_presence(user_id, True)
+        await self.publish_delivered(user_id, delivered)
+
+    @db_sync_to_async
+    def open_session(self):
+        """``(user_id, delivered)`` for the session's ChatUser, in one thread hop.
+
+        The id comes from the ``chat_user_id`` session key set at login and is
+        kept on the connection; client-sent user ids are never trusted.
+        """
+        session = self.scope.get("session")
+        user_id = session.get("chat_user_id") if session is not None else None
+        if not user_id or not user_cache.exists(user_id):
+            return None, {}
+        return int(user_id), self.deliver_pending(user_id)
 
     async def disconnect(self, close_code):
-        """Client disconnects → mark user offline."""
-        await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-        await self.channel_layer.group_discard(self.presence_group_name, self.channel_name)
+        """Client disconnects → offline once the user's last socket is gone."""
+        self.cancel_presence_digest()
+        if getattr(self, "outbound", None):
+            self.outbound.close()
+            metrics.gauge_add("connections", -1)
+        if self.user_group_name:
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        await self.subscribe_presence(remove=list(self.presence_subscriptions))
 
         if getattr(self, "user_id", None):
-            await self.set_user_online(self.user_id, False)
-            await self.channel_layer.group_send(
-                self.presence_group_name,
-                {
-                    "type": "presence_update",
-                    "user_id": self.user_id,
-                    "is_online": False,
-                    "last_seen": str(timezone.now()),
-                },
+            await get_connection_counter().close(
+                self.channel_layer, self.user_id, self.channel_name, self.go_offline
             )
 
-    async def receive(self, text_data):
-        """Handle incoming WebSocket messages."""
-        data = json.loads(text_data)
-        action = data.get("action")
+    async def go_offline(self):
+        """The user's last socket closed and the grace period passed."""
+        await self.set_user_online(self.user_id, False)
+        await self.publish_presence(self.user_id, False)
 
-        # ------------------ Presence ------------------
-        if action == "identify_user":
-            # Frontend handshake: identify the logged-in user
-            self.user_id = data.get("user_id")
-            if self.user_id:
-                await self.set_user_online(self.user_id, True)
-                await self.channel_layer.group_send(
-                    self.presence_group_name,
-                    {
-                        "type": "presence_update",
-                        "user_id": self.user_id,
-                        "is_online": True,
-                        "last_seen": str(timezone.now()),
-                    },
-                )
+    async def join_user_group(self, user_id):
+        """Subscribe this socket to the personal group of ``user_id``."""
+        self.user_id = user_id
+        group_name = user_group_name(user_id)
+        if group_name == self.user_group_name:
             return
-        # Update last seen (heartbeat)
-        elif action == "heartbeat":
-            uid = data.get("user_id")
-            if uid:
-                await self.touch(uid)
+        if self.user_group_name:
+            await self.channel_layer.group_discard(self.user_group_name, self.channel_name)
+        await self.channel_layer.group_add(group_name, self.channel_name)
+        self.user_group_name = group_name
+
+    async def send_event(self, event):
+        """Queue a group event's pre-encoded frame in this socket's encoding."""
+        if self.binary:
+            frame = {"bytes_data": event["bytes"]}
+        else:
+            frame = {"text_data": event["text"]}
+        await self.enqueue(frame, event.get("coalesce"))
+
+    async def send_payload(self, payload):
+        """Encode and queue a frame addressed to this socket only."""
+        if self.binary:
+            await self.enqueue({"bytes_data": frames.pack(payload)})
+        else:
+            await self.enqueue({"text_data": frames.dumps(payload)})
+
+    async def enqueue(self, frame, coalesce=None):
+        """Hand a frame to the outbound queue; apply the slow-consumer policy."""
+        if self.outbound.put(frame, coalesce):
             return
-
-        # Fetch presence (when user clicks on chat)
-        elif action == 'get_presence':
-            target_user_id = data.get('target_user_id')
-            print("get_presence for:", target_user_id) 
-            if target_user_id:
-                try:
-                    user = await database_sync_to_async(ChatUser.objects.get)(id=target_user_id)
-                    await self.send(text_data=json.dumps({
-                        'event': 'presence_update',
-                        'user_id': user.id,
-                        'is_online': user.is_online,
-                        'last_seen': str(user.last_seen) if user.last_seen else None
-                    }))
-                except ChatUser.DoesNotExist:
-                    pass
+        if getattr(settings, "CHAT_SEND_QUEUE_POLICY", "close") == "close":
+            # Client is too far behind: let it reconnect and catch up.
+            if not self.outbound.closed:
+                self.outbound.close()
+                metrics.incr("send_queue.closed")
+                await self.close(code=SLOW_CONSUMER_CLOSE_CODE)
+        else:
+            metrics.incr("send_queue.dropped")
+
+    # action -> handler; each handler gets the fields cleaned by its actions.SCHEMAS entry.
+    handlers = {
+        "heartbeat": "handle_heartbeat",
+        "subscribe_presence": "handle_subscribe_presence",
+        "get_presence": "handle_get_presence",
+        "get_presence_bulk": "handle_get_presence_bulk",
+        "send_message": "handle_send_message",
+        "receiver_connected": "handle_receiver_connected",
+        "mark_read": "handle_mark_read",
+        "delete_message": "handle_delete_message",
+        "resume": "handle_resume",
+        "typing": "handle_typing",
+    }
+
+    async def receive(self, text_data=None, bytes_data=None):
+        """Decode, validate and rate-limit a frame in memory, then run its handler."""
+        try:
+            if bytes_data is not None:
+                data = frames.unpack(bytes_data) if self.binary else {}
+            else:
+                data = frames.loads(text_data)
+        except (ValueError, TypeError, AttributeError):
+            data = None
+        if not isinstance(data, dict):
+            await self.reject_frame(None, actions.InvalidFrame("bad_frame"))
+            return
+        action = data.get("action")
+        if not isinstance(action, str) or action not in self.handlers:
+            await self.reject_frame(None, actions.InvalidFrame("unknown_action"))
             return
 
+        # Errors name the client's message id so a rejected send is not retried blindly.
+        client_msg_id = data.get("client_msg_id")
+        if not isinstance(client_msg_id, str):
+            client_msg_id = None
+
+        # Throttle in memory before any DB work is scheduled.
+        retry_after = await self.rate_limiter.check(action, self.user_id)
+        if retry_after:
+            await self.send_payload({
+                "event": "error",
+                "code": "rate_limited",
+                "action": action,
+                "retry_after": round(retry_after, 3),
+                **({"client_msg_id": client_msg_id} if client_msg_id else {}),
+            })
+            return
 
-        # ------------------ Messaging ------------------
-        if action == "send_message":
-            message = data.get("message")
-            sender_id = data.get("sender_id")
-            receiver_id = data.get("receiver_id")
-
-            if not (message and sender_id and receiver_id):
-                return
+        try:
+            fields = actions.validate(action, data)
+        except actions.InvalidFrame as exc:
+            await self.reject_frame(action, exc, client_msg_id)
+            return
 
-            saved_msg = await self.save_message(sender_id, receiver_id, message)
-            await self.channel_layer.group_send(
-                self.room_group_name,
-                {
-                    "type": "chat_message",
-                    "message": saved_msg.content,
-                    "sender_id": saved_msg.sender.id,
-                    "receiver_id": saved_msg.receiver.id,
-                    "timestamp": str(saved_msg.timestamp),
-                    "status": saved_msg.status,
-                    "msg_id": saved_msg.id,
-                },
+        start = time.perf_counter()
+        try:
+            await getattr(self, self.handlers[action])(**fields)
+        finally:
+            metrics.observe(f"action.{action}", time.perf_counter() - start)
+
+    async def reject_frame(self, action, error, client_msg_id=None):
+        metrics.incr(f"invalid_frames.{error.code}")
+        payload = {
+            "event": "error",
+            "code": error.code,
+            "action": action,
+            "field": error.field,
+        }
+        if client_msg_id:
+            payload["client_msg_id"] = client_msg_id
+        await self.send_payload(payload)
+
+    # ------------------ Presence ------------------
+    async def handle_heartbeat(self):
+        """Update last seen and keep this socket counted as open."""
+        await self.touch(self.user_id)
+        await get_connection_counter().refresh(self.channel_layer, self.user_id, self.channel_name)
+
+    async def handle_subscribe_presence(self, add, remove):
+        """Follow presence of the users in the chat list (incremental add/remove)."""
+        await self.subscribe_presence(add=add, remove=remove)
+
+    async def handle_get_presence(self, target_user_id):
+        """Fetch presence (when user clicks on chat) and follow it from now on."""
+        await self.subscribe_presence(add=[target_user_id])
+        state = await self.get_presence(target_user_id)
+        if state:
+            is_online, last_seen = state
+            await self.send_payload({
+                'event': 'presence_update',
+                'user_id': target_user_id,
+                'is_online': is_online,
+                'last_seen': str(last_seen) if last_seen else None
+            })
+
+    async def handle_get_presence_bulk(self, user_ids):
+        """Presence of a whole chat list in one frame: ``users`` = [[id, is_online, last_seen]]."""
+        states = await self.get_presence_bulk(user_ids)
+        await self.send_payload({
+            "event": "presence_bulk",
+            "users": [
+                [user_id, is_online, str(last_seen) if last_seen else None]
+                for user_id, (is_online, last_seen) in states.items()
+            ],
+        })
+
+    # ------------------ Messaging ------------------
+    async def handle_send_message(self, receiver_id, message, client_msg_id):
+        sender_id = self.user_id
+        if not await self.users_exist(receiver_id):
+            await self.reject_frame(
+                "send_message", actions.InvalidFrame("unknown_receiver", "receiver_id"), client_msg_id
             )
+            return
 
-        # ------------------ Receiver Connected ------------------
-        if action == "receiver_connected":
-            receiver_id = data.get("receiver_id")
-            if not receiver_id:
+        # Retried send: answer with the id it already has, broadcast nothing.
+        if client_msg_id:
+            known_id = recent_client_ids.get(sender_id, client_msg_id)
+            if known_id:
+                await self.ack_duplicate(client_msg_id, known_id)
                 return
 
-            self.user_id = receiver_id
-            await self.set_user_online(receiver_id, True)
-            await self.channel_layer.group_send(
-                self.presence_group_name,
-                {
-                    "type": "presence_update",
-                    "user_id": receiver_id,
-                    "is_online": True,
-                    "last_seen": str(timezone.now()),
-                },
-            )
-
-            delivered_ids = await self.mark_messages_delivered(receiver_id)
-            if delivered_ids:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "status_update",
-                        "msg_ids": delivered_ids,
-                        "new_status": "delivered",
-                    },
-                )
+        try:
+            saved_msg = await self.save_message(sender_id, receiver_id, message, client_msg_id)
+        except IntegrityError:
+            known_id = client_msg_id and await afind_client_message(sender_id, client_msg_id)
+            if not known_id:
+                raise
+            recent_client_ids.add(sender_id, client_msg_id, known_id)
+            await self.ack_duplicate(client_msg_id, known_id)
             return
+        if client_msg_id:
+            recent_client_ids.add(sender_id, client_msg_id, saved_msg.id)
+        # Only the two participants (all of their sockets) get the message.
+        await send_to_users(
+            self.channel_layer,
+            [saved_msg.sender_id, saved_msg.receiver_id],
+            frames.build_event("chat_message", saved_msg.change_payload),
+        )
 
-        # ------------------ Mark Read ------------------
-        if action == "mark_read":
-            reader_id = data.get("reader_id")
-            other_user_id = data.get("other_user_id")
-            if not (reader_id and other_user_id):
-                return
+    # ------------------ Receiver Connected ------------------
+    async def handle_receiver_connected(self):
+        """Messages arrived while connected: move the delivered watermark again."""
+        delivered = await self.mark_messages_delivered(self.user_id)
+        # Ticks only matter to whoever sent the messages.
+        await self.publish_delivered(self.user_id, delivered)
+
+    # ------------------ Mark Read ------------------
+    async def handle_mark_read(self, other_user_id):
+        reader_id = self.user_id
+        payload = await self.mark_messages_read(reader_id, other_user_id)
+        if payload:
+            await send_to_users(
+                self.channel_layer,
+                [other_user_id],
+                frames.build_event("status_update", payload, coalesce=f"status:read:{reader_id}"),
+            )
 
-            read_ids = await self.mark_messages_read(reader_id, other_user_id)
-            if read_ids:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "status_update",
-                        "msg_ids": read_ids,
-                        "new_status": "read",
-                    },
-                )
-            return
+    # ------------------ Delete Message ------------------
+    async def handle_delete_message(self, msg_id, for_everyone):
+        deleted = await self.delete_message(msg_id, self.user_id, for_everyone)
+        if deleted:
+            await send_to_users(
+                self.channel_layer,
+                [deleted.sender_id, deleted.receiver_id],
+                frames.build_event("delete_message_event", deleted.change_payload),
+            )
 
-        # ------------------ Delete Message ------------------
-        if action == "delete_message":
-            msg_id = data.get("msg_id")
-            for_everyone = data.get("for_everyone", False)
-            if not msg_id:
-                return
+    # ------------------ Resume ------------------
+    async def handle_resume(self, since):
+        """Reconnected client: replay what it missed after its last seq."""
+        await self.resume(since)
 
-            deleted_id = await self.delete_message(msg_id, for_everyone)
-            if deleted_id:
-                await self.channel_layer.group_send(
-                    self.room_group_name,
-                    {
-                        "type": "delete_message_event",
-                        "msg_id": deleted_id,
-                        "for_everyone": for_everyone,
-                    },
-                )
-            return
-        
\ No newline at end of file
+    # ------------------ Typing ------------------
+    async def handle_typing(self, receiver_id, typing):
+        await self.publish_typing(receiver_id, typing)
@@ -0,0 +1,147 @@
+"""Incremental maintenance of the ``Conversation`` chat-list summaries.
+
+Every write path (new message, attachment, read, delete) calls one of these
+helpers in the same thread hop as its own query, so ``chat_view`` can read the
+chat list straight from ``Conversation`` instead of aggregating messages.
+
+Delivery and read receipts are per-side watermarks on the same row: marking a
+conversation read or delivered is one UPDATE no matter how many messages it
+covers, and clients get the new watermark instead of a list of ids.
+
+Once committed, each change is also applied to the hot-conversation cache.
+"""
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+from .hotcache import hot_messages
+from .models import Conversation, conversation_key
+
+PREVIEW_LENGTH = 200
+
+
+def ordered_pair(a, b):
+    a, b = int(a), int(b)
+    return (a, b) if a <= b else (b, a)
+
+
+def preview_text(msg):
+    if msg.content:
+        return msg.content[:PREVIEW_LENGTH]
+    if msg.attachment_type:
+        return f"📎 {msg.attachment_type.title()}"
+    return ""
+
+
+def side_field(kind, low, user_id):
+    """Name of the ``kind`` field (unread, delivered, read) that belongs to ``user_id``."""
+    return f"{kind}_low" if int(user_id) == low else f"{kind}_high"
+
+
+def unread_field(low, user_id):
+    """Name of the unread counter that belongs to ``user_id``."""
+    return side_field("unread", low, user_id)
+
+
+def record_messages(messages):
+    """Fold newly saved messages into their conversations (one UPDATE per pair)."""
+    transaction.on_commit(lambda: [
+        hot_messages.add(conversation_key(msg.sender_id, msg.receiver_id), msg) for msg in messages
+    ])
+    by_pair = {}
+    for msg in messages:
+        by_pair.setdefault(ordered_pair(msg.sender_id, msg.receiver_id), []).append(msg)
+
+    for (low, high), pair_messages in by_pair.items():
+        last = max(pair_messages, key=lambda m: m.id)
+        unread = {"unread_low": 0, "unread_high": 0}
+        for msg in pair_messages:
+            if msg.sender_id != msg.receiver_id:
+                unread[unread_field(low, msg.receiver_id)] += 1
+        summary = {
+            "last_message_id": last.id,
+            "last_message_preview": preview_text(last),
+            "last_message_time": last.timestamp,
+            "last_sender_id": last.sender_id,
+        }
+        increments = {field: F(field) + count for field, count in unread.items() if count}
+        pair = Conversation.objects.filter(user_low_id=low, user_high_id=high)
+        if pair.update(**summary, **increments):
+            continue
+        try:
+            with transaction.atomic():
+                Conversation.objects.create(user_low_id=low, user_high_id=high, **summary, **unread)
+        except IntegrityError:
+            # Created concurrently by another writer: fall back to the update.
+            pair.update(**summary, **increments)
+
+
+def record_message(msg):
+    record_messages([msg])
+
+
+def mark_conversation_read(reader_id, other_user_id):
+    """Move the reader's read watermark to the newest message.
+
+    Also resets the unread counter and implies delivery. Returns the new
+    watermark, or None if there was nothing new to read.
+    """
+    low, high = ordered_pair(reader_id, other_user_id)
+    read = side_field("read", low, reader_id)
+    pair = Conversation.objects.filter(user_low_id=low, user_high_id=high)
+    updated = pair.filter(**{f"{read}__lt": F("last_message_id")}).update(**{
+        read: F("last_message_id"),
+        side_field("delivered", low, reader_id): F("last_message_id"),
+        unread_field(low, reader_id): 0,
+    })
+    if not updated:
+        return None
+    transaction.on_commit(lambda: hot_messages.forget_watermarks(conversation_key(low, high)))
+    return pair.values_list(read, flat=True).first()
+
+
+def mark_conversations_delivered(receiver_id):
+    """Move the receiver's delivered watermark to the newest message everywhere.
+
+    Returns ``{other_user_id: watermark}`` for the conversations that moved.
+    """
+    moved = {}
+    for side, other in (("low", "high"), ("high", "low")):
+        delivered = f"delivered_{side}"
+        pending = Conversation.objects.filter(
+            **{f"user_{side}_id": receiver_id, f"{delivered}__lt": F("last_message_id")}
+        )
+        rows = list(pending.values_list("id", f"user_{other}_id", "last_message_id"))
+        if rows:
+            Conversation.objects.filter(id__in=[row[0] for row in rows]).update(
+                **{delivered: F("last_message_id")}
+            )
+            moved.update({other_id: up_to for _, other_id, up_to in rows})
+    if moved:
+        transaction.on_commit(lambda: [
+            hot_messages.forget_watermarks(conversation_key(receiver_id, other_id)) for other_id in moved
+        ])
+    return moved
+
+
+def get_conversation(user_id, other_user_id):
+    low, high = ordered_pair(user_id, other_user_id)
+    return Conversation.objects.filter(user_low_id=low, user_high_id=high).first()
+
+
+def message_statuses(user_id, other_user_id, rows, conversation=None):
+    """Set the derived tick state on history rows (dicts with id/sender_id).
+
+    ``conversation`` saves the lookup when the caller already has the row.
+    """
+    if rows and conversation is None:
+        conversation = get_conversation(user_id, other_user_id)
+    for row in rows:
+        receiver_id = other_user_id if row["sender_id"] == user_id else user_id
+        row["status"] = conversation.message_status(row["id"], receiver_id) if conversation else "sent"
+    return rows
+
+
+def record_deletion(msg):
+    """Refresh the preview if the deleted message is the one shown in the list."""
+    transaction.on_commit(lambda: hot_messages.invalidate(conversation_key(msg.sender_id, msg.receiver_id)))
+    Conversation.objects.filter(last_message_id=msg.id).update(last_message_preview=preview_text(msg))
@@ -0,0 +1,44 @@
+"""Thread pool for the database work the consumers still do synchronously.
+
+Single-query reads use Django's async ORM (``aget``/``afirst``/``async for``);
+transactions cannot, so they still need a thread hop. ``database_sync_to_async``
+runs every hop on the one thread-sensitive thread, so under load they queue
+behind each other. ``CHAT_DB_EXECUTOR_WORKERS`` > 0 runs the hops made through
+``db_sync_to_async`` on a dedicated pool of that many threads instead, each with
+its own connection (use it with a database that allows concurrent writers;
+SQLite still serializes them). 0 keeps channels' thread-sensitive behaviour.
+"""
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from channels.db import DatabaseSyncToAsync
+from django.conf import settings
+
+_executors = {}
+
+
+def executor_workers():
+    return getattr(settings, "CHAT_DB_EXECUTOR_WORKERS", 0)
+
+
+def get_executor(workers):
+    """Shared pool with ``workers`` threads (created on first use)."""
+    executor = _executors.get(workers)
+    if executor is None:
+        executor = _executors[workers] = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="chat-db"
+        )
+    return executor
+
+
+def db_sync_to_async(func):
+    """``database_sync_to_async`` that honours ``CHAT_DB_EXECUTOR_WORKERS`` per call."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        workers = executor_workers()
+        if workers:
+            call = DatabaseSyncToAsync(func, thread_sensitive=False, executor=get_executor(workers))
+        else:
+            call = DatabaseSyncToAsync(func)
+        return await call(*args, **kwargs)
+    return wrapper
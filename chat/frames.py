@@ -0,0 +1,112 @@
+"""Encoding of WebSocket frames.
+
+Group events are serialized once, when they are sent to the channel layer,
+and the finished frame travels inside the event; each receiving consumer only
+forwards it. The JSON backend is chosen by ``CHAT_JSON_BACKEND``: ``"orjson"``,
+``"json"`` (stdlib) or ``"auto"`` (orjson when installed).
+
+Clients that negotiate the ``chat.msgpack.v1`` subprotocol get binary
+MessagePack frames instead, with field names replaced by the small integer
+tags in ``FIELD_TAGS``. JSON stays the default: the binary subprotocol is
+opt-in (``CHAT_MSGPACK_ENABLED``) because it makes every group event carry a
+second, msgpack-encoded copy of its frame.
+"""
+import json
+
+from django.conf import settings
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+MSGPACK_SUBPROTOCOL = "chat.msgpack.v1"
+
+# Wire tags for chat.msgpack.v1. Append only: existing numbers are part of the protocol.
+FIELD_TAGS = {
+    "action": 0,
+    "event": 1,
+    "message": 2,
+    "sender_id": 3,
+    "receiver_id": 4,
+    "timestamp": 5,
+    "status": 6,
+    "msg_id": 7,
+    "attachment_url": 8,
+    "attachment_type": 9,
+    "msg_ids": 10,
+    "new_status": 11,
+    "user_id": 12,
+    "is_online": 13,
+    "last_seen": 14,
+    "for_everyone": 15,
+    "target_user_id": 16,
+    "reader_id": 17,
+    "other_user_id": 18,
+    "add": 19,
+    "remove": 20,
+    "code": 21,
+    "retry_after": 22,
+    "up_to": 23,
+    "seq": 24,
+    "since": 25,
+    "client_msg_id": 26,
+    "duplicate": 27,
+    "user_ids": 28,
+    "users": 29,
+    "typing": 30,
+    "expires_in": 31,
+}
+TAG_FIELDS = {tag: field for field, tag in FIELD_TAGS.items()}
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(",", ":"))
+
+
+def _orjson_dumps(obj):
+    return orjson.dumps(obj).decode()
+
+
+def _select_backend(name):
+    if name == "json" or (name == "auto" and orjson is None):
+        return "json", _stdlib_dumps, json.loads
+    if orjson is None:
+        raise ImportError("CHAT_JSON_BACKEND = 'orjson' but orjson is not installed")
+    return "orjson", _orjson_dumps, orjson.loads
+
+
+backend, dumps, loads = _select_backend(getattr(settings, "CHAT_JSON_BACKEND", "auto"))
+
+
+def pack(payload):
+    """Encode a payload as a chat.msgpack.v1 binary frame."""
+    return msgpack.packb({FIELD_TAGS.get(key, key): value for key, value in payload.items()})
+
+
+def unpack(data):
+    """Decode a chat.msgpack.v1 binary frame back to long field names."""
+    return {TAG_FIELDS.get(key, key): value for key, value in msgpack.unpackb(data, strict_map_key=False).items()}
+
+
+def msgpack_enabled():
+    return msgpack is not None and getattr(settings, "CHAT_MSGPACK_ENABLED", False)
+
+
+def build_event(handler_type, payload, coalesce=None):
+    """Channel-layer event for ``handler_type`` carrying the pre-encoded frame(s).
+
+    ``coalesce`` names the state the frame describes; a newer frame with the
+    same key may replace (or merge into) one still queued for a slow client.
+    """
+    event = {"type": handler_type, "text": dumps(payload)}
+    if msgpack_enabled():
+        event["bytes"] = pack(payload)
+    if coalesce:
+        event["coalesce"] = coalesce
+    return event
@@ -0,0 +1,17 @@
+"""Channel-layer group names and routing helpers for chat events."""
+
+
+def user_group_name(user_id):
+    """Group joined by every socket of a single ChatUser."""
+    return f"chat_user_{user_id}"
+
+
+def presence_group_name(user_id):
+    """Group of the sockets that follow ``user_id``'s online status."""
+    return f"presence_{user_id}"
+
+
+async def send_to_users(channel_layer, user_ids, event):
+    """Deliver one event to the personal group of each (distinct) user."""
+    for user_id in dict.fromkeys(uid for uid in user_ids if uid):
+        await channel_layer.group_send(user_group_name(user_id), event)
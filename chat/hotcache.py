@@ -0,0 +1,166 @@
+"""Process-local cache of the newest messages of active conversations.
+
+Opening a conversation asks for its newest history page, which was usually
+just written by this same process. Each cached conversation keeps its last
+``CHAT_HOT_CACHE_MESSAGES`` rows (the same dicts ``get_message_page`` reads
+from the database) plus the ``Conversation`` row its ticks are derived from.
+Entries are filled on the first read, extended when a write commits, dropped
+when a message is deleted, and lose their watermarks when a delivered/read
+watermark moves. Least recently used conversations are evicted once the
+estimated size passes ``CHAT_HOT_CACHE_MAX_BYTES``.
+
+A database read and the ``fill`` that caches it are not atomic: a message
+committed in between would be missing from the entry. Every change bumps the
+key's version, and ``fill`` / ``set_conversation`` are ignored when the
+version moved since the caller took it with ``version`` before reading.
+
+Writes made by other processes are not seen here, so the cache is meant for a
+single worker (``CHAT_HOT_CACHE_ENABLED`` defaults to off with Redis).
+"""
+import threading
+from collections import OrderedDict, deque
+
+from django.conf import settings
+
+from . import metrics
+
+ROW_OVERHEAD = 200  # rough bytes per cached row besides its text
+VERSION_SLOTS = 1024  # keys share version counters; a collision only skips a fill
+
+
+def row_size(row):
+    return ROW_OVERHEAD + len(row["content"] or "") + len(row["attachment"] or "")
+
+
+def message_row(msg):
+    """A saved ChatMessage in the shape of a history row."""
+    return {
+        "id": msg.id,
+        "content": msg.content,
+        "sender_id": msg.sender_id,
+        "timestamp": msg.timestamp,
+        "attachment": msg.attachment.name if msg.attachment else None,
+        "attachment_type": msg.attachment_type,
+    }
+
+
+class HotConversation:
+    __slots__ = ("rows", "has_older", "conversation", "size")
+
+    def __init__(self, rows, has_older, conversation):
+        self.rows = deque(rows)
+        self.has_older = has_older
+        self.conversation = conversation
+        self.size = sum(row_size(row) for row in rows)
+
+
+class HotMessageCache:
+    def __init__(self, max_messages=None, max_bytes=None):
+        self.max_messages = max_messages or getattr(settings, "CHAT_HOT_CACHE_MESSAGES", 50)
+        self.max_bytes = max_bytes or getattr(settings, "CHAT_HOT_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.versions = [0] * VERSION_SLOTS
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return getattr(settings, "CHAT_HOT_CACHE_ENABLED", True)
+
+    def newest_page(self, key, limit):
+        """``(rows, next_cursor, conversation)`` for the newest page, or None on a miss.
+
+        Rows are copies; ``conversation`` is None when the watermarks must be
+        reloaded (then hand them back with ``set_conversation``).
+        """
+        if not self.enabled():
+            return None
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is None or (len(entry.rows) < limit and entry.has_older):
+                metrics.incr("hot_cache.misses")
+                return None
+            self.entries.move_to_end(key)
+            metrics.incr("hot_cache.hits")
+            rows = [dict(row) for row in list(entry.rows)[-limit:]]
+            has_more = len(entry.rows) > limit or entry.has_older
+            return rows, rows[0]["id"] if has_more and rows else None, entry.conversation
+
+    def version(self, key):
+        """Take before reading what will be passed to ``fill``/``set_conversation``."""
+        return self.versions[hash(key) % VERSION_SLOTS]
+
+    def fill(self, key, rows, has_older, conversation, version):
+        """Cache the newest rows read from the database (oldest first)."""
+        if not self.enabled():
+            return
+        has_older = has_older or len(rows) > self.max_messages
+        rows = [dict(row) for row in rows[-self.max_messages:]]
+        entry = HotConversation(rows, has_older, conversation)
+        with self._lock:
+            if self.version(key) != version:
+                metrics.incr("hot_cache.stale_fills")
+                return
+            self._drop(key)
+            self.entries[key] = entry
+            self._account(entry.size)
+
+    def set_conversation(self, key, conversation, version):
+        with self._lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.version(key) == version:
+                entry.conversation = conversation
+
+    def add(self, key, msg):
+        """A committed new message; extends the conversation if it is cached."""
+        with self._lock:
+            self._bump(key)
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            self.entries.move_to_end(key)
+            row = message_row(msg)
+            entry.rows.append(row)
+            entry.size += row_size(row)
+            self._account(row_size(row))
+            while len(entry.rows) > self.max_messages:
+                dropped = entry.rows.popleft()
+                entry.size -= row_size(dropped)
+                entry.has_older = True
+                self._account(-row_size(dropped))
+
+    def forget_watermarks(self, key):
+        with self._lock:
+            self._bump(key)
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.conversation = None
+
+    def invalidate(self, key):
+        with self._lock:
+            self._bump(key)
+            self._drop(key)
+
+    def clear(self):
+        with self._lock:
+            for key in list(self.entries):
+                self._drop(key)
+
+    def _bump(self, key):
+        self.versions[hash(key) % VERSION_SLOTS] += 1
+
+    def _drop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self._account(-entry.size)
+
+    def _account(self, delta):
+        self.bytes += delta
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            _, entry = self.entries.popitem(last=False)
+            self.bytes -= entry.size
+            metrics.incr("hot_cache.evictions")
+        metrics.gauge_set("hot_cache.bytes", self.bytes)
+        metrics.gauge_set("hot_cache.conversations", len(self.entries))
+
+
+hot_messages = HotMessageCache()
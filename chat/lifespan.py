@@ -0,0 +1,18 @@
+"""ASGI lifespan handler.
+
+Buffered write-behind messages are flushed once, when the server shuts down,
+instead of on every WebSocket disconnect. Servers that do not speak the
+lifespan protocol simply never call this.
+"""
+from .writer import flush_message_writer
+
+
+async def lifespan(scope, receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await flush_message_writer()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
@@ -0,0 +1,134 @@
+import asyncio
+import statistics
+import time
+
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.sessions import SessionMiddlewareStack
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.sessions.backends.db import SessionStore
+from django.contrib.sessions.models import Session
+from django.core.management.base import BaseCommand
+from django.test.utils import override_settings
+
+from chat import frames
+from chat.changefeed import current_seq
+from chat.models import ChatUser
+from chat.routing import websocket_urlpatterns
+
+BENCH_PREFIX = '+bench'
+
+# action -> (request for (user, peer, n), is this frame its reply?)
+ACTIONS = {
+    'send_message': (
+        lambda user, peer, n: {
+            'action': 'send_message', 'receiver_id': peer.id,
+            'message': f'bench {n}', 'client_msg_id': f'bench-{user.id}-{n}',
+        },
+        lambda frame, user, n: frame.get('client_msg_id') == f'bench-{user.id}-{n}',
+    ),
+    'get_presence': (
+        lambda user, peer, n: {'action': 'get_presence', 'target_user_id': peer.id},
+        lambda frame, user, n: frame.get('event') == 'presence_update',
+    ),
+    'resume': (
+        lambda user, peer, n: {'action': 'resume', 'since': user.bench_seq},
+        lambda frame, user, n: frame.get('event') in ('resumed', 'resync'),
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = "Per-action WebSocket latency (send → reply) at several concurrency levels."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency', type=int, action='append', default=None,
+            help='sockets acting at once (repeatable, default 1, 100 and 1000)',
+        )
+        parser.add_argument('--rounds', type=int, default=5, help='requests per socket and action')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='CHAT_DB_EXECUTOR_WORKERS for the run (default: the setting)',
+        )
+
+    def handle(self, *args, **options):
+        levels = options['concurrency'] or [1, 100, 1000]
+        workers = options['workers']
+        if workers is None:
+            workers = getattr(settings, 'CHAT_DB_EXECUTOR_WORKERS', 0)
+
+        users = self.create_users(max(levels) + 1)
+        try:
+            # Rate limits would measure the limiter, not the database path.
+            with override_settings(CHAT_RATE_LIMITS={}, CHAT_DB_EXECUTOR_WORKERS=workers):
+                self.stdout.write(f"CHAT_DB_EXECUTOR_WORKERS={workers}")
+                for concurrency in levels:
+                    results = asyncio.run(self.run(users[:concurrency + 1], options['rounds']))
+                    for action, latencies in results.items():
+                        self.stdout.write(f"{action:<14} c={concurrency:<5} {self.summary(latencies)}")
+        finally:
+            Session.objects.filter(session_key__in=[user.session_key for user in users]).delete()
+            ChatUser.objects.filter(number__startswith=BENCH_PREFIX).delete()
+
+    def create_users(self, count):
+        ChatUser.objects.filter(number__startswith=BENCH_PREFIX).delete()
+        ChatUser.objects.bulk_create(
+            ChatUser(name=f'bench {i}', number=f'{BENCH_PREFIX}{i}') for i in range(count)
+        )
+        users = list(ChatUser.objects.filter(number__startswith=BENCH_PREFIX).order_by('id'))
+        for user in users:
+            session = SessionStore()
+            session['chat_user_id'] = user.id
+            session.create()
+            user.session_key = session.session_key
+        return users
+
+    async def run(self, users, rounds):
+        application = SessionMiddlewareStack(URLRouter(websocket_urlpatterns))
+        sockets = []
+        for user in users[:-1]:
+            communicator = WebsocketCommunicator(
+                application,
+                '/ws/chat/global_chat/',
+                headers=[(b'cookie', f'{settings.SESSION_COOKIE_NAME}={user.session_key}'.encode())],
+            )
+            connected, _ = await communicator.connect()
+            if not connected:
+                raise RuntimeError(f'{user.number} could not connect')
+            sockets.append(communicator)
+        seq = await database_sync_to_async(current_seq)()
+        for user in users:
+            user.bench_seq = seq
+
+        results = {}
+        try:
+            for action, (request, is_reply) in ACTIONS.items():
+                latencies = await asyncio.gather(*(
+                    self.client(socket, user, peer, rounds, request, is_reply)
+                    for socket, user, peer in zip(sockets, users, users[1:])
+                ))
+                results[action] = [value for values in latencies for value in values]
+        finally:
+            for communicator in sockets:
+                await communicator.disconnect()
+        return results
+
+    async def client(self, communicator, user, peer, rounds, request, is_reply):
+        latencies = []
+        for n in range(rounds):
+            start = time.perf_counter()
+            await communicator.send_to(text_data=frames.dumps(request(user, peer, n)))
+            while not is_reply(frames.loads(await communicator.receive_from(timeout=60)), user, n):
+                pass
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    def summary(self, latencies):
+        latencies = sorted(latencies)
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return (
+            f"n={len(latencies):<6} p50 {quantiles[49] * 1000:8.2f} ms  "
+            f"p95 {quantiles[94] * 1000:8.2f} ms  p99 {quantiles[98] * 1000:8.2f} ms"
+        )
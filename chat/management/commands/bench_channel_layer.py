@@ -0,0 +1,68 @@
+import asyncio
+import time
+
+from channels.layers import InMemoryChannelLayer
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+
+class Command(BaseCommand):
+    help = "Compare group_send → receive throughput of the in-memory and Redis channel layers."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--messages', type=int, default=2000)
+        parser.add_argument('--receivers', type=int, default=10, help='sockets in the group')
+        parser.add_argument(
+            '--redis', action='append', default=None,
+            help='redis:// URL (repeat for shards). Defaults to CHAT_REDIS_HOSTS, '
+                 'then to a fakeredis stand-in.',
+        )
+
+    def handle(self, *args, **options):
+        layers = [('in-memory', InMemoryChannelLayer(**settings.CHANNEL_LAYER_CONFIG))]
+        layers.append(self.redis_layer(options['redis'] or settings.CHAT_REDIS_HOSTS))
+
+        for name, layer in layers:
+            elapsed = asyncio.run(self.run(layer, options['messages'], options['receivers']))
+            delivered = options['messages'] * options['receivers']
+            self.stdout.write(
+                f"{name:<22} {options['messages']} sends x {options['receivers']} receivers: "
+                f"{elapsed * 1000:.1f} ms, {delivered / elapsed:,.0f} deliveries/s"
+            )
+
+    def redis_layer(self, hosts):
+        try:
+            from channels_redis.core import RedisChannelLayer
+        except ImportError:
+            raise CommandError("channels_redis is not installed.")
+
+        config = dict(settings.CHANNEL_LAYER_CONFIG)
+        if hosts:
+            return 'redis', RedisChannelLayer(hosts=hosts, **config)
+
+        try:
+            import fakeredis
+            from fakeredis.aioredis import FakeConnection
+        except ImportError:
+            raise CommandError("Pass --redis or install fakeredis[lua] for a local stand-in.")
+        hosts = [{'connection_class': FakeConnection, 'server': fakeredis.FakeServer()}]
+        return 'redis (fakeredis)', RedisChannelLayer(hosts=hosts, **config)
+
+    async def run(self, layer, messages, receivers):
+        # Keep the queue below capacity: drain after every send.
+        channels = [await layer.new_channel() for _ in range(receivers)]
+        for channel in channels:
+            await layer.group_add('bench', channel)
+
+        start = time.perf_counter()
+        for i in range(messages):
+            await layer.group_send('bench', {'type': 'chat_message', 'msg_id': i})
+            for channel in channels:
+                await layer.receive(channel)
+        elapsed = time.perf_counter() - start
+
+        for channel in channels:
+            await layer.group_discard('bench', channel)
+        if hasattr(layer, 'flush'):
+            await layer.flush()
+        return elapsed
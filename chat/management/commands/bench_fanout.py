@@ -0,0 +1,47 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import frames
+
+
+class Command(BaseCommand):
+    help = "Per-recipient cost of a group event: json.dumps per consumer vs. serialize-once."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--recipients', type=int, default=1000)
+        parser.add_argument('--rounds', type=int, default=200)
+
+    def handle(self, *args, **options):
+        recipients, rounds = options['recipients'], options['rounds']
+        event = {
+            "event": "chat_message",
+            "message": "Hey! Are we still on for tomorrow? " * 3,
+            "sender_id": 12,
+            "receiver_id": 34,
+            "timestamp": "2025-10-17 09:15:22.123456+00:00",
+            "status": "sent",
+            "msg_id": 987654,
+            "attachment_url": None,
+            "attachment_type": None,
+        }
+
+        def per_consumer():
+            # Old handlers: each consumer rebuilt and re-encoded the same dict.
+            for _ in range(recipients):
+                json.dumps({key: event.get(key) for key in event})
+
+        def serialize_once():
+            built = frames.build_event("chat_message", event)
+            for _ in range(recipients):
+                built["text"]
+
+        for name, fn in (("json.dumps per recipient", per_consumer),
+                         (f"serialize once ({frames.backend})", serialize_once)):
+            start = time.perf_counter()
+            for _ in range(rounds):
+                fn()
+            elapsed = time.perf_counter() - start
+            per_recipient_ns = elapsed / (rounds * recipients) * 1e9
+            self.stdout.write(f"{name:<32} {per_recipient_ns:8.1f} ns/recipient")
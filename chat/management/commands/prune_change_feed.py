@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat import changefeed
+
+
+class Command(BaseCommand):
+    help = "Delete change-feed entries older than CHAT_CHANGE_FEED_RETENTION (run periodically)."
+
+    def handle(self, *args, **options):
+        deleted = changefeed.prune()
+        self.stdout.write(f"Pruned {deleted} change-feed entries")
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from chat import uploads
+
+
+class Command(BaseCommand):
+    help = "Delete upload sessions idle longer than CHAT_UPLOAD_SESSION_TTL and their temp files (run periodically)."
+
+    def handle(self, *args, **options):
+        deleted = uploads.prune()
+        self.stdout.write(f"Pruned {deleted} upload sessions")
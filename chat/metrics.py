@@ -0,0 +1,47 @@
+"""Process-local counters, gauges and timings for the chat runtime."""
+from collections import defaultdict
+
+counters = defaultdict(int)
+gauges = defaultdict(int)
+timings = defaultdict(lambda: [0, 0.0, 0.0])  # name -> [count, total seconds, max seconds]
+
+# Callables ``hook(name, seconds)`` run for every timing, e.g. to export histograms.
+timing_hooks = []
+
+
+def incr(name, value=1):
+    counters[name] += value
+
+
+def gauge_add(name, value):
+    gauges[name] += value
+
+
+def gauge_set(name, value):
+    gauges[name] = value
+
+
+def gauge_max(name, value):
+    if value > gauges[name]:
+        gauges[name] = value
+
+
+def observe(name, seconds):
+    timing = timings[name]
+    timing[0] += 1
+    timing[1] += seconds
+    if seconds > timing[2]:
+        timing[2] = seconds
+    for hook in timing_hooks:
+        hook(name, seconds)
+
+
+def snapshot():
+    return {
+        "counters": dict(counters),
+        "gauges": dict(gauges),
+        "timings": {
+            name: {"count": count, "total_ms": round(total * 1000, 3), "max_ms": round(peak * 1000, 3)}
+            for name, (count, total, peak) in timings.items()
+        },
+    }
@@ -0,0 +1,63 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:08
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def backfill_conversations(apps, schema_editor):
+    """Build one summary row per user pair from the existing messages."""
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    summaries = {}
+    rows = ChatMessage.objects.order_by('id').values_list(
+        'id', 'sender_id', 'receiver_id', 'content', 'attachment_type', 'timestamp', 'status'
+    )
+    for msg_id, sender_id, receiver_id, content, attachment_type, timestamp, status in rows.iterator():
+        low, high = sorted((sender_id, receiver_id))
+        summary = summaries.setdefault((low, high), Conversation(user_low_id=low, user_high_id=high))
+        summary.last_message_id = msg_id
+        summary.last_message_time = timestamp
+        summary.last_sender_id = sender_id
+        if content:
+            summary.last_message_preview = content[:200]
+        elif attachment_type:
+            summary.last_message_preview = f"📎 {attachment_type.title()}"
+        else:
+            summary.last_message_preview = ''
+        if status in ('sent', 'delivered') and sender_id != receiver_id:
+            if receiver_id == low:
+                summary.unread_low += 1
+            else:
+                summary.unread_high += 1
+
+    Conversation.objects.bulk_create(summaries.values(), batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0022_alter_chatmessage_attachment_type_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_message_preview', models.CharField(blank=True, default='', max_length=200)),
+                ('last_message_time', models.DateTimeField(blank=True, null=True)),
+                ('unread_low', models.PositiveIntegerField(default=0)),
+                ('unread_high', models.PositiveIntegerField(default=0)),
+                ('last_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatmessage')),
+                ('last_sender', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.chatuser')),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatuser')),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatuser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', '-last_message_time'], name='conversation_low_recent'), models.Index(fields=['user_high', '-last_message_time'], name='conversation_high_recent')],
+                'constraints': [models.UniqueConstraint(fields=('user_low', 'user_high'), name='unique_conversation_pair')],
+            },
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,50 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:11
+
+from django.db import migrations, models
+
+BATCH_SIZE = 1000
+
+
+def backfill_conversation_keys(apps, schema_editor):
+    """Fill conversation_key for existing messages, BATCH_SIZE rows at a time."""
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    last_id = 0
+    while True:
+        batch = list(
+            ChatMessage.objects.filter(id__gt=last_id, conversation_key='')
+            .order_by('id')
+            .only('id', 'sender_id', 'receiver_id')[:BATCH_SIZE]
+        )
+        if not batch:
+            break
+        by_key = {}
+        for msg in batch:
+            low, high = sorted((msg.sender_id, msg.receiver_id))
+            by_key.setdefault(f"{low}_{high}", []).append(msg.id)
+        for key, ids in by_key.items():
+            ChatMessage.objects.filter(id__in=ids).update(conversation_key=key)
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0023_conversation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='conversation_key',
+            field=models.CharField(default='', editable=False, max_length=32),
+        ),
+        migrations.RunPython(backfill_conversation_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['conversation_key', 'id'], name='chatmessage_conversation'),
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['receiver', 'status'], name='chatmessage_receiver_status'),
+        ),
+    ]
@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:13
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def backfill_watermarks(apps, schema_editor):
+    """Start each watermark at the newest message already marked delivered/read."""
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    Conversation = apps.get_model('chat', 'Conversation')
+
+    for kind, statuses in (('delivered', ('delivered', 'read')), ('read', ('read',))):
+        rows = (
+            ChatMessage.objects.filter(status__in=statuses)
+            .values('conversation_key', 'receiver_id')
+            .annotate(up_to=Max('id'))
+        )
+        for row in rows.iterator():
+            low, high = (int(part) for part in row['conversation_key'].split('_'))
+            side = 'low' if row['receiver_id'] == low else 'high'
+            Conversation.objects.filter(user_low_id=low, user_high_id=high).update(
+                **{f'{kind}_{side}': row['up_to']}
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0024_chatmessage_conversation_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='delivered_high',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='delivered_low',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='read_high',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='read_low',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_watermarks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:15
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0025_conversation_watermarks'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('payload', models.JSONField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user_high', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatuser')),
+                ('user_low', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.chatuser')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_low', 'id'], name='change_low_seq'), models.Index(fields=['user_high', 'id'], name='change_high_seq')],
+            },
+        ),
+    ]
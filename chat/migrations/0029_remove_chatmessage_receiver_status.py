@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 06:41
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0028_uploadsession'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chatmessage_receiver_status',
+        ),
+    ]
@@ -1,6 +1,7 @@
 from django.db import models
 from django.utils import timezone
 import pyotp
+import uuid
 import time
 
 class ChatUser(models.Model):
@@ -41,6 +42,12 @@ class ChatUser(models.Model):
     def __str__(self):
         return f"{self.name} ({self.number})"
 
+def conversation_key(user_a_id, user_b_id):
+    """Canonical key of the conversation between two users, e.g. ``"3_7"``."""
+    low, high = sorted((int(user_a_id), int(user_b_id)))
+    return f"{low}_{high}"
+
+
 class ChatMessage(models.Model):
     sender = models.ForeignKey(ChatUser, related_name='sent_chat_messages', on_delete=models.CASCADE)
     receiver = models.ForeignKey(ChatUser, related_name='received_chat_messages', on_delete=models.CASCADE)
@@ -59,12 +66,144 @@ class ChatMessage(models.Model):
         ]
     status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='sent')
 
+    # Same value for both directions of a conversation, so history is one
+    # index range scan instead of an OR of two sender/receiver lookups.
+    # Filled in by save(); bulk_create callers set it themselves.
+    conversation_key = models.CharField(max_length=32, default='', editable=False)
+
+    # Idempotency key generated by the sending client; a retried send with
+    # the same key resolves to the message that was already stored.
+    client_msg_id = models.CharField(max_length=64, null=True, blank=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['sender', 'client_msg_id'], name='unique_client_msg_id'),
+        ]
+        indexes = [
+            models.Index(fields=['conversation_key', 'id'], name='chatmessage_conversation'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if not self.conversation_key:
+            self.conversation_key = conversation_key(self.sender_id, self.receiver_id)
+        super().save(*args, **kwargs)
+
     def __str__(self):
         display_text = self.content[:20] if self.content else (
             self.attachment.name if self.attachment else "[Empty]"
         )
         return f"{self.sender} -> {self.receiver}: {self.content[:20]} ({self.status})  {display_text}"
     
+class Conversation(models.Model):
+    """Chat-list summary for one pair of users, kept up to date on every write.
+
+    The pair is stored ordered (``user_low.id < user_high.id``) so each
+    conversation has exactly one row; ``unread_low``/``unread_high`` count the
+    messages each side has not read yet. ``delivered_*``/``read_*`` are
+    watermarks: every message to that side with an id up to the value has
+    been delivered/read, which is where message ticks come from.
+    """
+    user_low = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    last_message = models.ForeignKey(
+        ChatMessage, related_name='+', null=True, blank=True, on_delete=models.SET_NULL
+    )
+    last_message_preview = models.CharField(max_length=200, blank=True, default='')
+    last_message_time = models.DateTimeField(null=True, blank=True)
+    last_sender = models.ForeignKey(
+        ChatUser, related_name='+', null=True, blank=True, on_delete=models.SET_NULL
+    )
+    unread_low = models.PositiveIntegerField(default=0)
+    unread_high = models.PositiveIntegerField(default=0)
+    delivered_low = models.BigIntegerField(default=0)
+    delivered_high = models.BigIntegerField(default=0)
+    read_low = models.BigIntegerField(default=0)
+    read_high = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_low', 'user_high'], name='unique_conversation_pair'),
+        ]
+        indexes = [
+            models.Index(fields=['user_low', '-last_message_time'], name='conversation_low_recent'),
+            models.Index(fields=['user_high', '-last_message_time'], name='conversation_high_recent'),
+        ]
+
+    def other_user(self, user_id):
+        return self.user_high if self.user_low_id == user_id else self.user_low
+
+    def unread_for(self, user_id):
+        return self.unread_low if self.user_low_id == user_id else self.unread_high
+
+    def message_status(self, msg_id, receiver_id):
+        """Tick state of message ``msg_id`` sent to ``receiver_id``."""
+        if self.user_low_id == receiver_id:
+            delivered, read = self.delivered_low, self.read_low
+        else:
+            delivered, read = self.delivered_high, self.read_high
+        if msg_id <= read:
+            return 'read'
+        if msg_id <= delivered:
+            return 'delivered'
+        return 'sent'
+
+    def __str__(self):
+        return f"{self.user_low_id} <-> {self.user_high_id}: {self.last_message_preview[:20]}"
+
+
+class ChangeEvent(models.Model):
+    """One entry of the change feed replayed to reconnecting clients.
+
+    ``id`` is the sequence number: it only grows, so a client that remembers
+    the last ``seq`` it saw can ask for everything after it. Every change
+    concerns a pair of users (ordered like ``Conversation``) and ``payload``
+    is the frame that was broadcast to them.
+    """
+    user_low = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    user_high = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user_low', 'id'], name='change_low_seq'),
+            models.Index(fields=['user_high', 'id'], name='change_high_seq'),
+        ]
+
+    def __str__(self):
+        return f"#{self.id} {self.user_low_id} <-> {self.user_high_id}: {self.payload.get('event')}"
+
+
+class UploadSession(models.Model):
+    """A resumable attachment upload (init -> chunks -> complete).
+
+    Chunks are written straight into a temp file named after ``id``;
+    ``received`` is how many leading bytes of it are stored. ``message`` is
+    set once the upload was completed, so a retried completion returns the
+    same message. Sessions idle for ``CHAT_UPLOAD_SESSION_TTL`` are removed
+    with their temp file by ``manage.py prune_upload_sessions``.
+    """
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    sender = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    receiver = models.ForeignKey(ChatUser, related_name='+', on_delete=models.CASCADE)
+    file_name = models.CharField(max_length=255)
+    file_type = models.CharField(max_length=20)
+    size = models.BigIntegerField()
+    sha256 = models.CharField(max_length=64)
+    received = models.BigIntegerField(default=0)
+    message = models.ForeignKey(
+        ChatMessage, related_name='+', null=True, blank=True, on_delete=models.SET_NULL
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['updated_at'], name='upload_session_updated')]
+
+    def __str__(self):
+        return f"{self.id} {self.file_name} {self.received}/{self.size}"
+
+
 class TempUser(models.Model):
     country_code = models.CharField(max_length=10)
     number = models.CharField(max_length=15, unique=True)
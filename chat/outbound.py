@@ -0,0 +1,96 @@
+"""Bounded per-connection send queue.
+
+Channel-layer events are handed to the consumer as fast as the layer can
+deliver them, while a slow client drains its socket at network speed. Each
+connection therefore buffers outgoing frames here, up to
+``CHAT_SEND_QUEUE_MAX_MESSAGES`` frames / ``CHAT_SEND_QUEUE_MAX_BYTES`` bytes.
+A queued frame is replaced by a newer one with the same coalesce key (the
+latest presence of a user, the latest delivered/read watermark), so a backlog
+does not grow with redundant state. ``put`` returns False when a frame does not fit;
+the consumer then applies ``CHAT_SEND_QUEUE_POLICY``.
+"""
+import asyncio
+from collections import deque
+
+from django.conf import settings
+
+from . import metrics
+
+
+def frame_size(frame):
+    """Bytes the frame takes on the wire (text frames are sent as UTF-8)."""
+    text = frame.get("text_data")
+    if text is None:
+        return len(frame.get("bytes_data") or b"")
+    return len(text) if text.isascii() else len(text.encode())
+
+
+class OutboundQueue:
+    def __init__(self, send, max_messages=None, max_bytes=None):
+        self._send = send
+        self.max_messages = max_messages or getattr(settings, "CHAT_SEND_QUEUE_MAX_MESSAGES", 200)
+        self.max_bytes = max_bytes or getattr(settings, "CHAT_SEND_QUEUE_MAX_BYTES", 1024 * 1024)
+        self.entries = deque()  # [key, frame, size]
+        self.by_key = {}
+        self.bytes = 0
+        self.closed = False
+        self._ready = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def put(self, frame, key=None):
+        """Queue a frame (``text_data=`` or ``bytes_data=`` kwargs for send)."""
+        if self.closed:
+            return False
+        entry = self.by_key.get(key) if key else None
+        if entry is not None:
+            size = frame_size(frame)
+            if self.bytes + size - entry[2] > self.max_bytes:
+                metrics.incr("send_queue.overflows")
+                return False
+            self._account(0, size - entry[2])
+            entry[1], entry[2] = frame, size
+            metrics.incr("send_queue.coalesced")
+            return True
+
+        size = frame_size(frame)
+        if len(self.entries) >= self.max_messages or self.bytes + size > self.max_bytes:
+            metrics.incr("send_queue.overflows")
+            return False
+        entry = [key, frame, size]
+        self.entries.append(entry)
+        if key:
+            self.by_key[key] = entry
+        self._account(1, size)
+        metrics.gauge_max("send_queue.max_depth", len(self.entries))
+        self._ready.set()
+        return True
+
+    def _account(self, frames_delta, bytes_delta):
+        self.bytes += bytes_delta
+        metrics.gauge_add("send_queue.frames", frames_delta)
+        metrics.gauge_add("send_queue.bytes", bytes_delta)
+
+    async def _run(self):
+        while True:
+            if not self.entries:
+                self._ready.clear()
+                await self._ready.wait()
+                continue
+            key, frame, size = self.entries.popleft()
+            if key:
+                self.by_key.pop(key, None)
+            self._account(-1, -size)
+            await self._send(**frame)
+
+    def close(self):
+        """Stop the writer and release whatever is still queued."""
+        if self.closed:
+            return
+        self.closed = True
+        self._task.cancel()
+        self._account(-len(self.entries), -self.bytes)
+        self.entries.clear()
+        self.by_key.clear()
@@ -0,0 +1,338 @@
+"""Process-level presence registry and per-user connection counts.
+
+Heartbeats and connect/disconnect only touch memory here; dirty entries are
+written back to ``ChatUser`` by a periodic flush that issues one batched
+UPDATE of ``is_online``/``last_seen`` (and nothing else) per interval.
+
+Each process only sees the sockets it serves, so with a channels_redis layer
+every change is also written to a Redis hash per user (``apublish``) and
+answers come from there (``aload``/``aload_many``); a worker never answers
+from its own memory for users connected elsewhere. The local entries then only
+feed the database flush. The online flag is only believed while the user still
+has a live socket in the connection set below (or is inside the grace period),
+so users of a worker that crashed read as offline once their sockets expire,
+even though that worker never ran ``go_offline``.
+
+A user is online while any of their sockets is open. ``ConnectionCounter`` counts
+them (in Redis when the channel layer is channels_redis, so every worker sees
+the same count). There each socket is a member of a sorted set scored by its
+last heartbeat, so sockets of a worker that died without closing them stop
+counting after ``CHAT_PRESENCE_CONNECTION_TTL`` seconds. The user is reported
+offline only when the last socket has been closed for
+``CHAT_PRESENCE_GRACE_PERIOD`` seconds, so reloads and quick reconnects do not
+flap.
+"""
+import asyncio
+import time
+import weakref
+from datetime import datetime, timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+
+from .dbexec import db_sync_to_async
+from .models import ChatUser
+
+
+# KEYS[1] = presence hash of a user. ARGV = online ("1"/"0"), last_seen
+# (timestamp, "" keeps the stored one), expiry.
+REDIS_PRESENCE_SET = """
+redis.call('HSET', KEYS[1], 'online', ARGV[1])
+if ARGV[2] ~= '' then
+    redis.call('HSET', KEYS[1], 'last_seen', ARGV[2])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+"""
+
+
+def presence_key(channel_layer, user_id):
+    return f"{channel_layer.prefix}:presence:{user_id}"
+
+
+class PresenceRegistry:
+    def __init__(self):
+        self.states = {}  # user_id -> (is_online, last_seen)
+        self.dirty = set()
+
+    def set_online(self, user_id, is_online):
+        user_id = int(user_id)
+        _, last_seen = self.states.get(user_id, (False, None))
+        if not is_online:
+            last_seen = timezone.now()
+        self.states[user_id] = (is_online, last_seen)
+        self.dirty.add(user_id)
+
+    def touch(self, user_id):
+        user_id = int(user_id)
+        is_online, _ = self.states.get(user_id, (True, None))
+        self.states[user_id] = (is_online, timezone.now())
+        self.dirty.add(user_id)
+
+    def get(self, user_id):
+        """``(is_online, last_seen)`` or None when this process never saw the user."""
+        return self.states.get(int(user_id))
+
+    def load(self, user_id):
+        """Answer from memory, falling back to (and caching) the database row."""
+        state = self.get(user_id)
+        if state is None:
+            row = ChatUser.objects.filter(id=user_id).values_list("is_online", "last_seen").first()
+            if row is None:
+                return None
+            state = self.states.setdefault(int(user_id), tuple(row))
+        return state
+
+    async def aload(self, user_id, channel_layer=None):
+        """``load`` through the async ORM, for consumers (shared state with Redis)."""
+        if hasattr(channel_layer, "consistent_hash"):
+            return (await self.aload_many([user_id], channel_layer)).get(int(user_id))
+        state = self.get(user_id)
+        if state is None:
+            row = await ChatUser.objects.filter(id=user_id).values_list("is_online", "last_seen").afirst()
+            if row is None:
+                return None
+            state = self.states.setdefault(int(user_id), tuple(row))
+        return state
+
+    def load_many(self, user_ids):
+        """``{user_id: (is_online, last_seen)}``; unknown ids cost one ``id__in`` query."""
+        states, missing = self._split(user_ids)
+        if missing:
+            rows = ChatUser.objects.filter(id__in=missing).values_list("id", "is_online", "last_seen")
+            self._remember(states, rows)
+        return states
+
+    async def aload_many(self, user_ids, channel_layer=None):
+        """``load_many`` through the async ORM, for consumers (shared state with Redis)."""
+        if hasattr(channel_layer, "consistent_hash"):
+            states, connected = await self.aload_shared(channel_layer, user_ids)
+            missing = {int(user_id) for user_id in user_ids} - set(states)
+            if missing:
+                # The row may still say online if the user's worker died before flushing the change.
+                rows = ChatUser.objects.filter(id__in=missing).values_list("id", "is_online", "last_seen")
+                states.update({
+                    user_id: (is_online and user_id in connected, last_seen)
+                    async for user_id, is_online, last_seen in rows
+                })
+            return states
+        states, missing = self._split(user_ids)
+        if missing:
+            rows = ChatUser.objects.filter(id__in=missing).values_list("id", "is_online", "last_seen")
+            self._remember(states, [row async for row in rows])
+        return states
+
+    async def apublish(self, channel_layer, user_id):
+        """Copy this process's state of ``user_id`` to Redis (channels_redis layers only)."""
+        if not hasattr(channel_layer, "consistent_hash"):
+            return
+        is_online, last_seen = self.states[int(user_id)]
+        key = presence_key(channel_layer, user_id)
+        connection = channel_layer.connection(channel_layer.consistent_hash(key))
+        await connection.eval(
+            REDIS_PRESENCE_SET, 1, key, int(is_online), last_seen.timestamp() if last_seen else "",
+            channel_layer.group_expiry,
+        )
+
+    async def aload_shared(self, channel_layer, user_ids):
+        """``(states, connected)`` from Redis, one pipelined round trip per host.
+
+        ``states`` holds ``(is_online, last_seen)`` of the users Redis has
+        state for; ``connected`` the users with a live socket (or inside the
+        grace period). ``is_online`` is only true for connected users.
+        """
+        now, ttl = time.time(), connection_ttl()
+        shards = {}
+        for user_id in {int(user_id) for user_id in user_ids}:
+            key = presence_key(channel_layer, user_id)
+            sockets = connections_key(channel_layer, user_id)
+            shards.setdefault(channel_layer.consistent_hash(key), []).append((user_id, "state", key))
+            # The grace marker is written by the connection script, on the set's host.
+            sockets_shard = shards.setdefault(channel_layer.consistent_hash(sockets), [])
+            sockets_shard.append((user_id, "sockets", sockets))
+            sockets_shard.append((user_id, "closing", closing_key(sockets)))
+        found, connected = {}, set()
+        for index, reads in shards.items():
+            async with channel_layer.connection(index).pipeline(transaction=False) as pipe:
+                for _, kind, key in reads:
+                    if kind == "state":
+                        pipe.hmget(key, "online", "last_seen")
+                    elif kind == "sockets":
+                        pipe.zcount(key, f"({now - ttl}", "+inf")
+                    else:
+                        pipe.exists(key)
+                results = await pipe.execute()
+            for (user_id, kind, _), result in zip(reads, results):
+                if kind == "state":
+                    found[user_id] = result
+                elif result:
+                    connected.add(user_id)
+        states = {}
+        for user_id, (online, last_seen) in found.items():
+            if online is not None:
+                states[user_id] = (online == b"1" and user_id in connected, from_timestamp(last_seen))
+        return states, connected
+
+    def _split(self, user_ids):
+        states, missing = {}, set()
+        for user_id in user_ids:
+            state = self.get(user_id)
+            if state is None:
+                missing.add(int(user_id))
+            else:
+                states[int(user_id)] = state
+        return states, missing
+
+    def _remember(self, states, rows):
+        for user_id, is_online, last_seen in rows:
+            states[user_id] = self.states.setdefault(user_id, (is_online, last_seen))
+
+    def flush(self):
+        """Write dirty entries back in one UPDATE touching only presence fields."""
+        if not self.dirty:
+            return 0
+        dirty, self.dirty = self.dirty, set()
+        users = [
+            ChatUser(id=user_id, is_online=self.states[user_id][0], last_seen=self.states[user_id][1])
+            for user_id in dirty
+        ]
+        try:
+            return ChatUser.objects.bulk_update(users, ["is_online", "last_seen"], batch_size=len(users))
+        except Exception:
+            self.dirty |= dirty  # retry on the next interval
+            raise
+
+
+def from_timestamp(value):
+    return datetime.fromtimestamp(float(value), tz=dt_timezone.utc) if value else None
+
+
+registry = PresenceRegistry()
+
+# KEYS[1] = zset of a user's open channels scored by last heartbeat, KEYS[2] =
+# grace marker. ARGV = op ("open", "close", "count"), channel, now, ttl, grace.
+# Channels silent for longer than ttl (their worker died without closing them)
+# are trimmed first. Closing the last channel sets the marker for the grace
+# period, so readers still see the user online. Returns how many are left.
+REDIS_CONNECTION_COUNT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[3] - ARGV[4])
+if ARGV[1] == 'open' then
+    redis.call('ZADD', KEYS[1], ARGV[3], ARGV[2])
+    redis.call('DEL', KEYS[2])
+elseif ARGV[1] == 'close' then
+    redis.call('ZREM', KEYS[1], ARGV[2])
+end
+local count = redis.call('ZCARD', KEYS[1])
+if count == 0 then
+    redis.call('DEL', KEYS[1])
+    if ARGV[1] == 'close' and tonumber(ARGV[5]) > 0 then
+        redis.call('SET', KEYS[2], 1, 'PX', math.ceil(ARGV[5] * 1000))
+    end
+else
+    redis.call('EXPIRE', KEYS[1], math.ceil(ARGV[4]))
+end
+return count
+"""
+
+
+def connection_ttl():
+    return getattr(settings, "CHAT_PRESENCE_CONNECTION_TTL", 60)
+
+
+def connections_key(channel_layer, user_id):
+    return f"{channel_layer.prefix}:connections:{user_id}"
+
+
+def closing_key(connections):
+    return f"{connections}:closing"
+
+
+class ConnectionCounter:
+    def __init__(self):
+        self.channels = {}  # user_id -> open channel names in this process (local layer only)
+        self.pending_offline = {}  # user_id -> TimerHandle of the grace period
+
+    async def open(self, channel_layer, user_id, channel_name):
+        """Count a new socket; True if the user just came online (announce it).
+
+        A reconnect inside the grace period cancels the pending offline and
+        is not announced: subscribers never saw the user leave.
+        """
+        user_id = int(user_id)
+        timer = self.pending_offline.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        count = await self._update(channel_layer, user_id, "open", channel_name)
+        return count == 1 and timer is None
+
+    async def refresh(self, channel_layer, user_id, channel_name):
+        """Heartbeat: keep the socket from being trimmed as abandoned."""
+        await self._update(channel_layer, int(user_id), "open", channel_name)
+
+    async def close(self, channel_layer, user_id, channel_name, go_offline):
+        """Uncount a socket; ``await go_offline()`` once none is left after the grace period."""
+        user_id = int(user_id)
+        if await self._update(channel_layer, user_id, "close", channel_name):
+            return
+        grace = getattr(settings, "CHAT_PRESENCE_GRACE_PERIOD", 5)
+        if not grace:
+            await go_offline()
+            return
+        previous = self.pending_offline.pop(user_id, None)
+        if previous is not None:
+            previous.cancel()
+        self.pending_offline[user_id] = asyncio.get_running_loop().call_later(
+            grace, lambda: asyncio.ensure_future(self._expire(channel_layer, user_id, go_offline))
+        )
+
+    async def _expire(self, channel_layer, user_id, go_offline):
+        self.pending_offline.pop(user_id, None)
+        # Another worker may have accepted a reconnect in the meantime.
+        if not await self._update(channel_layer, user_id, "count"):
+            await go_offline()
+
+    async def _update(self, channel_layer, user_id, op, channel_name=""):
+        if hasattr(channel_layer, "consistent_hash"):
+            key = connections_key(channel_layer, user_id)
+            connection = channel_layer.connection(channel_layer.consistent_hash(key))
+            return int(await connection.eval(
+                REDIS_CONNECTION_COUNT, 2, key, closing_key(key), op, channel_name, time.time(),
+                connection_ttl(), getattr(settings, "CHAT_PRESENCE_GRACE_PERIOD", 5),
+            ))
+        channels = self.channels.setdefault(user_id, set())
+        if op == "open":
+            channels.add(channel_name)
+        elif op == "close":
+            channels.discard(channel_name)
+        if not channels:
+            del self.channels[user_id]
+        return len(channels)
+
+
+_counters = weakref.WeakKeyDictionary()
+
+
+def get_connection_counter():
+    """Process-wide connection counter for the running event loop."""
+    loop = asyncio.get_running_loop()
+    counter = _counters.get(loop)
+    if counter is None:
+        counter = _counters[loop] = ConnectionCounter()
+    return counter
+
+
+_flushers = weakref.WeakKeyDictionary()
+
+
+async def _flush_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        await db_sync_to_async(registry.flush)()
+
+
+def ensure_flusher():
+    """Start the periodic flush task for the running event loop (once)."""
+    loop = asyncio.get_running_loop()
+    task = _flushers.get(loop)
+    if task is None or task.done():
+        interval = getattr(settings, "CHAT_PRESENCE_FLUSH_INTERVAL", 5)
+        _flushers[loop] = loop.create_task(_flush_periodically(interval))
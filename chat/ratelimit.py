@@ -0,0 +1,120 @@
+"""Token-bucket rate limits for WebSocket actions.
+
+Limits are configured per action in ``CHAT_RATE_LIMITS`` as
+``{"connection": (rate, burst), "user": (rate, burst)}`` (tokens per second,
+bucket size); ``"default"`` covers unlisted actions. Connection buckets live
+on the consumer. User buckets are process-wide, or kept in Redis when the
+channel layer is channels_redis so every worker draws from the same bucket.
+Everything here runs before any database work is scheduled.
+"""
+import time
+
+from django.conf import settings
+
+from . import metrics
+
+# KEYS[1] = bucket, ARGV = rate, burst, now. Returns 0 if allowed, else the
+# seconds until the next token (as a string, Lua numbers lose their fraction).
+REDIS_TOKEN_BUCKET = """
+local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(state[1]) or burst
+local ts = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+
+def limits_for(action, scope):
+    limits = getattr(settings, "CHAT_RATE_LIMITS", {})
+    action_limits = limits.get(action, limits.get("default", {}))
+    return action_limits.get(scope)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def take(self, now):
+        """Spend a token; returns 0 if allowed, else seconds until one is free."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class BucketSet:
+    """Buckets keyed by (key, action), created on first use."""
+
+    def __init__(self, prune_every=1000):
+        self.buckets = {}
+        self.prune_every = prune_every
+
+    def take(self, key, action, rate, burst):
+        now = time.monotonic()
+        bucket = self.buckets.get((key, action))
+        if bucket is None:
+            if len(self.buckets) >= self.prune_every:
+                self.prune(now)
+            bucket = self.buckets[(key, action)] = TokenBucket(rate, burst, now)
+        return bucket.take(now)
+
+    def prune(self, now):
+        """Forget buckets that have refilled completely (same as a new one)."""
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items()
+            if (now - bucket.updated) * bucket.rate < bucket.burst - bucket.tokens
+        }
+
+
+user_buckets = BucketSet()
+
+
+class RateLimiter:
+    """Per-connection limiter; user limits are shared as described above."""
+
+    def __init__(self, channel_layer=None):
+        self.connection_buckets = BucketSet()
+        self.channel_layer = channel_layer
+
+    async def check(self, action, user_id=None):
+        """0 if ``action`` may run now, else the seconds to wait."""
+        limit = limits_for(action, "connection")
+        if limit:
+            wait = self.connection_buckets.take(None, action, *limit)
+            if wait:
+                metrics.incr(f"rate_limited.{action}")
+                return wait
+
+        limit = limits_for(action, "user")
+        if limit and user_id:
+            if hasattr(self.channel_layer, "consistent_hash"):
+                wait = await self.take_shared(f"{user_id}:{action}", *limit)
+            else:
+                wait = user_buckets.take(user_id, action, *limit)
+            if wait:
+                metrics.incr(f"rate_limited.{action}")
+                return wait
+        return 0
+
+    async def take_shared(self, key, rate, burst):
+        layer = self.channel_layer
+        key = f"{layer.prefix}:ratelimit:{key}"
+        connection = layer.connection(layer.consistent_hash(key))
+        wait = await connection.eval(REDIS_TOKEN_BUCKET, 1, key, rate, burst, time.time())
+        return float(wait)
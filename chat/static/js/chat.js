@@ -5,12 +5,38 @@ const meId = Number(messagesContainer?.dataset.meId || 0);              // Logge
 // Make otherUserId mutable and initialise from dataset if present
 let otherUserId = Number(messagesContainer?.dataset.receiverId || 0); // Chat partner (may change)
 
-// Create WebSocket connection
-const chatSocket = new WebSocket(
-    (window.location.protocol === 'https:' ? 'wss://' : 'ws://') +
-    window.location.host +
-    '/ws/chat/global_chat/'
-);
+// History paging: the page shows the newest messages, older ones load on scroll
+let currentChatNumber = messagesContainer?.dataset.receiverNumber || '';
+let nextCursor = messagesContainer?.dataset.nextCursor || '';
+let loadingOlder = false;
+
+// Change-feed cursor: highest seq seen; sent as "resume" when the socket opens
+let lastSeq = Number(messagesContainer?.dataset.changeSeq || 0);
+
+// WebSocket connection, replaced by a new one whenever it drops
+let chatSocket = null;
+
+// Reconnect delay: doubles after every failed attempt, with jitter
+const RECONNECT_MIN_MS = 1000;
+const RECONNECT_MAX_MS = 30000;
+let reconnectDelay = RECONNECT_MIN_MS;
+
+function connectSocket() {
+    chatSocket = new WebSocket(
+        (window.location.protocol === 'https:' ? 'wss://' : 'ws://') +
+        window.location.host +
+        '/ws/chat/global_chat/'
+    );
+    chatSocket.onopen = onSocketOpen;
+    chatSocket.onmessage = onSocketMessage;
+    chatSocket.onclose = onSocketClose;
+}
+
+function scheduleReconnect() {
+    const delay = reconnectDelay * (0.5 + Math.random() / 2);
+    reconnectDelay = Math.min(reconnectDelay * 2, RECONNECT_MAX_MS);
+    setTimeout(connectSocket, delay);
+}
 
 // Update ticks for a message by msgId
 function updateTicksForMsg(msgId, newStatus) {
@@ -26,6 +52,100 @@ function updateTicksForMsg(msgId, newStatus) {
         ticksSpan.innerHTML = "<span class='read-ticks'>✓✓</span>";
 }
 
+// ------------------ Idempotent sends ------------------
+// Every send carries a client_msg_id; it is resent until the server echoes it
+// (chat_message) or acknowledges it (message_ack for a duplicate). An error
+// frame naming it stops the retries (or, for rate_limited, delays them).
+const pendingSends = new Map(); // client_msg_id -> { payload, notBefore, backoff }
+const SEND_RETRY_MS = 5000;
+const SEND_RETRY_MAX_MS = 60000;
+
+function newClientMsgId() {
+    if (window.crypto?.randomUUID) return crypto.randomUUID();
+    return `${meId}-${Date.now()}-${Math.random().toString(36).slice(2)}`;
+}
+
+function sendWithRetry(payload) {
+    const pending = { payload, notBefore: 0, backoff: SEND_RETRY_MS };
+    pendingSends.set(payload.client_msg_id, pending);
+    const attempt = () => {
+        if (pendingSends.get(payload.client_msg_id) !== pending) return;
+        const wait = pending.notBefore - Date.now();
+        if (wait > 0) {
+            setTimeout(attempt, wait);
+            return;
+        }
+        if (chatSocket.readyState === WebSocket.OPEN) chatSocket.send(JSON.stringify(payload));
+        setTimeout(attempt, SEND_RETRY_MS);
+    };
+    attempt();
+}
+
+// Server rejected a send: wait on rate_limited, give up on anything else
+function handleSendError(data) {
+    const pending = pendingSends.get(data.client_msg_id);
+    if (!pending) return;
+    if (data.code === 'rate_limited') {
+        const wait = Math.max((data.retry_after || 0) * 1000, pending.backoff);
+        pending.backoff = Math.min(pending.backoff * 2, SEND_RETRY_MAX_MS);
+        pending.notBefore = Date.now() + Math.min(wait, SEND_RETRY_MAX_MS);
+        return;
+    }
+    pendingSends.delete(data.client_msg_id);
+    const bubble = document.querySelector(`[data-client-msg-id='${data.client_msg_id}']`);
+    if (!bubble) return;
+    bubble.classList.add('failed');
+    bubble.title = `Not sent (${data.code})`;
+    const ticksSpan = bubble.querySelector('.ticks');
+    if (ticksSpan) ticksSpan.innerHTML = "<i class='fas fa-exclamation-circle'></i>";
+}
+
+// Swap the optimistic bubble's temp id for the server's msg_id; true if found
+function confirmSend(clientMsgId, msgId) {
+    if (!clientMsgId) return false;
+    pendingSends.delete(clientMsgId);
+    const bubble = document.querySelector(`[data-client-msg-id='${clientMsgId}']`);
+    if (!bubble) return false;
+    bubble.setAttribute('data-msg-id', msgId);
+    return true;
+}
+
+// Delivered/read receipts arrive as a watermark: every message we sent to
+// userId with an id up to upTo has reached that state
+function applyStatusWatermark(userId, upTo, newStatus) {
+    if (!upTo || Number(userId) !== otherUserId) return;
+    document.querySelectorAll('.message-bubble.sent[data-msg-id]').forEach((elem) => {
+        if (!(Number(elem.dataset.msgId) <= upTo)) return; // also skips unconfirmed temp ids
+        if (newStatus === 'delivered' && elem.querySelector('.read-ticks')) return; // never downgrade
+        updateTicksForMsg(elem.dataset.msgId, newStatus);
+    });
+}
+
+// Escape user text before it goes into innerHTML
+function escapeHtml(text) {
+    const div = document.createElement('div');
+    div.textContent = text;
+    return div.innerHTML;
+}
+
+// Bubble body for a text or attachment message (text is escaped)
+function messageBodyHtml(text, attachmentUrl, attachmentType) {
+    if (!attachmentUrl) return escapeHtml(text || "");
+
+    const url = escapeHtml(attachmentUrl).replace(/"/g, '&quot;');
+    const type = attachmentType || "";
+    // 🖼️ Image
+    if (type.startsWith("image") || attachmentUrl.match(/\.(jpg|jpeg|png|gif|webp)$/i)) {
+        return `<img src="${url}" class="chat-image" alt="image">`;
+    }
+    // 🎥 Video
+    if (type.startsWith("video") || attachmentUrl.match(/\.(mp4|webm|ogg)$/i)) {
+        return `<video controls class="chat-video"><source src="${url}" type="video/mp4"></video>`;
+    }
+    // 📄 Document or other file types
+    return `<a href="${url}" target="_blank" rel="noopener noreferrer">📄 Download File</a>`;
+}
+
 // Create message div element (incoming or outgoing)
 function createMessageDiv(msgText, isSender, timestampText, status, msgId) {
     const msgDiv = document.createElement('div');
@@ -59,6 +179,7 @@ function createMessageDiv(msgText, isSender, timestampText, status, msgId) {
 function updatePresenceUI(userId, isOnline, lastSeen) {
     // only update if this presence is for currently-open chat partner
     if (Number(userId) !== Number(otherUserId)) return;
+    hideTyping();
 
     const dot = document.getElementById('presence-dot');
     const text = document.getElementById('presence-text');
@@ -90,52 +211,123 @@ function markReadNow() {
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
         chatSocket.send(JSON.stringify({
             action: 'mark_read',
-            reader_id: meId,
             other_user_id: otherUserId,
         }));
     }
 }
 
+// Typing indicator of the open chat partner; expires on its own unless refreshed
+let typingTimer = null;
+let presenceTextBeforeTyping = null;
+
+function showTyping(userId, isTyping, expiresIn) {
+    if (Number(userId) !== Number(otherUserId)) return;
+    const text = document.getElementById('presence-text');
+    if (!text) return;
+    clearTimeout(typingTimer);
+    if (!isTyping) {
+        hideTyping();
+        return;
+    }
+    if (presenceTextBeforeTyping === null) presenceTextBeforeTyping = text.textContent;
+    text.textContent = 'typing…';
+    typingTimer = setTimeout(hideTyping, (expiresIn || 5) * 1000);
+}
+
+function hideTyping() {
+    clearTimeout(typingTimer);
+    typingTimer = null;
+    const text = document.getElementById('presence-text');
+    if (text && presenceTextBeforeTyping !== null) text.textContent = presenceTextBeforeTyping;
+    presenceTextBeforeTyping = null;
+}
+
+// Tell the open chat partner we are typing (the server throttles too)
+let lastTypingSent = 0;
+
+function sendTyping() {
+    if (!otherUserId || !chatSocket || chatSocket.readyState !== WebSocket.OPEN) return;
+    const now = Date.now();
+    if (now - lastTypingSent < 2000) return;
+    lastTypingSent = now;
+    chatSocket.send(JSON.stringify({ action: 'typing', receiver_id: otherUserId }));
+}
+
+// Online dot on a chat-list entry
+function markChatItemPresence(userId, isOnline) {
+    const item = document.querySelector(`.chat-item[data-userid="${Number(userId)}"]`);
+    if (item) item.classList.toggle('online', Boolean(isOnline));
+}
+
+// Presence subscriptions: only follow users shown in the chat list / open chat
+const presenceSubscriptions = new Set();
+
+function syncPresenceSubscriptions(userIds) {
+    const wanted = new Set(userIds.map(Number).filter(Boolean));
+    const add = [...wanted].filter((id) => !presenceSubscriptions.has(id));
+    const remove = [...presenceSubscriptions].filter((id) => !wanted.has(id));
+    if (!add.length && !remove.length) return;
+    if (chatSocket.readyState !== WebSocket.OPEN) return;
+
+    chatSocket.send(JSON.stringify({ action: 'subscribe_presence', add, remove }));
+    add.forEach((id) => presenceSubscriptions.add(id));
+    remove.forEach((id) => presenceSubscriptions.delete(id));
+}
+
+function chatListUserIds() {
+    const ids = [...document.querySelectorAll('.chat-item')].map((item) => item.dataset.userid);
+    if (otherUserId) ids.push(otherUserId);
+    return ids;
+}
+
 // ------------------ WebSocket Handlers ------------------
 
-chatSocket.onopen = function () {
+// Heartbeat
+setInterval(() => {
+    if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
+        chatSocket.send(JSON.stringify({ action: 'heartbeat' }));
+    }
+}, 20000); // every 20 seconds
+
+function onSocketOpen() {
     console.log('WebSocket connected');
+    reconnectDelay = RECONNECT_MIN_MS;
 
-    // Heartbeat
-    setInterval(() => {
-        if (chatSocket.readyState === WebSocket.OPEN) {
-            chatSocket.send(JSON.stringify({
-                action: 'heartbeat',
-                user_id: meId
-            }));
-        }
-    }, 20000); // every 20 seconds
+    // The server already knows us from the session cookie: the connection is
+    // online and pending messages were marked delivered during the handshake.
 
-    // Identify current user to backend (so presence = online)
+    // Replay anything that changed since the page was rendered (or since the
+    // last frame seen before the connection dropped)
     chatSocket.send(JSON.stringify({
-        action: 'identify_user',
-        user_id: meId
+        action: 'resume',
+        since: lastSeq,
     }));
 
-    // Inform server this client is connected (so pending -> delivered)
-    chatSocket.send(JSON.stringify({
-        action: 'receiver_connected',
-        receiver_id: meId,
-    }));
+    // Follow presence of the chat list + open conversation only, and fetch
+    // the current state of all of them in one round trip (a new connection
+    // starts without subscriptions)
+    presenceSubscriptions.clear();
+    const listIds = [...new Set(chatListUserIds().map(Number).filter(Boolean))];
+    syncPresenceSubscriptions(listIds);
+    if (listIds.length) {
+        chatSocket.send(JSON.stringify({ action: 'get_presence_bulk', user_ids: listIds }));
+    }
 
     // Mark messages read for open chat
     markReadNow();
-};
+}
 
-chatSocket.onmessage = function (e) {
+function onSocketMessage(e) {
     const data = JSON.parse(e.data);
     const eventType = data.event;
+    if (data.seq) lastSeq = Math.max(lastSeq, data.seq);
 
     if (eventType === 'chat_message') {
         const message = data.message;
         const sender_id = Number(data.sender_id);
         const receiver_id = Number(data.receiver_id);
         const isSender = sender_id === meId;
+        if (!isSender) hideTyping();
         const status = data.status;
         const msgId = data.msg_id;
      
@@ -146,34 +338,17 @@ chatSocket.onmessage = function (e) {
             })
         : "Just now";
 
-        // Only show if message is for the open chat
+        // Our own optimistic bubble: just attach the real id
+        const confirmed = isSender && confirmSend(data.client_msg_id, msgId);
+
+        // Only show if message is for the open chat (and not already shown, e.g. replayed on resume)
         if (
-        (isSender && receiver_id === otherUserId) ||
-        (!isSender && sender_id === otherUserId)
+        !confirmed &&
+        ((isSender && receiver_id === otherUserId) ||
+        (!isSender && sender_id === otherUserId)) &&
+        !document.querySelector(`[data-msg-id='${msgId}']`)
         ) {
-        let html = "";
-
-        // 📎 Attachment Handling
-        if (data.attachment_url) {
-            const url = data.attachment_url;
-            const type = data.attachment_type || "";
-
-            // 🖼️ Image
-            if (type.startsWith("image") || url.match(/\.(jpg|jpeg|png|gif|webp)$/i)) {
-            html = `<img src="${url}" class="chat-image" alt="image">`;
-
-            // 🎥 Video
-            } else if (type.startsWith("video") || url.match(/\.(mp4|webm|ogg)$/i)) {
-            html = `<video controls class="chat-video"><source src="${url}" type="video/mp4"></video>`;
-
-            // 📄 Document or other file types
-            } else {
-            html = `<a href="${url}" target="_blank" rel="noopener noreferrer">📄 Download File</a>`;
-            }
-        } else {
-            // 💬 Regular Text Message
-            html = escapeHtml(data.message || "");
-        }
+        const html = messageBodyHtml(data.message, data.attachment_url, data.attachment_type);
 
         // Create the message bubble
         const msgDiv = createMessageDiv(html, isSender, ts, status, msgId);
@@ -188,22 +363,41 @@ chatSocket.onmessage = function (e) {
         chatSocket.send(
             JSON.stringify({
             action: "receiver_connected",
-            receiver_id: meId,
             })
         );
      }
   } else if (eventType === 'status_update') {
-        const ids = data.msg_ids || [];
-        const newStatus = data.new_status;
-        ids.forEach((id) => updateTicksForMsg(id, newStatus));
+        applyStatusWatermark(data.user_id, data.up_to, data.new_status);
     } else if (eventType === 'presence_update') {
+        markChatItemPresence(data.user_id, data.is_online);
         updatePresenceUI(data.user_id, data.is_online, data.last_seen);
+    } else if (eventType === 'presence_bulk' || eventType === 'presence_digest') {
+        // users: [[user_id, is_online, last_seen], ...]
+        data.users.forEach(([userId, isOnline, lastSeen]) => {
+            markChatItemPresence(userId, isOnline);
+            updatePresenceUI(userId, isOnline, lastSeen);
+        });
+    } else if (eventType === 'typing') {
+        showTyping(data.user_id, data.typing, data.expires_in);
+    } else if (eventType === 'message_ack') {
+        confirmSend(data.client_msg_id, data.msg_id);
+    } else if (eventType === 'error') {
+        if (data.client_msg_id) handleSendError(data);
+        else console.warn('Chat socket error:', data.code, data.action, data.field);
+    } else if (eventType === 'resync') {
+        // Missed too much (or too long ago) to replay: reload everything.
+        window.location.reload();
     }
-};
+}
 
-chatSocket.onclose = function () {
-    console.error('Chat socket closed unexpectedly');
-};
+function onSocketClose(e) {
+    // Dropped, or closed by the server for falling behind (4008): reconnect;
+    // the "resume" sent on open replays what was missed (or asks for a reload).
+    console.error(`Chat socket closed (${e.code}), reconnecting`);
+    scheduleReconnect();
+}
+
+connectSocket();
 
 // ------------------ Event Listeners ------------------
 
@@ -257,9 +451,40 @@ document.querySelectorAll('.chat-item').forEach(item => {
     });
 });
 
+// Prepend the page of messages before nextCursor, keeping the scroll position
+function loadOlderMessages() {
+    if (!nextCursor || !currentChatNumber || loadingOlder) return;
+    loadingOlder = true;
+    const msgContainer = document.getElementById('chat-messages');
+    const chatNumber = currentChatNumber;
+
+    fetch(`/api/chat/${chatNumber}/messages/?before=${nextCursor}`)
+        .then(res => res.json())
+        .then(data => {
+            if (chatNumber !== currentChatNumber) return; // chat switched meanwhile
+            const previousHeight = msgContainer.scrollHeight;
+            const fragment = document.createDocumentFragment();
+            data.messages.forEach(msg => {
+                fragment.appendChild(createMessageDiv(messageBodyHtml(msg.content, msg.attachment_url, msg.attachment_type), msg.is_sender, msg.timestamp, msg.status || (msg.is_sender ? 'sent' : ''), msg.id));
+            });
+            msgContainer.insertBefore(fragment, msgContainer.firstChild);
+            msgContainer.scrollTop += msgContainer.scrollHeight - previousHeight;
+            nextCursor = data.next_cursor || '';
+        })
+        .catch(err => console.error('Failed to load older messages:', err))
+        .finally(() => { loadingOlder = false; });
+}
+
+messagesContainer?.addEventListener('scroll', () => {
+    if (messagesContainer.scrollTop < 100) loadOlderMessages();
+});
+
 function loadChat(number, name, userId) {
     otherUserId = Number(userId); // store globally
+    currentChatNumber = number;
+    nextCursor = '';
     document.querySelector('.chat-contact-name').textContent = name;
+    hideTyping();
     document.getElementById('presence-text').textContent = 'Checking...';
     document.getElementById('presence-dot').style.background = '#bdc3c7';
 
@@ -270,21 +495,24 @@ function loadChat(number, name, userId) {
             // Use the same container used elsewhere
             const msgContainer = document.getElementById('chat-messages');
             msgContainer.innerHTML = '';
+            nextCursor = data.next_cursor || '';
 
             data.messages.forEach(msg => {
                 // reuse createMessageDiv so structure & ticks are consistent
-                const div = createMessageDiv(msg.content, msg.is_sender, msg.timestamp, msg.status || (msg.is_sender ? 'sent' : ''), msg.id);
+                const div = createMessageDiv(messageBodyHtml(msg.content, msg.attachment_url, msg.attachment_type), msg.is_sender, msg.timestamp, msg.status || (msg.is_sender ? 'sent' : ''), msg.id);
                 msgContainer.appendChild(div);
             });
 
             msgContainer.scrollTop = msgContainer.scrollHeight;
 
-            // Ask backend for presence info (after messages load)
+            // Ask backend for presence info (after messages load); the server
+            // also subscribes us to that user's presence changes.
             if (chatSocket && chatSocket.readyState === WebSocket.OPEN && otherUserId) {
                 chatSocket.send(JSON.stringify({
                     action: 'get_presence',
                     target_user_id: otherUserId
                 }));
+                presenceSubscriptions.add(otherUserId);
             }
 
             // mark as read after loading messages
@@ -595,6 +823,8 @@ navItems.forEach((item) => {
 
 // ------------------ Form Submission ------------------
 
+document.getElementById('chat-message-input').addEventListener('input', sendTyping);
+
 document.getElementById('chat-form').onsubmit = function (e) {
     e.preventDefault();
     const inputField = document.getElementById('chat-message-input');
@@ -607,25 +837,26 @@ document.getElementById('chat-form').onsubmit = function (e) {
         return;
     }
 
-    // 🕒 Prepare timestamp and temp ID
+    // 🕒 Prepare timestamp and client message id (also the bubble's temp id)
     const ts = new Date().toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
-    const tempId = 'temp-' + Date.now();
+    const clientMsgId = newClientMsgId();
 
     // ✅ Instantly show the message in UI
     if (typeof createMessageDiv === 'function' && typeof messagesContainer !== 'undefined') {
-        const msgDiv = createMessageDiv(message, true, ts, 'sent', tempId);
+        const msgDiv = createMessageDiv(escapeHtml(message), true, ts, 'sent', clientMsgId);
+        msgDiv.dataset.clientMsgId = clientMsgId;
         messagesContainer.appendChild(msgDiv);
         messagesContainer.scrollTop = messagesContainer.scrollHeight;
     }
 
     // 🟢 Send message via WebSocket
     if (chatSocket && chatSocket.readyState === WebSocket.OPEN) {
-        chatSocket.send(JSON.stringify({
+        sendWithRetry({
             action: 'send_message',
             message: message,
-            sender_id: meId,
             receiver_id: otherUserId,
-        }));
+            client_msg_id: clientMsgId,
+        });
     } else {
         console.error('❌ WebSocket not connected.');
         alert('Connection lost. Try reloading the page.');
@@ -635,6 +866,75 @@ document.getElementById('chat-form').onsubmit = function (e) {
     inputField.value = '';
 };
 
+// ------------------ Attachment Uploads ------------------
+
+async function sha256Hex(file) {
+    const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+    return [...new Uint8Array(digest)].map((b) => b.toString(16).padStart(2, '0')).join('');
+}
+
+// fetch with retries on network errors and 5xx responses
+async function uploadRequest(url, options, attempts = 5) {
+    for (let attempt = 1; ; attempt++) {
+        try {
+            const response = await fetch(url, {
+                ...options,
+                headers: { 'X-CSRFToken': csrfToken, ...(options.headers || {}) },
+            });
+            if (response.status < 500 || attempt >= attempts) return response;
+        } catch (err) {
+            if (attempt >= attempts) throw err;
+        }
+        await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+    }
+}
+
+// init -> PUT chunks at offsets -> complete; a retried chunk is harmless and
+// a 409 tells us where the server wants to continue
+async function uploadInChunks(file, fileType) {
+    const start = await uploadRequest('/api/uploads/', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({
+            receiver_id: otherUserId,
+            file_name: file.name,
+            file_type: fileType,
+            size: file.size,
+            sha256: await sha256Hex(file),
+        }),
+    });
+    if (!start.ok) throw new Error('Upload could not start');
+    const session = await start.json();
+    const url = `/api/uploads/${session.upload_id}/`;
+
+    let offset = session.offset;
+    while (offset < file.size) {
+        const chunk = file.slice(offset, offset + session.chunk_size);
+        const response = await uploadRequest(`${url}?offset=${offset}`, { method: 'PUT', body: chunk });
+        const state = await response.json();
+        if (!response.ok && state.offset === undefined) throw new Error(state.error || 'Chunk failed');
+        offset = state.offset;
+    }
+
+    const done = await uploadRequest(`${url}complete/`, { method: 'POST' });
+    if (!done.ok) throw new Error('Upload failed');
+    return done.json();
+}
+
+async function uploadWhole(file, fileType) {
+    const formData = new FormData();
+    formData.append('receiver_id', otherUserId);
+    formData.append('file', file);
+    formData.append('file_type', fileType);
+    const response = await fetch('/chat/upload_attachment/', {
+        method: 'POST',
+        headers: { 'X-CSRFToken': csrfToken },
+        body: formData,
+    });
+    if (!response.ok) throw new Error('Upload failed');
+    return response.json();
+}
+
 // ------------------ Popup & Attachment Logic ------------------
 
 const emojiPopup = document.getElementById('emojiPopup');
@@ -746,25 +1046,12 @@ document.addEventListener('DOMContentLoaded', () => {
         // Show local preview instantly
         renderAttachmentBubble(localUrl, fileType, true);
 
-        // Prepare form data for upload
-        const formData = new FormData();
-        formData.append('sender_id', meId);
-        formData.append('receiver_id', otherUserId);
-        formData.append('file', file);
-        formData.append('file_type', fileType);
-
         try {
-            const response = await fetch('/chat/upload_attachment/', {
-                method: 'POST',
-                headers: {
-                    'X-CSRFToken': csrfToken,
-                },
-                body: formData,
-            });
-
-            if (!response.ok) throw new Error('Upload failed');
-
-            const data = await response.json();
+            // Resumable chunked upload; one multipart request where WebCrypto
+            // (needed for the checksum) is unavailable, e.g. plain http.
+            const data = window.crypto && crypto.subtle
+                ? await uploadInChunks(file, fileType)
+                : await uploadWhole(file, fileType);
             console.log('Uploaded successfully:', data);
 
             // Update preview with final server URL if available
@@ -1,3 +1,1234 @@
-from django.test import TestCase
+import asyncio
+import hashlib
+import os
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import skipUnless
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.routing import URLRouter
+from channels.sessions import SessionMiddlewareStack
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.contrib.auth.models import User
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import re_path
+from django.utils import timezone
+
+try:
+    import fakeredis
+    from fakeredis.aioredis import FakeConnection
+    from channels_redis.core import RedisChannelLayer
+except ImportError:
+    fakeredis = None
+
+from .models import ChangeEvent, ChatUser, ChatMessage, Conversation, UploadSession, conversation_key
+from .routing import websocket_urlpatterns
+from . import actions, changefeed, frames, uploads
+from .clientids import recent_client_ids
+from .lifespan import lifespan
+from .hotcache import HotMessageCache, hot_messages
+from .views import HISTORY_FIELDS, get_message_page
+from .dbexec import db_sync_to_async
+from .consumers import ChatConsumer, typing_throttle
+from .conversations import (
+    mark_conversation_read, mark_conversations_delivered, message_statuses, record_deletion, record_message,
+)
+from . import metrics
+from .outbound import OutboundQueue
+from .presence import ConnectionCounter, PresenceRegistry, registry as presence_registry
+from .ratelimit import BucketSet, RateLimiter
+from .usercache import UserIdCache, user_cache
+from .writer import MessageWriter, get_message_writer
 
 # Create your tests here.
+
+application = SessionMiddlewareStack(URLRouter(websocket_urlpatterns))
+
+
+def fake_redis_hosts(shards=2):
+    """channels_redis host configs backed by in-process fakeredis servers."""
+    return [
+        {"connection_class": FakeConnection, "server": fakeredis.FakeServer()}
+        for _ in range(shards)
+    ]
+
+
+async def connect(user, subprotocols=None):
+    """A socket logged in as ``user`` through a session cookie."""
+    session = SessionStore()
+    session["chat_user_id"] = user.id
+    await database_sync_to_async(session.create)()
+    communicator = WebsocketCommunicator(
+        application,
+        "/ws/chat/global_chat/",
+        headers=[(b"cookie", f"{settings.SESSION_COOKIE_NAME}={session.session_key}".encode())],
+        subprotocols=subprotocols,
+    )
+    connected, _ = await communicator.connect()
+    assert connected
+    return communicator
+
+
+async def drain(communicator):
+    """Throw away every frame currently queued for a communicator."""
+    while not await communicator.receive_nothing(timeout=0.1):
+        await communicator.receive_json_from()
+
+
+class ChatRoutingTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+
+    async def connect_as(self, user):
+        return await connect(user)
+
+    async def test_events_reach_only_participants(self):
+        alice = await self.connect_as(self.alice)
+        bob = await self.connect_as(self.bob)
+        carol = await self.connect_as(self.carol)
+        for communicator in (alice, bob, carol):
+            await drain(communicator)
+
+        await alice.send_json_to({
+            "action": "send_message",
+            "message": "hi bob",
+            "receiver_id": self.bob.id,
+        })
+        for communicator in (alice, bob):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event["event"], "chat_message")
+            self.assertEqual(event["message"], "hi bob")
+        msg_id = event["msg_id"]
+
+        await bob.send_json_to({
+            "action": "mark_read",
+            "other_user_id": self.alice.id,
+        })
+        event = await alice.receive_json_from()
+        self.assertEqual(event["event"], "status_update")
+        self.assertEqual((event["user_id"], event["up_to"]), (self.bob.id, msg_id))
+
+        await alice.send_json_to({"action": "delete_message", "msg_id": msg_id, "for_everyone": True})
+        for communicator in (alice, bob):
+            event = await communicator.receive_json_from()
+            self.assertEqual(event["event"], "delete_message")
+
+        self.assertTrue(await carol.receive_nothing(timeout=0.2))
+        for communicator in (alice, bob, carol):
+            await communicator.disconnect()
+
+    async def test_identity_comes_from_the_session(self):
+        anonymous = WebsocketCommunicator(application, "/ws/chat/global_chat/")
+        connected, _ = await anonymous.connect()
+        self.assertFalse(connected)
+
+        alice = await self.connect_as(self.alice)
+        await alice.send_json_to({
+            "action": "send_message",
+            "message": "spoofed?",
+            "sender_id": self.bob.id,
+            "receiver_id": self.carol.id,
+        })
+        event = await alice.receive_json_from()
+        self.assertEqual((event["event"], event["sender_id"]), ("chat_message", self.alice.id))
+
+        # Connecting is enough to deliver what was pending.
+        carol = await self.connect_as(self.carol)
+        event = await alice.receive_json_from()
+        self.assertEqual((event["event"], event["user_id"], event["new_status"]), ("status_update", self.carol.id, "delivered"))
+
+        # Only the sender may delete for everyone.
+        await carol.send_json_to({"action": "delete_message", "msg_id": event["up_to"], "for_everyone": True})
+        event = await alice.receive_json_from()
+        self.assertEqual((event["event"], event["for_everyone"]), ("delete_message", False))
+        for communicator in (alice, carol):
+            await communicator.disconnect()
+
+    async def test_retried_send_is_deduplicated(self):
+        recent_client_ids.ids.clear()  # test databases reuse ids across test cases
+        alice = await self.connect_as(self.alice)
+        bob = await self.connect_as(self.bob)
+        for communicator in (alice, bob):
+            await drain(communicator)
+
+        send = {
+            "action": "send_message",
+            "message": "once",
+            "receiver_id": self.bob.id,
+            "client_msg_id": "c-1",
+        }
+        await alice.send_json_to(send)
+        for communicator in (alice, bob):
+            event = await communicator.receive_json_from()
+            self.assertEqual((event["event"], event["client_msg_id"]), ("chat_message", "c-1"))
+        msg_id = event["msg_id"]
+
+        # Answered from the recent-id cache, then (cache lost) from the unique constraint.
+        for forget in (False, True):
+            if forget:
+                recent_client_ids.ids.clear()
+            await alice.send_json_to(send)
+            ack = await alice.receive_json_from()
+            self.assertEqual((ack["event"], ack["msg_id"], ack["duplicate"]), ("message_ack", msg_id, True))
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        count = await database_sync_to_async(ChatMessage.objects.filter(client_msg_id="c-1").count)()
+        self.assertEqual(count, 1)
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    async def test_presence_reaches_only_subscribers(self):
+        bob = await self.connect_as(self.bob)
+        carol = await self.connect_as(self.carol)
+        await bob.send_json_to({"action": "subscribe_presence", "add": [self.alice.id]})
+        await drain(bob)
+
+        alice = await self.connect_as(self.alice)
+        event = await bob.receive_json_from()
+        self.assertEqual(event["event"], "presence_digest")
+        [(user_id, is_online, _)] = event["users"]
+        self.assertEqual((user_id, is_online), (self.alice.id, True))
+        self.assertTrue(await carol.receive_nothing(timeout=0.2))
+
+        await bob.send_json_to({"action": "subscribe_presence", "remove": [self.alice.id]})
+        await alice.disconnect()
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        for communicator in (bob, carol):
+            await communicator.disconnect()
+
+
+@override_settings(CHAT_WRITE_BEHIND=True)
+class WriteBehindRoutingTests(ChatRoutingTests):
+    """Same routing guarantees when messages go through the batch writer."""
+
+
+class HotPathQueryTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    def test_send_message_is_one_query(self):
+        async def send_one():
+            alice = await connect(self.alice)
+            await drain(alice)
+            # Queries run on the main thread's connection, so read the log there.
+            captured = database_sync_to_async(lambda: list(queries.captured_queries))
+            start = len(await captured())
+            await alice.send_json_to({
+                "action": "send_message",
+                "message": "counted",
+                "receiver_id": self.bob.id,
+            })
+            event = await alice.receive_json_from()
+            await alice.disconnect()
+            return event, (await captured())[start:]
+
+        Conversation.objects.create(user_low=self.alice, user_high=self.bob)
+        with CaptureQueriesContext(connection) as queries:
+            event, sent = async_to_sync(send_one)()
+        self.assertEqual(event["message"], "counted")
+        # The message INSERT, the chat-list summary UPDATE and the change-feed
+        # INSERT; no lookups (the sender was resolved once, at connect).
+        statements = [
+            q["sql"].split(" ", 3)[:3] for q in sent
+            if "SAVEPOINT" not in q["sql"]
+        ]
+        self.assertEqual(statements, [
+            ["INSERT", "INTO", '"chat_chatmessage"'],
+            ["UPDATE", '"chat_conversation"', "SET"],
+            ["INSERT", "INTO", '"chat_changeevent"'],
+        ])
+        self.assertEqual(event["seq"], ChangeEvent.objects.get().id)
+
+    def test_cache_tracks_user_creation_and_deletion(self):
+        carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+        self.assertTrue(user_cache.contains(carol.id))
+        carol_id = carol.id
+        carol.delete()
+        self.assertFalse(user_cache.contains(carol_id))
+        with self.assertNumQueries(1):
+            self.assertFalse(user_cache.exists(carol_id))
+
+    def test_lru_is_bounded(self):
+        cache = UserIdCache(max_size=1)
+        with self.assertNumQueries(1):
+            self.assertTrue(cache.exists(self.alice.id, self.bob.id))
+        self.assertEqual(len(cache.ids), 1)
+        self.assertFalse(cache.exists("not-an-id"))
+
+
+class DbExecutorTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+
+    async def test_async_lookups_need_no_thread_hop_wrapper(self):
+        cache = UserIdCache()
+        self.assertFalse(await cache.aload([self.alice.id, self.alice.id + 1]))
+        self.assertTrue(cache.contains(self.alice.id))
+        registry = PresenceRegistry()
+        self.assertEqual(await registry.aload(self.alice.id), (False, None))
+
+    async def test_executor_size_is_configurable(self):
+        thread_name = db_sync_to_async(lambda: threading.current_thread().name)
+        self.assertFalse((await thread_name()).startswith("chat-db"))
+        with override_settings(CHAT_DB_EXECUTOR_WORKERS=2):
+            self.assertTrue((await thread_name()).startswith("chat-db"))
+
+
+class ConversationSummaryTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+
+    def send(self, sender, receiver, text):
+        msg = ChatMessage.objects.create(sender=sender, receiver=receiver, content=text)
+        record_message(msg)
+        return msg
+
+    def test_writes_keep_summary_current(self):
+        self.send(self.bob, self.alice, "one")
+        last = self.send(self.bob, self.alice, "two")
+        conversation = Conversation.objects.get()
+        self.assertEqual((conversation.user_low, conversation.user_high), (self.alice, self.bob))
+        self.assertEqual(conversation.last_message_id, last.id)
+        self.assertEqual(conversation.last_message_preview, "two")
+        self.assertEqual(conversation.unread_for(self.alice.id), 2)
+        self.assertEqual(conversation.unread_for(self.bob.id), 0)
+
+        mark_conversation_read(self.alice.id, self.bob.id)
+        last.content = "[This message was deleted]"
+        last.save()
+        record_deletion(last)
+        conversation.refresh_from_db()
+        self.assertEqual(conversation.unread_for(self.alice.id), 0)
+        self.assertEqual(conversation.last_message_preview, "[This message was deleted]")
+
+    def test_receipts_are_watermarks(self):
+        first = self.send(self.bob, self.alice, "one")
+        last = self.send(self.bob, self.alice, "two")
+        self.send(self.carol, self.alice, "hi")
+        self.assertEqual(mark_conversations_delivered(self.alice.id)[self.bob.id], last.id)
+        self.assertEqual(mark_conversations_delivered(self.alice.id), {})
+
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(mark_conversation_read(self.alice.id, self.bob.id), last.id)
+        self.assertEqual(len(queries.captured_queries), 2)
+        self.assertIsNone(mark_conversation_read(self.alice.id, self.bob.id))
+        self.assertEqual(ChatMessage.objects.filter(status="sent").count(), 3)  # rows untouched
+
+        newer = self.send(self.bob, self.alice, "three")
+        rows = [{"id": m.id, "sender_id": self.bob.id} for m in (first, last, newer)]
+        statuses = [row["status"] for row in message_statuses(self.alice.id, self.bob.id, rows)]
+        self.assertEqual(statuses, ["read", "read", "sent"])
+
+    def test_chat_list_cost_does_not_grow_with_history(self):
+        session = self.client.session
+        session["chat_user_id"] = self.alice.id
+        session.save()
+
+        def list_queries():
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get("/chat/")
+            self.assertEqual(response.status_code, 200)
+            return len(queries.captured_queries), response
+
+        self.send(self.bob, self.alice, "hello")
+        baseline, _ = list_queries()
+        for i in range(20):
+            self.send(self.carol, self.alice, f"msg {i}")
+        count, response = list_queries()
+        self.assertEqual(count, baseline)
+        chats = response.context["chat_list_data"]
+        self.assertEqual([c["user"] for c in chats], [self.carol, self.bob])
+        self.assertEqual(chats[0]["unread_count"], 20)
+
+
+@override_settings(CHAT_HISTORY_PAGE_SIZE=2)
+class HistoryPaginationTests(TestCase):
+    def setUp(self):
+        hot_messages.clear()
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+        self.ids = [
+            ChatMessage.objects.create(sender=sender, receiver=receiver, content=str(i)).id
+            for i, (sender, receiver) in enumerate([(self.alice, self.bob), (self.bob, self.alice)] * 3)
+        ]
+        ChatMessage.objects.create(sender=self.carol, receiver=self.alice, content="other chat")
+        session = self.client.session
+        session["chat_user_id"] = self.alice.id
+        session.save()
+
+    def page(self, **params):
+        response = self.client.get(f"/api/chat/{self.bob.number}/messages/", params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [m["id"] for m in data["messages"]], data["next_cursor"]
+
+    def test_pages_walk_back_through_history(self):
+        self.assertEqual(self.page(), (self.ids[4:], self.ids[4]))
+        self.assertEqual(self.page(before=self.ids[4]), (self.ids[2:4], self.ids[2]))
+        self.assertEqual(self.page(before=self.ids[2]), (self.ids[:2], None))
+        self.assertEqual(self.page(after=self.ids[0], limit=3), (self.ids[1:4], self.ids[3]))
+        self.assertEqual(self.page(after=self.ids[3], limit=3), (self.ids[4:], None))
+
+    def test_history_query_uses_conversation_index(self):
+        key = conversation_key(self.bob.id, self.alice.id)
+        self.assertEqual(key, f"{self.alice.id}_{self.bob.id}")
+        self.assertEqual(ChatMessage.objects.filter(conversation_key=key).count(), 6)
+
+        history = ChatMessage.objects.filter(conversation_key=key, id__lt=self.ids[4]).order_by("-id")
+        self.assertIn("chatmessage_conversation", history.explain())
+
+    def test_chat_page_renders_only_newest_page(self):
+        response = self.client.get(f"/chat/{self.bob.number}/")
+        self.assertEqual([m["id"] for m in response.context["messages"]], self.ids[4:])
+        self.assertContains(response, f'data-next-cursor="{self.ids[4]}"')
+
+
+class HotMessageCacheTests(TestCase):
+    def setUp(self):
+        hot_messages.clear()
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        for text in ("one", "two"):
+            self.send(self.bob, self.alice, text)
+
+    def send(self, sender, receiver, text):
+        with self.captureOnCommitCallbacks(execute=True):
+            msg = ChatMessage.objects.create(sender=sender, receiver=receiver, content=text)
+            record_message(msg)
+        return msg
+
+    def newest(self):
+        rows, _ = get_message_page(self.alice.id, self.bob.id)
+        return [(row["content"], row["status"]) for row in rows]
+
+    def test_newest_page_is_served_from_memory(self):
+        hits, misses = metrics.counters["hot_cache.hits"], metrics.counters["hot_cache.misses"]
+        self.assertEqual(self.newest(), [("one", "sent"), ("two", "sent")])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.newest(), [("one", "sent"), ("two", "sent")])
+        self.assertEqual(metrics.counters["hot_cache.misses"] - misses, 1)
+        self.assertEqual(metrics.counters["hot_cache.hits"] - hits, 1)
+
+        self.send(self.alice, self.bob, "three")  # write extends the cached page
+        with self.captureOnCommitCallbacks(execute=True):
+            mark_conversation_read(self.alice.id, self.bob.id)
+        with self.assertNumQueries(1):  # only the watermarks are reloaded
+            self.assertEqual(self.newest(), [("one", "read"), ("two", "read"), ("three", "sent")])
+
+        msg = ChatMessage.objects.get(content="two")
+        msg.content = "[This message was deleted]"
+        msg.save()
+        with self.captureOnCommitCallbacks(execute=True):
+            record_deletion(msg)
+        self.assertEqual(self.newest()[1][0], "[This message was deleted]")
+
+    def test_bounded_by_rows_and_bytes(self):
+        cache = HotMessageCache(max_messages=2, max_bytes=1000)
+        rows = [{"id": i, "content": "x", "sender_id": 1, "attachment": None} for i in range(1, 4)]
+        cache.fill("1_2", rows, False, None, cache.version("1_2"))
+        page, next_cursor, _ = cache.newest_page("1_2", 2)
+        self.assertEqual(([row["id"] for row in page], next_cursor), ([2, 3], 2))
+        self.assertIsNone(cache.newest_page("1_2", 3))  # older rows were not kept
+
+        cache.fill("1_3", [{"id": 9, "content": "y" * 700, "sender_id": 1, "attachment": None}], False, None, cache.version("1_3"))
+        self.assertEqual(list(cache.entries), ["1_3"])
+        self.assertLessEqual(cache.bytes, 1000)
+
+    def test_fill_after_a_concurrent_write_is_dropped(self):
+        key = conversation_key(self.alice.id, self.bob.id)
+        version = hot_messages.version(key)
+        rows = list(ChatMessage.objects.filter(conversation_key=key).order_by("id").values(*HISTORY_FIELDS))
+        self.send(self.alice, self.bob, "three")  # commits between the read and the fill
+        hot_messages.fill(key, rows, False, None, version)
+        self.assertIsNone(hot_messages.newest_page(key, 50))
+        self.assertEqual([content for content, _ in self.newest()], ["one", "two", "three"])
+
+
+class TypingTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+        typing_throttle.buckets.clear()
+
+    def test_typing_is_throttled_routed_and_never_queries(self):
+        async def type_a_lot():
+            alice, bob, carol = await connect(self.alice), await connect(self.bob), await connect(self.carol)
+            for communicator in (alice, bob, carol):
+                await drain(communicator)
+            captured = database_sync_to_async(lambda: list(queries.captured_queries))
+            start = len(await captured())
+            for _ in range(5):
+                await alice.send_json_to({"action": "typing", "receiver_id": self.bob.id})
+            await alice.send_json_to({"action": "typing", "receiver_id": self.bob.id, "typing": False})
+            events = [await bob.receive_json_from(), await bob.receive_json_from()]
+            nothing_else = [await c.receive_nothing(timeout=0.1) for c in (alice, bob, carol)]
+            sent = (await captured())[start:]
+            for communicator in (alice, bob, carol):
+                await communicator.disconnect()
+            return events, nothing_else, sent
+
+        with CaptureQueriesContext(connection) as queries:
+            events, nothing_else, sent = async_to_sync(type_a_lot)()
+        self.assertEqual(
+            [(e["event"], e["user_id"], e["typing"]) for e in events],
+            [("typing", self.alice.id, True), ("typing", self.alice.id, False)],
+        )
+        self.assertEqual(events[0]["expires_in"], settings.CHAT_TYPING_TTL)
+        self.assertEqual(nothing_else, [True, True, True])
+        self.assertEqual(sent, [])
+
+
+class ChangeFeedTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+
+    def change(self, sender, receiver, text):
+        msg = ChatMessage.objects.create(sender=sender, receiver=receiver, content=text)
+        changefeed.record_message_changes([msg])
+        return msg.change_payload["seq"]
+
+    async def test_resume_replays_only_missed_changes(self):
+        seen = await database_sync_to_async(self.change)(self.alice, self.bob, "seen")
+        await database_sync_to_async(self.change)(self.carol, self.alice, "not for bob")
+        missed = await database_sync_to_async(self.change)(self.alice, self.bob, "missed")
+
+        bob = await connect(self.bob)
+        await bob.send_json_to({"action": "resume", "since": seen})
+        event = await bob.receive_json_from()
+        self.assertEqual((event["event"], event["message"], event["seq"]), ("chat_message", "missed", missed))
+        self.assertEqual(await bob.receive_json_from(), {"event": "resumed", "seq": missed})
+        await bob.disconnect()
+
+    def test_http_changes_and_resync_fallback(self):
+        session = self.client.session
+        session["chat_user_id"] = self.bob.id
+        session.save()
+        first = self.change(self.alice, self.bob, "one")
+        second = self.change(self.alice, self.bob, "two")
+
+        data = self.client.get("/api/changes/", {"since": first}).json()
+        self.assertEqual(([c["seq"] for c in data["changes"]], data["seq"]), ([second], second))
+
+        with override_settings(CHAT_RESUME_MAX_CHANGES=1):
+            self.assertTrue(self.client.get("/api/changes/", {"since": 0}).json()["resync"])
+        ChangeEvent.objects.update(created_at=timezone.now() - timedelta(days=30))
+        self.assertEqual(changefeed.prune(), 1)  # newest entry is kept
+        self.assertTrue(self.client.get("/api/changes/", {"since": 0}).json()["resync"])
+        changes = self.client.get("/api/changes/", {"since": first}).json()["changes"]
+        self.assertEqual([c["seq"] for c in changes], [second])
+
+
+class ChunkedUploadTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        overrides = override_settings(
+            CHAT_UPLOAD_TEMP_DIR=os.path.join(self.tmp.name, "parts"),
+            CHAT_UPLOAD_CHUNK_SIZE=4,
+            MEDIA_ROOT=self.tmp.name,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        session = self.client.session
+        session["chat_user_id"] = self.alice.id
+        session.save()
+
+    def start(self, data, **fields):
+        response = self.client.post("/api/uploads/", {
+            "receiver_id": self.bob.id,
+            "file_name": "clip.mp4",
+            "file_type": "video",
+            "size": len(data),
+            "sha256": hashlib.sha256(data).hexdigest(),
+            **fields,
+        }, content_type="application/json")
+        self.assertEqual(response.status_code, 201)
+        return f"/api/uploads/{response.json()['upload_id']}/"
+
+    def put(self, url, offset, chunk):
+        return self.client.put(f"{url}?offset={offset}", chunk, content_type="application/octet-stream")
+
+    def test_chunks_resume_and_complete_once(self):
+        data = b"0123456789"
+        url = self.start(data)
+        self.assertEqual(self.put(url, 0, data[:4]).json()["offset"], 4)
+        self.assertEqual(self.put(url, 0, data[:4]).json()["offset"], 4)  # retried chunk
+        gap = self.put(url, 8, data[8:])
+        self.assertEqual((gap.status_code, gap.json()["offset"]), (409, 4))
+        self.assertEqual(self.put(url, 4, b"45678901").status_code, 413)  # over the chunk size
+        self.assertEqual(self.client.post(f"{url}complete/").status_code, 409)  # incomplete
+
+        # Connection dropped: ask where to continue.
+        offset = self.client.get(url).json()["offset"]
+        self.put(url, offset, data[offset:offset + 4])
+        self.assertEqual(self.put(url, 8, data[8:]).json()["offset"], len(data))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            first = self.client.post(f"{url}complete/").json()
+        again = self.client.post(f"{url}complete/").json()
+        self.assertEqual(first["msg_id"], again["msg_id"])
+        msg = ChatMessage.objects.get()
+        self.assertEqual((msg.sender_id, msg.receiver_id, msg.attachment_type), (self.alice.id, self.bob.id, "video"))
+        with msg.attachment.open("rb") as fh:
+            self.assertEqual(fh.read(), data)
+        self.assertEqual(os.listdir(os.path.join(self.tmp.name, "parts")), [])
+        self.assertEqual(self.put(url, 0, data[:4]).status_code, 409)
+
+    def test_malformed_offset_or_length_is_a_bad_request(self):
+        url = self.start(b"abcd")
+        self.assertEqual(self.put(url, "²", b"ab").status_code, 400)
+        response = self.client.put(
+            f"{url}?offset=0", b"ab", content_type="application/octet-stream", CONTENT_LENGTH="²"
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(self.client.get(url).json()["offset"], 0)
+
+    def test_checksum_mismatch_restarts_upload(self):
+        url = self.start(b"abcd", sha256=hashlib.sha256(b"abce").hexdigest())
+        self.put(url, 0, b"abcd")
+        response = self.client.post(f"{url}complete/")
+        self.assertEqual((response.status_code, response.json()["offset"]), (422, 0))
+        self.assertFalse(ChatMessage.objects.exists())
+
+    def test_only_the_sender_sees_the_session(self):
+        url = self.start(b"abcd")
+        session = self.client.session
+        session["chat_user_id"] = self.bob.id
+        session.save()
+        self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_stale_sessions_are_pruned(self):
+        self.start(b"abcd")
+        fresh = self.start(b"efgh")
+        UploadSession.objects.exclude(pk=fresh.split("/")[-2]).update(
+            updated_at=timezone.now() - timedelta(days=2)
+        )
+        self.assertEqual(uploads.prune(), 1)
+        self.assertEqual(len(os.listdir(os.path.join(self.tmp.name, "parts"))), 1)
+
+    def test_single_request_upload_is_sent_as_the_session_user(self):
+        form = {"receiver_id": self.bob.id, "sender_id": self.bob.id, "file_type": "document"}
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/chat/upload_attachment/", {
+                **form, "file": SimpleUploadedFile("notes.txt", b"hello"),
+            })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(ChatMessage.objects.get().sender_id, self.alice.id)
+
+        self.client.logout()
+        response = self.client.post("/chat/upload_attachment/", {
+            **form, "file": SimpleUploadedFile("notes.txt", b"hello"),
+        })
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(ChatMessage.objects.count(), 1)
+
+
+class MessageWriterTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    def unsaved(self, text):
+        return ChatMessage(sender_id=self.alice.id, receiver_id=self.bob.id, content=text)
+
+    def test_full_batch_is_one_insert(self):
+        writer = MessageWriter(batch_size=3, max_delay=60)
+
+        async def save_three():
+            return await asyncio.gather(*(writer.save(self.unsaved(str(i))) for i in range(3)))
+
+        with CaptureQueriesContext(connection) as queries:
+            saved = async_to_sync(save_three)()
+        inserts = [
+            q for q in queries.captured_queries if q["sql"].startswith('INSERT INTO "chat_chatmessage"')
+        ]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(len({msg.id for msg in saved}), 3)
+        self.assertTrue(all(msg.id and msg.timestamp for msg in saved))
+
+    async def test_partial_batch_flushes_after_delay(self):
+        writer = MessageWriter(batch_size=100, max_delay=0.01)
+        msg = await writer.save(self.unsaved("later"))
+        self.assertTrue(await ChatMessage.objects.filter(id=msg.id).aexists())
+
+    async def test_close_flushes_pending_within_timeout(self):
+        writer = MessageWriter(batch_size=100, max_delay=60)
+        pending = asyncio.ensure_future(writer.save(self.unsaved("bye")))
+        await asyncio.sleep(0)
+        self.assertTrue(await writer.close(timeout=1))
+        self.assertTrue((await pending).id)
+
+    async def test_lifespan_shutdown_flushes_the_writer(self):
+        writer = get_message_writer()
+        writer.max_delay = 60
+        pending = asyncio.ensure_future(writer.save(self.unsaved("shutdown")))
+        await asyncio.sleep(0)
+
+        server = ApplicationCommunicator(lifespan, {"type": "lifespan"})
+        await server.send_input({"type": "lifespan.startup"})
+        self.assertEqual((await server.receive_output())["type"], "lifespan.startup.complete")
+        await server.send_input({"type": "lifespan.shutdown"})
+        self.assertEqual((await server.receive_output(timeout=2))["type"], "lifespan.shutdown.complete")
+        self.assertTrue(pending.done())
+        self.assertTrue((await pending).id)
+
+
+class FrameTests(TestCase):
+    payload = {"event": "status_update", "user_id": 2, "up_to": 7, "new_status": "read"}
+
+    def test_event_carries_encoded_frame(self):
+        event = frames.build_event("status_update", self.payload)
+        self.assertEqual(event["type"], "status_update")
+        self.assertEqual(frames.loads(event["text"]), self.payload)
+        self.assertNotIn("bytes", event)  # no second encoding unless msgpack is enabled
+
+    def test_stdlib_backend_is_compatible(self):
+        name, dumps, loads = frames._select_backend("json")
+        self.assertEqual(name, "json")
+        self.assertEqual(loads(dumps(self.payload)), frames.loads(frames.dumps(self.payload)))
+
+
+@skipUnless(frames.msgpack, "needs msgpack")
+@override_settings(CHAT_MSGPACK_ENABLED=True)
+class MessagePackProtocolTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    async def connect_binary(self, user):
+        return await connect(user, subprotocols=[frames.MSGPACK_SUBPROTOCOL])
+
+    async def send(self, communicator, payload):
+        await communicator.send_to(bytes_data=frames.pack(payload))
+
+    async def receive(self, communicator, event):
+        data = await communicator.receive_from()
+        self.assertIsInstance(data, bytes)
+        payload = frames.unpack(data)
+        self.assertEqual(payload["event"], event)
+        return payload
+
+    def test_every_field_round_trips(self):
+        payload = {field: [tag, str(tag)] for field, tag in frames.FIELD_TAGS.items()}
+        payload["unknown_field"] = True
+        self.assertEqual(frames.unpack(frames.pack(payload)), payload)
+        self.assertLess(len(frames.pack(payload)), len(frames.dumps(payload)))
+
+    async def test_every_action_and_event(self):
+        bob = await self.connect_binary(self.bob)
+        await self.send(bob, {"action": "subscribe_presence", "add": [self.alice.id]})
+        alice = await self.connect_binary(self.alice)
+        alice_json = await connect(self.alice)
+
+        # Both tabs coming online reach bob as one digest.
+        event = await self.receive(bob, "presence_digest")
+        self.assertEqual([user[:2] for user in event["users"]], [[self.alice.id, True]])
+        await self.send(bob, {"action": "get_presence", "target_user_id": self.alice.id})
+        self.assertTrue((await self.receive(bob, "presence_update"))["is_online"])
+        await self.send(alice, {"action": "heartbeat"})
+
+        await self.send(alice, {
+            "action": "send_message",
+            "message": "packed",
+            "receiver_id": self.bob.id,
+        })
+        for communicator in (alice, bob):
+            event = await self.receive(communicator, "chat_message")
+            self.assertEqual((event["message"], event["sender_id"]), ("packed", self.alice.id))
+        msg_id = event["msg_id"]
+        # One event, two encodings: the JSON tab of the same user sees the same message.
+        self.assertEqual((await alice_json.receive_json_from())["msg_id"], msg_id)
+
+        await self.send(bob, {"action": "receiver_connected"})
+        event = await self.receive(alice, "status_update")
+        self.assertEqual((event["up_to"], event["new_status"]), (msg_id, "delivered"))
+
+        await self.send(bob, {"action": "mark_read", "other_user_id": self.alice.id})
+        event = await self.receive(alice, "status_update")
+        self.assertEqual((event["up_to"], event["new_status"]), (msg_id, "read"))
+
+        await self.send(alice, {"action": "delete_message", "msg_id": msg_id, "for_everyone": True})
+        for communicator in (alice, bob):
+            event = await self.receive(communicator, "delete_message")
+            self.assertEqual((event["msg_id"], event["for_everyone"]), (msg_id, True))
+
+        await self.send(bob, {"action": "subscribe_presence", "remove": [self.alice.id]})
+        for communicator in (alice, bob, alice_json):
+            await communicator.disconnect()
+
+
+class ActionDispatchTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    def test_schemas_clean_and_reject_fields(self):
+        self.assertEqual(
+            actions.validate("send_message", {"receiver_id": "7", "message": "hi"}),
+            {"receiver_id": 7, "message": "hi", "client_msg_id": None},
+        )
+        self.assertEqual(actions.validate("resume", {}), {"since": 0})
+        cases = [
+            ("shout", {}, ("unknown_action", None)),
+            ("send_message", {"message": "hi"}, ("missing_field", "receiver_id")),
+            ("send_message", {"receiver_id": True, "message": "hi"}, ("invalid_field", "receiver_id")),
+            ("mark_read", {"other_user_id": "²"}, ("invalid_field", "other_user_id")),  # isdigit, not int()
+            ("send_message", {"receiver_id": 7, "message": ["hi"]}, ("invalid_field", "message")),
+            ("delete_message", {"msg_id": 1, "for_everyone": "yes"}, ("invalid_field", "for_everyone")),
+            ("subscribe_presence", {"add": [1, "x"]}, ("invalid_field", "add")),
+        ]
+        for action, data, expected in cases:
+            with self.subTest(action=action, data=data), self.assertRaises(actions.InvalidFrame) as caught:
+                actions.validate(action, data)
+            self.assertEqual((caught.exception.code, caught.exception.field), expected)
+        with override_settings(CHAT_MESSAGE_MAX_LENGTH=3), self.assertRaises(actions.InvalidFrame) as caught:
+            actions.validate("send_message", {"receiver_id": 7, "message": "long"})
+        self.assertEqual(caught.exception.code, "too_large")
+
+    async def test_bad_frames_get_error_without_db_work(self):
+        alice = await connect(self.alice)
+        await alice.send_to(text_data="not json")
+        self.assertEqual((await alice.receive_json_from())["code"], "bad_frame")
+        for action in ("nope", [], {}, 1):
+            await alice.send_json_to({"action": action})
+            self.assertEqual((await alice.receive_json_from())["code"], "unknown_action")
+        await alice.send_json_to({
+            "action": "send_message", "receiver_id": self.bob.id, "message": "", "client_msg_id": "c-9",
+        })
+        error = await alice.receive_json_from()
+        self.assertEqual(
+            (error["code"], error["action"], error["field"], error["client_msg_id"]),
+            ("invalid_field", "send_message", "message", "c-9"),
+        )
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+        await alice.send_json_to({
+            "action": "send_message", "receiver_id": self.bob.id + 100, "message": "hi", "client_msg_id": "c-10",
+        })
+        error = await alice.receive_json_from()
+        self.assertEqual((error["code"], error["client_msg_id"]), ("unknown_receiver", "c-10"))
+        self.assertEqual(await ChatMessage.objects.acount(), 0)
+
+        handled = metrics.timings["action.heartbeat"][0]
+        await alice.send_json_to({"action": "heartbeat"})
+        await alice.send_json_to({"action": "resume", "since": 0})
+        self.assertEqual((await alice.receive_json_from())["event"], "resumed")
+        self.assertEqual(metrics.timings["action.heartbeat"][0], handled + 1)
+        await alice.disconnect()
+
+
+@override_settings(CHAT_RATE_LIMITS={"send_message": {"connection": (0.001, 2)}})
+class RateLimitTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    async def test_excess_actions_get_error_frame_without_db_work(self):
+        alice = await connect(self.alice)
+        for i in range(3):
+            await alice.send_json_to({
+                "action": "send_message",
+                "message": str(i),
+                "receiver_id": self.bob.id,
+                "client_msg_id": f"rl-{i}",
+            })
+        events = [await alice.receive_json_from() for _ in range(3)]
+        self.assertEqual([e["event"] for e in events], ["chat_message", "chat_message", "error"])
+        self.assertEqual(
+            (events[2]["code"], events[2]["action"], events[2]["client_msg_id"]), ("rate_limited", "send_message", "rl-2")
+        )
+        self.assertGreater(events[2]["retry_after"], 0)
+        self.assertEqual(await ChatMessage.objects.acount(), 2)
+        await alice.disconnect()
+
+    def test_bucket_refills_and_prunes(self):
+        buckets = BucketSet()
+        self.assertEqual(buckets.take(1, "typing", 0.001, 1), 0)
+        self.assertGreater(buckets.take(1, "typing", 0.001, 1), 0)
+        bucket = buckets.buckets[(1, "typing")]
+        buckets.prune(bucket.updated + 1)
+        self.assertIn((1, "typing"), buckets.buckets)
+        buckets.prune(bucket.updated + 1001)
+        self.assertEqual(buckets.buckets, {})
+
+    @skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+    @override_settings(CHAT_RATE_LIMITS={"mark_read": {"user": (0.001, 1)}})
+    async def test_user_bucket_is_shared_across_workers(self):
+        hosts = fake_redis_hosts()
+        worker_a = RateLimiter(RedisChannelLayer(hosts=hosts))
+        worker_b = RateLimiter(RedisChannelLayer(hosts=hosts))
+        self.assertEqual(await worker_a.check("mark_read", user_id=5), 0)
+        self.assertGreater(await worker_b.check("mark_read", user_id=5), 0)
+        self.assertEqual(await worker_b.check("mark_read", user_id=6), 0)
+
+
+class MetricsViewTests(TestCase):
+    def test_metrics_need_a_staff_login(self):
+        chat_user = ChatUser.objects.create(name="Alice", number="+910000000001")
+        session = self.client.session
+        session["chat_user_id"] = chat_user.id
+        session.save()
+        self.assertEqual(self.client.get("/api/metrics/").status_code, 403)
+
+        staff = User.objects.create_user("ops", password="x", is_staff=True)
+        self.client.force_login(staff)
+        response = self.client.get("/api/metrics/")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("counters", response.json())
+
+
+class OutboundQueueTests(TestCase):
+    async def stalled_queue(self, **limits):
+        """Queue whose socket accepts one frame and then stalls."""
+        self.sent = []
+        self.gate = asyncio.Event()
+
+        async def send(**frame):
+            self.sent.append(frame)
+            await self.gate.wait()
+
+        queue = OutboundQueue(send, **limits)
+        queue.put({"text_data": "first"})
+        await asyncio.sleep(0)  # writer picks up "first" and blocks on the socket
+        return queue
+
+    async def test_limits_and_depth_metric(self):
+        queue = await self.stalled_queue(max_messages=2, max_bytes=1000)
+        depth = metrics.gauges["send_queue.frames"]
+        self.assertTrue(queue.put({"text_data": "a"}))
+        self.assertTrue(queue.put({"text_data": "b"}))
+        self.assertFalse(queue.put({"text_data": "c"}))
+        self.assertEqual(metrics.gauges["send_queue.frames"], depth + 2)
+        self.assertFalse(queue.put({"text_data": "x" * 2000}, key="presence:9"))
+
+        self.gate.set()
+        await asyncio.sleep(0.01)
+        self.assertEqual([f["text_data"] for f in self.sent], ["first", "a", "b"])
+        self.assertEqual(len(queue), 0)
+        queue.close()
+        self.assertEqual(metrics.gauges["send_queue.frames"], depth)
+
+    async def test_presence_and_status_frames_coalesce(self):
+        queue = await self.stalled_queue()
+        queue.put({"text_data": frames.dumps({"user_id": 1, "is_online": True})}, key="presence:1")
+        queue.put({"text_data": frames.dumps({"user_id": 1, "is_online": False})}, key="presence:1")
+        for up_to in (2, 3):
+            payload = {"event": "status_update", "user_id": 2, "up_to": up_to, "new_status": "read"}
+            queue.put({"text_data": frames.dumps(payload)}, key="status:read:2")
+        self.assertEqual(len(queue), 2)
+
+        self.gate.set()
+        await asyncio.sleep(0.01)
+        presence, status = (frames.loads(f["text_data"]) for f in self.sent[1:])
+        self.assertFalse(presence["is_online"])
+        self.assertEqual(status["up_to"], 3)
+        queue.close()
+
+    async def test_limit_counts_utf8_bytes_and_coalesced_growth(self):
+        queue = await self.stalled_queue(max_bytes=10)
+        self.assertFalse(queue.put({"text_data": "éééééé"}))  # 6 characters, 12 bytes
+        self.assertTrue(queue.put({"text_data": "ab"}, key="presence:1"))
+        self.assertFalse(queue.put({"text_data": "x" * 20}, key="presence:1"))
+        self.assertTrue(queue.put({"text_data": "é" * 5}, key="presence:1"))
+        self.assertEqual(queue.bytes, 10)
+        queue.close()
+
+
+class PresenceRegistryTests(TestCase):
+    def setUp(self):
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001", otp_secret="ABC")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+        self.carol = ChatUser.objects.create(name="Carol", number="+910000000003")
+        self.registry = PresenceRegistry()
+
+    def test_heartbeats_stay_in_memory(self):
+        with self.assertNumQueries(0):
+            self.registry.set_online(self.alice.id, True)
+            for _ in range(10):
+                self.registry.touch(self.alice.id)
+            is_online, last_seen = self.registry.get(self.alice.id)
+        self.assertTrue(is_online)
+        self.assertIsNotNone(last_seen)
+
+    def test_flush_is_one_update_of_presence_fields(self):
+        self.registry.set_online(self.alice.id, True)
+        self.registry.set_online(self.bob.id, False)
+        with CaptureQueriesContext(connection) as queries:
+            self.registry.flush()
+        self.assertEqual(len(queries.captured_queries), 1)
+        sql = queries.captured_queries[0]["sql"]
+        self.assertTrue(sql.startswith("UPDATE"))
+        self.assertNotIn("otp_secret", sql)
+
+        self.alice.refresh_from_db()
+        self.bob.refresh_from_db()
+        self.assertTrue(self.alice.is_online)
+        self.assertEqual(self.alice.otp_secret, "ABC")
+        self.assertFalse(self.bob.is_online)
+        self.assertIsNotNone(self.bob.last_seen)
+        with self.assertNumQueries(0):
+            self.registry.flush()
+
+    def test_load_reads_database_once(self):
+        with self.assertNumQueries(1):
+            self.assertEqual(self.registry.load(self.bob.id), (False, None))
+            self.registry.load(self.bob.id)
+
+    def test_load_many_is_one_id_in_query(self):
+        self.registry.set_online(self.alice.id, True)
+        with self.assertNumQueries(1):
+            states = self.registry.load_many([self.alice.id, self.bob.id, self.bob.id + 100])
+        self.assertEqual(set(states), {self.alice.id, self.bob.id})
+        self.assertTrue(states[self.alice.id][0])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.registry.load_many([self.bob.id]), {self.bob.id: (False, None)})
+
+    async def test_reconnect_storm_is_one_digest_per_subscriber(self):
+        bob = await connect(self.bob)
+        await bob.send_json_to({"action": "subscribe_presence", "add": [self.alice.id, self.carol.id]})
+        await drain(bob)
+        carol = await connect(self.carol)
+        for _ in range(3):
+            alice = await connect(self.alice)
+            await alice.disconnect()
+        alice = await connect(self.alice)
+
+        event = await bob.receive_json_from()
+        self.assertEqual(event["event"], "presence_digest")
+        self.assertEqual(
+            sorted(user[:2] for user in event["users"]), [[self.alice.id, True], [self.carol.id, True]]
+        )
+        self.assertTrue(await bob.receive_nothing(timeout=0.3))
+
+        with override_settings(CHAT_PRESENCE_DIGEST_WINDOW=0, CHAT_PRESENCE_GRACE_PERIOD=0):
+            await carol.disconnect()
+            event = await bob.receive_json_from()
+        self.assertEqual((event["event"], event["user_id"], event["is_online"]), ("presence_update", self.carol.id, False))
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+    @override_settings(CHAT_PRESENCE_DIGEST_WINDOW=0, CHAT_PRESENCE_GRACE_PERIOD=0.1)
+    async def test_offline_only_after_last_socket_and_grace_period(self):
+        bob = await connect(self.bob)
+        await bob.send_json_to({"action": "subscribe_presence", "add": [self.alice.id]})
+        phone, laptop = await connect(self.alice), await connect(self.alice)
+        self.assertTrue((await bob.receive_json_from())["is_online"])
+        self.assertTrue(await bob.receive_nothing(timeout=0.1))  # second device: no update
+
+        await phone.disconnect()
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        await laptop.disconnect()
+        laptop = await connect(self.alice)  # reload inside the grace period
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+
+        await laptop.disconnect()
+        event = await bob.receive_json_from()
+        self.assertEqual((event["user_id"], event["is_online"]), (self.alice.id, False))
+        self.assertFalse(presence_registry.get(self.alice.id)[0])
+        await bob.disconnect()
+
+    @skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+    async def test_connection_counts_are_shared_across_workers(self):
+        hosts = fake_redis_hosts()
+        worker_a, worker_b = RedisChannelLayer(hosts=hosts), RedisChannelLayer(hosts=hosts)
+        counter_a, counter_b = ConnectionCounter(), ConnectionCounter()
+        went_offline = []
+
+        async def go_offline():
+            went_offline.append(True)
+
+        self.assertTrue(await counter_a.open(worker_a, self.alice.id, "a!1"))
+        self.assertFalse(await counter_b.open(worker_b, self.alice.id, "b!1"))  # already online elsewhere
+        with override_settings(CHAT_PRESENCE_GRACE_PERIOD=0):
+            await counter_a.close(worker_a, self.alice.id, "a!1", go_offline)
+            self.assertEqual(went_offline, [])
+            await counter_b.close(worker_b, self.alice.id, "b!1", go_offline)
+        self.assertEqual(went_offline, [True])
+        await worker_a.flush()
+
+    @skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+    async def test_presence_is_read_from_redis_not_local_memory(self):
+        hosts = fake_redis_hosts()
+        worker_a, worker_b = RedisChannelLayer(hosts=hosts), RedisChannelLayer(hosts=hosts)
+        registry_a, registry_b = PresenceRegistry(), PresenceRegistry()
+        registry_b.set_online(self.alice.id, False)  # B saw Alice leave earlier
+
+        await ConnectionCounter().open(worker_a, self.alice.id, "a!1")  # she is back, connected to A
+        registry_a.set_online(self.alice.id, True)
+        await registry_a.apublish(worker_a, self.alice.id)
+        self.assertTrue((await registry_b.aload(self.alice.id, worker_b))[0])
+        self.assertFalse(registry_b.get(self.alice.id)[0])  # the local entry is not the answer
+
+        # Bob has no shared state yet: answered from his row.
+        states = await registry_b.aload_many([self.alice.id, self.bob.id], worker_b)
+        self.assertEqual((states[self.alice.id][0], states[self.bob.id][0]), (True, False))
+        await worker_a.flush()
+
+    @skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+    @override_settings(CHAT_PRESENCE_GRACE_PERIOD=0.2, CHAT_PRESENCE_CONNECTION_TTL=0.2)
+    async def test_user_of_a_crashed_worker_reads_offline(self):
+        hosts = fake_redis_hosts()
+        worker_a, worker_b = RedisChannelLayer(hosts=hosts), RedisChannelLayer(hosts=hosts)
+        registry_a, registry_b = PresenceRegistry(), PresenceRegistry()
+        # Alice's only socket is on worker A, which flushed her row as online and then died.
+        await ConnectionCounter().open(worker_a, self.alice.id, "a!1")
+        registry_a.set_online(self.alice.id, True)
+        await registry_a.apublish(worker_a, self.alice.id)
+        await database_sync_to_async(registry_a.flush)()
+        # Bob closed his last socket just now: inside the grace period.
+        counter_b = ConnectionCounter()
+        await counter_b.open(worker_b, self.bob.id, "b!1")
+        registry_b.set_online(self.bob.id, True)
+        await registry_b.apublish(worker_b, self.bob.id)
+        went_offline = []
+
+        async def go_offline():
+            went_offline.append(True)
+
+        await counter_b.close(worker_b, self.bob.id, "b!1", go_offline)
+        counter_b.pending_offline.pop(self.bob.id).cancel()  # ...and then worker B died too
+
+        states = await registry_b.aload_many([self.alice.id, self.bob.id], worker_b)
+        self.assertEqual((states[self.alice.id][0], states[self.bob.id][0]), (True, True))
+
+        await asyncio.sleep(0.3)  # no heartbeat from A, grace period over
+        states = await registry_b.aload_many([self.alice.id, self.bob.id], worker_b)
+        self.assertEqual((states[self.alice.id][0], states[self.bob.id][0]), (False, False))
+        self.assertEqual(went_offline, [])  # nobody announced it: readers work it out
+        await worker_b.flush()
+        # Once the shared hash is gone too, the stale row is not believed either.
+        self.assertFalse((await registry_b.aload(self.alice.id, worker_b))[0])
+        await worker_a.flush()
+
+    @skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+    @override_settings(CHAT_PRESENCE_GRACE_PERIOD=0, CHAT_PRESENCE_CONNECTION_TTL=0.2)
+    async def test_sockets_of_a_crashed_worker_stop_counting(self):
+        hosts = fake_redis_hosts()
+        worker_a, worker_b = RedisChannelLayer(hosts=hosts), RedisChannelLayer(hosts=hosts)
+        counter_a, counter_b = ConnectionCounter(), ConnectionCounter()
+        went_offline = []
+
+        async def go_offline():
+            went_offline.append(True)
+
+        await counter_a.open(worker_a, self.alice.id, "a!1")
+        await counter_b.open(worker_b, self.alice.id, "b!1")  # worker B dies without closing it
+        await asyncio.sleep(0.3)
+        await counter_a.refresh(worker_a, self.alice.id, "a!1")  # heartbeat on the live socket
+        await counter_a.close(worker_a, self.alice.id, "a!1", go_offline)
+        self.assertEqual(went_offline, [True])
+        await worker_a.flush()
+
+    async def test_bulk_presence_is_one_frame(self):
+        bob = await connect(self.bob)
+        alice = await connect(self.alice)
+        await alice.send_json_to({"action": "get_presence_bulk", "user_ids": [self.bob.id, self.bob.id + 100]})
+        event = await alice.receive_json_from()
+        self.assertEqual(event["event"], "presence_bulk")
+        [(user_id, is_online, _)] = event["users"]
+        self.assertEqual((user_id, is_online), (self.bob.id, True))
+        for communicator in (alice, bob):
+            await communicator.disconnect()
+
+
+@skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+class RedisChannelLayerTests(TestCase):
+    def setUp(self):
+        self.hosts = fake_redis_hosts()
+
+    async def test_group_send_crosses_worker_processes(self):
+        # Two layer instances on the same hosts behave like two ASGI workers.
+        worker_a = RedisChannelLayer(hosts=self.hosts)
+        worker_b = RedisChannelLayer(hosts=self.hosts)
+        channel = await worker_b.new_channel()
+        await worker_b.group_add("chat_user_1", channel)
+
+        await worker_a.group_send("chat_user_1", {"type": "chat_message", "msg_id": 7})
+        self.assertEqual((await worker_b.receive(channel))["msg_id"], 7)
+        await worker_a.flush()
+        await worker_b.flush()
+
+    async def test_groups_are_sharded_across_hosts(self):
+        layer = RedisChannelLayer(hosts=self.hosts)
+        shards = {layer.consistent_hash(f"chat_user_{uid}") for uid in range(50)}
+        self.assertEqual(shards, {0, 1})
+
+    def test_layer_settings_are_configurable(self):
+        layer = RedisChannelLayer(hosts=self.hosts, group_expiry=30, capacity=5)
+        self.assertEqual((layer.group_expiry, layer.capacity), (30, 5))
+
+
+@skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+@override_settings(CHANNEL_LAYERS={
+    "default": {
+        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "CONFIG": {"hosts": fake_redis_hosts() if fakeredis else []},
+    }
+})
+class RedisChatRoutingTests(ChatRoutingTests):
+    """Same routing guarantees when the layer is shared across processes."""
+
+
+@skipUnless(fakeredis, "needs channels_redis and fakeredis[lua]")
+class SharedPresenceTests(TestCase):
+    """Two consumers on separate Redis layer instances stand in for two workers."""
+
+    def setUp(self):
+        hosts = fake_redis_hosts()
+        layer = {"BACKEND": "channels_redis.core.RedisChannelLayer", "CONFIG": {"hosts": hosts}}
+        overrides = override_settings(CHANNEL_LAYERS={"default": layer, "worker_a": layer, "worker_b": layer})
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.addCleanup(presence_registry.states.clear)
+        self.alice = ChatUser.objects.create(name="Alice", number="+910000000001")
+        self.bob = ChatUser.objects.create(name="Bob", number="+910000000002")
+
+    async def connect_to(self, worker, user):
+        session = SessionStore()
+        session["chat_user_id"] = user.id
+        await database_sync_to_async(session.create)()
+        worker_app = SessionMiddlewareStack(URLRouter([
+            re_path(r"ws/chat/global_chat/$", ChatConsumer.as_asgi(channel_layer_alias=worker)),
+        ]))
+        communicator = WebsocketCommunicator(
+            worker_app,
+            "/ws/chat/global_chat/",
+            headers=[(b"cookie", f"{settings.SESSION_COOKIE_NAME}={session.session_key}".encode())],
+        )
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_bulk_presence_sees_a_connect_on_another_worker(self):
+        bob = await self.connect_to("worker_b", self.bob)
+        await drain(bob)  # the connect has finished (online published)
+        # Worker A's own memory last saw Bob offline (in one test process
+        # both "workers" share the module registry).
+        presence_registry.states[self.bob.id] = (False, None)
+        alice = await self.connect_to("worker_a", self.alice)
+        await drain(alice)
+
+        await alice.send_json_to({"action": "get_presence_bulk", "user_ids": [self.bob.id]})
+        event = await alice.receive_json_from()
+        self.assertEqual(event["event"], "presence_bulk")
+        self.assertEqual([user[:2] for user in event["users"]], [[self.bob.id, True]])
+        for communicator in (alice, bob):
+            await communicator.disconnect()
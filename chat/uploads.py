@@ -0,0 +1,147 @@
+"""Resumable, chunked attachment uploads.
+
+A client opens an ``UploadSession`` with the file's size and SHA-256, sends
+the bytes as ``PUT`` chunks tagged with their offset, and completes it. Each
+chunk is streamed from the request into the session's temp file under
+``CHAT_UPLOAD_TEMP_DIR``; nothing is held in memory. A chunk may start
+anywhere up to the bytes already received, so a retried or partly applied
+chunk simply rewrites the same bytes. After a dropped connection the client
+asks for ``received`` and continues from there.
+"""
+import hashlib
+import os
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from .models import UploadSession
+
+READ_BLOCK = 64 * 1024
+
+
+class UploadError(Exception):
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+def temp_dir():
+    return str(getattr(settings, "CHAT_UPLOAD_TEMP_DIR", os.path.join(settings.BASE_DIR, "tmp", "chat_uploads")))
+
+
+def temp_path(upload):
+    return os.path.join(temp_dir(), f"{upload.id}.part")
+
+
+def max_upload_bytes():
+    return getattr(settings, "CHAT_UPLOAD_MAX_BYTES", 100 * 1024 * 1024)
+
+
+def max_chunk_bytes():
+    return getattr(settings, "CHAT_UPLOAD_CHUNK_SIZE", 1024 * 1024)
+
+
+def open_session(sender_id, receiver_id, file_name, file_type, size, sha256):
+    """A new session with an empty temp file."""
+    if not isinstance(size, int) or isinstance(size, bool) or size <= 0:
+        raise UploadError("Invalid size")
+    if size > max_upload_bytes():
+        raise UploadError("File too large", status=413)
+    sha256 = (sha256 or "").lower()
+    if len(sha256) != 64 or any(c not in "0123456789abcdef" for c in sha256):
+        raise UploadError("Invalid sha256")
+    upload = UploadSession.objects.create(
+        sender_id=sender_id,
+        receiver_id=receiver_id,
+        file_name=os.path.basename(file_name or "")[:255] or "upload",
+        file_type=(file_type or "document")[:20],
+        size=size,
+        sha256=sha256,
+    )
+    os.makedirs(temp_dir(), exist_ok=True)
+    open(temp_path(upload), "wb").close()
+    return upload
+
+
+def write_chunk(upload, offset, stream, length):
+    """Copy ``length`` bytes of ``stream`` to ``offset``; returns the new ``received``.
+
+    ``offset`` may not be past ``received`` (that would leave a hole): the
+    error carries the offset to resume from instead.
+    """
+    if upload.message_id:
+        raise UploadError("Upload already completed", status=409, offset=upload.received)
+    if offset > upload.received:
+        raise UploadError("Chunk does not continue the upload", status=409, offset=upload.received)
+    if length <= 0 or length > max_chunk_bytes():
+        raise UploadError("Invalid chunk length", status=413 if length > 0 else 400)
+    if offset + length > upload.size:
+        raise UploadError("Chunk ends past the declared size")
+
+    written = 0
+    with open(temp_path(upload), "r+b") as fh:
+        fh.seek(offset)
+        while written < length:
+            block = stream.read(min(READ_BLOCK, length - written))
+            if not block:
+                break
+            fh.write(block)
+            written += len(block)
+    if written < length:
+        raise UploadError("Chunk body shorter than Content-Length", offset=upload.received)
+
+    UploadSession.objects.filter(pk=upload.pk).update(
+        received=Greatest(F("received"), offset + length), updated_at=timezone.now()
+    )
+    upload.refresh_from_db(fields=["received", "updated_at"])
+    return upload.received
+
+
+def verify(upload):
+    """Raise UploadError unless every byte arrived and the SHA-256 matches.
+
+    On a checksum mismatch the session starts over from offset 0.
+    """
+    if upload.received != upload.size:
+        raise UploadError("Upload incomplete", status=409, offset=upload.received)
+    digest = hashlib.sha256()
+    with open(temp_path(upload), "rb") as fh:
+        for block in iter(lambda: fh.read(READ_BLOCK), b""):
+            digest.update(block)
+    if digest.hexdigest() != upload.sha256:
+        UploadSession.objects.filter(pk=upload.pk).update(received=0, updated_at=timezone.now())
+        open(temp_path(upload), "wb").close()
+        raise UploadError("Checksum mismatch", status=422, offset=0)
+
+
+def discard_temp_file(upload):
+    try:
+        os.remove(temp_path(upload))
+    except FileNotFoundError:
+        pass
+
+
+def prune(now=None):
+    """Delete sessions idle longer than ``CHAT_UPLOAD_SESSION_TTL`` and their temp files.
+
+    Temp files left without a session (e.g. after a user was deleted) go too.
+    """
+    ttl = getattr(settings, "CHAT_UPLOAD_SESSION_TTL", timedelta(hours=24))
+    cutoff = (now or timezone.now()) - ttl
+    stale = UploadSession.objects.filter(updated_at__lt=cutoff)
+    for upload in stale.only("id"):
+        discard_temp_file(upload)
+    deleted, _ = stale.delete()
+
+    if os.path.isdir(temp_dir()):
+        live = {str(pk) for pk in UploadSession.objects.values_list("id", flat=True)}
+        for name in os.listdir(temp_dir()):
+            path = os.path.join(temp_dir(), name)
+            if (name.endswith(".part") and name[:-len(".part")] not in live
+                    and os.path.getmtime(path) < cutoff.timestamp()):
+                os.remove(path)
+    return deleted
@@ -14,10 +14,16 @@ urlpatterns = [
     # 
     path('logout/', views.logout_view, name='logout'),
     path('chat/', views.chat_view, name='chat_list'),
+    path('chat/upload_attachment/', views.upload_attachment, name='upload_attachment'),
+    path('chat/<str:number>/', views.chat_view, name='chat_with'),
     path('api/chat/<str:number>/messages/', views.get_chat_messages, name='get_chat_messages'),
 
     # path('lobby/', views.lobby_view, name='lobby'),
     path('profile/get/', views.get_profile, name='get_profile'),
     path('update_profile/', views.update_profile, name='update_profile'),
-    path('chat/upload_attachment/', views.upload_attachment, name='upload_attachment'),
+    path('api/changes/', views.changes_view, name='changes'),
+    path('api/uploads/', views.upload_sessions_view, name='upload_sessions'),
+    path('api/uploads/<uuid:upload_id>/', views.upload_session_view, name='upload_session'),
+    path('api/uploads/<uuid:upload_id>/complete/', views.complete_upload_view, name='complete_upload'),
+    path('api/metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
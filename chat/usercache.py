@@ -0,0 +1,86 @@
+"""Bounded LRU of ChatUser ids known to exist.
+
+Lets the message hot path validate sender/receiver ids without a query per
+message. Only positive answers are cached; the ``post_save``/``post_delete``
+receivers keep the cache in step with user creation and deletion in this
+process, and the foreign keys still reject ids deleted by another worker.
+"""
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .models import ChatUser
+
+
+class UserIdCache:
+    def __init__(self, max_size=None):
+        self.max_size = max_size or getattr(settings, "CHAT_USER_ID_CACHE_SIZE", 10000)
+        self.ids = OrderedDict()
+
+    def _coerce(self, user_id):
+        try:
+            return int(user_id)
+        except (TypeError, ValueError):
+            return None
+
+    def contains(self, user_id):
+        """Memory-only check; False means "unknown", not "missing"."""
+        user_id = self._coerce(user_id)
+        if user_id in self.ids:
+            self.ids.move_to_end(user_id)
+            return True
+        return False
+
+    def add(self, user_id):
+        self.ids[int(user_id)] = True
+        self.ids.move_to_end(int(user_id))
+        while len(self.ids) > self.max_size:
+            self.ids.popitem(last=False)
+
+    def discard(self, user_id):
+        self.ids.pop(int(user_id), None)
+
+    def missing(self, user_ids):
+        """Ids in ``user_ids`` not in the cache (invalid ids count as missing)."""
+        return [uid for uid in user_ids if not self.contains(uid)]
+
+    def load(self, user_ids):
+        """Resolve unknown ids with one ``id__in`` query; True if all exist."""
+        wanted = {self._coerce(uid) for uid in user_ids}
+        if None in wanted:
+            return False
+        found = set(ChatUser.objects.filter(id__in=wanted).values_list("id", flat=True))
+        for user_id in found:
+            self.add(user_id)
+        return found == wanted
+
+    async def aload(self, user_ids):
+        """``load`` through the async ORM, for consumers."""
+        wanted = {self._coerce(uid) for uid in user_ids}
+        if None in wanted:
+            return False
+        found = {uid async for uid in ChatUser.objects.filter(id__in=wanted).values_list("id", flat=True)}
+        for user_id in found:
+            self.add(user_id)
+        return found == wanted
+
+    def exists(self, *user_ids):
+        """Sync helper for views: True if every id is a ChatUser."""
+        missing = self.missing(user_ids)
+        return not missing or self.load(missing)
+
+
+user_cache = UserIdCache()
+
+
+@receiver(post_save, sender=ChatUser)
+def _cache_new_user(sender, instance, created, **kwargs):
+    if created:
+        user_cache.add(instance.id)
+
+
+@receiver(post_delete, sender=ChatUser)
+def _forget_deleted_user(sender, instance, **kwargs):
+    user_cache.discard(instance.id)
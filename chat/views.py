@@ -1,21 +1,51 @@
 from django.shortcuts import render, redirect, get_object_or_404
-from .models import ChatUser, ChatMessage, TempUser
+from .models import ChatUser, ChatMessage, Conversation, TempUser, UploadSession, conversation_key
 from .forms import SignupForm, PhoneNumberForm
-from django.db.models import Q, OuterRef, Subquery, Count
+from django.db import transaction
+from django.db.models import F, Q
 from django.utils import timezone 
 from django.core.paginator import Paginator
+from django.core.files import File
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
+from django.conf import settings
 import json
 import pyotp
 from django.middleware.csrf import get_token
 from channels.layers import get_channel_layer
 from asgiref.sync import async_to_sync
+from .groups import send_to_users
+from .frames import build_event
+from .presence import registry as presence_registry
+from .usercache import user_cache
+from . import metrics, uploads
+from .conversations import get_conversation, message_statuses, record_message
+from .hotcache import hot_messages
+from .changefeed import changes_since, current_seq, message_payload, record_change
 
 
 # ---------------------------
 # Helper Functions
 # ---------------------------
+def presence_overlay(user_ids):
+    """Live ``{user_id: (is_online, last_seen)}`` for users whose rows may be stale.
+
+    Presence reaches the database only on the periodic flush. With a Redis
+    channel layer the shared state is read from Redis (rows of users it has
+    no state for cost one query); otherwise this process's registry knows
+    every connected user.
+    """
+    channel_layer = get_channel_layer()
+    if hasattr(channel_layer, "consistent_hash"):
+        return async_to_sync(presence_registry.aload_many)(user_ids, channel_layer)
+    states = {}
+    for user_id in user_ids:
+        state = presence_registry.get(user_id)
+        if state:
+            states[user_id] = state
+    return states
+
+
 def get_logged_in_user(request):
     """Retrieve the currently logged-in ChatUser from session."""
     user_id = request.session.get('chat_user_id')
@@ -27,6 +57,62 @@ def get_logged_in_user(request):
         return None
 
 
+HISTORY_FIELDS = ('id', 'content', 'sender_id', 'timestamp', 'attachment', 'attachment_type')
+
+
+def get_message_page(user_id, other_user_id, before=None, after=None, limit=None):
+    """One keyset page of a conversation, oldest first, plus the next cursor.
+
+    Without a cursor this is the newest page. ``before`` walks back in history
+    and ``after`` forward; ``next_cursor`` is the id to pass as the same
+    parameter for the following page, or None when there is nothing more.
+    Only ``HISTORY_FIELDS`` are read, as plain dicts; ``status`` comes from
+    the conversation's delivery/read watermarks. The newest page is served
+    from the hot-conversation cache when possible.
+    """
+    max_limit = getattr(settings, 'CHAT_HISTORY_MAX_PAGE_SIZE', 200)
+    limit = min(limit or getattr(settings, 'CHAT_HISTORY_PAGE_SIZE', 50), max_limit)
+    key = conversation_key(user_id, other_user_id)
+
+    if before is None and after is None:
+        version = hot_messages.version(key)
+        cached = hot_messages.newest_page(key, limit)
+        if cached is not None:
+            rows, next_cursor, conversation = cached
+            if conversation is None:
+                conversation = get_conversation(user_id, other_user_id)
+                hot_messages.set_conversation(key, conversation, version)
+            return message_statuses(user_id, other_user_id, rows, conversation), next_cursor
+
+    qs = ChatMessage.objects.filter(conversation_key=key)
+    if after is not None:
+        rows = list(qs.filter(id__gt=after).order_by('id').values(*HISTORY_FIELDS)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = rows[-1]['id'] if has_more else None
+    else:
+        if before is not None:
+            qs = qs.filter(id__lt=before)
+        rows = list(qs.order_by('-id').values(*HISTORY_FIELDS)[:limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        next_cursor = rows[0]['id'] if has_more else None
+        if before is None:
+            conversation = get_conversation(user_id, other_user_id)
+            hot_messages.fill(key, rows, has_more, conversation, version)
+            return message_statuses(user_id, other_user_id, rows, conversation), next_cursor
+    return message_statuses(user_id, other_user_id, rows), next_cursor
+
+
+def parse_cursor(value):
+    """Positive integer query parameter, or None if missing/invalid."""
+    try:
+        value = int(value)
+    except (TypeError, ValueError):
+        return None
+    return value if value > 0 else None
+
+
 # ---------------------------
 # Views: Signup & User Management
 # ---------------------------
@@ -296,41 +382,42 @@ def chat_view(request, number=None):
     if not current_user:
         return redirect('login')
 
-    # === chat_list_view logic === (unchanged) ===
-    users = ChatUser.objects.exclude(id=current_user.id).annotate(
-        last_message_id=Subquery(
-            ChatMessage.objects.filter(
-                Q(sender_id=OuterRef('id'), receiver_id=current_user.id) |
-                Q(sender_id=current_user.id, receiver_id=OuterRef('id'))
-            ).order_by('-timestamp').values('id')[:1]
-        ),
+    # === chat list: one indexed query over the per-pair Conversation summaries ===
+    conversations = Conversation.objects.filter(
+        Q(user_low=current_user) | Q(user_high=current_user)
+    ).exclude(user_low=F('user_high')).select_related('user_low', 'user_high').order_by(
+        F('last_message_time').desc(nulls_last=True)
     )
 
-    users = users.annotate(
-        last_message_content=Subquery(
-            ChatMessage.objects.filter(id=OuterRef('last_message_id')).values('content')[:1]
-        ),
-        last_message_time=Subquery(
-            ChatMessage.objects.filter(id=OuterRef('last_message_id')).values('timestamp')[:1]
-        ),
-        last_message_sender_id=Subquery(
-            ChatMessage.objects.filter(id=OuterRef('last_message_id')).values('sender_id')[:1]
-        ),
-        unread_count=Subquery(
-            ChatMessage.objects.filter(
-                sender_id=OuterRef('id'),
-                receiver_id=current_user.id,
-                status__in=['sent', 'delivered']
-            ).values('sender_id')
-            .annotate(count=Count('id'))
-            .values('count')[:1]
-        )
-    ).order_by('-last_message_time')
+    users = []
+    for conversation in conversations:
+        user = conversation.other_user(current_user.id)
+        user.last_message_content = conversation.last_message_preview
+        user.last_message_time = conversation.last_message_time
+        user.last_message_sender_id = conversation.last_sender_id
+        user.unread_count = conversation.unread_for(current_user.id)
+        users.append(user)
+
+    # Users without a conversation yet are listed after the ones with messages.
+    listed_ids = [user.id for user in users] + [current_user.id]
+    for user in ChatUser.objects.exclude(id__in=listed_ids):
+        user.last_message_content = None
+        user.last_message_time = None
+        user.last_message_sender_id = None
+        user.unread_count = 0
+        users.append(user)
 
     chat_list_data = []
     now = timezone.now()
+    profile_data = get_profile(request)
+    live_presence = presence_overlay([user.id for user in users])
 
     for user in users:
+        # Presence is kept in memory and only flushed to the DB periodically.
+        state = live_presence.get(user.id)
+        if state:
+            user.is_online, user.last_seen = state
+
         initials = ''.join(word[0] for word in user.name.split() if word).upper()[:3]
         if not initials:
             initials = str(user.number)[-2:]
@@ -352,8 +439,6 @@ def chat_view(request, number=None):
             preview_text = 'Start a chat'
 
         data_type = 'Unread' if user.unread_count and user.unread_count > 0 else 'All'
-        # safe to call get_profile once (not inside loop ideally)
-        profile_data = get_profile(request)
         chat_list_data.append({
             'user': user,
             'initials': initials,
@@ -366,15 +451,16 @@ def chat_view(request, number=None):
     # If a number is provided, try to load that conversation
     receiver = None
     messages = []
-    room_name = "global_chat"  # keep same group name as consumer
+    next_cursor = None
+    room_name = "global_chat"  # websocket route; events themselves are routed per user
     if number:
         try:
             receiver = ChatUser.objects.get(number=number)
-            messages_qs = ChatMessage.objects.filter(
-                Q(sender=current_user, receiver=receiver) |
-                Q(sender=receiver, receiver=current_user)
-            ).order_by('timestamp')
-            messages = list(messages_qs)
+            state = presence_overlay([receiver.id]).get(receiver.id)
+            if state:
+                receiver.is_online, receiver.last_seen = state
+            # Only the newest page is rendered; older pages load on scroll.
+            messages, next_cursor = get_message_page(current_user.id, receiver.id)
         except ChatUser.DoesNotExist:
             receiver = None
             messages = []
@@ -385,13 +471,18 @@ def chat_view(request, number=None):
         'profile_data': profile_data,
         'receiver': receiver,
         'messages': messages,
+        'next_cursor': next_cursor,
+        'change_seq': current_seq(),
         'room_name': room_name,
     })
 
 
 
 def get_chat_messages(request, number):
-    """Return chat messages between current user and the given number."""
+    """Return one page of chat messages between current user and the given number.
+
+    Query parameters: ``before`` / ``after`` (message id cursor) and ``limit``.
+    """
     current_user = get_logged_in_user(request)
     if not current_user:
         return JsonResponse({'error': 'Not logged in'}, status=403)
@@ -401,26 +492,54 @@ def get_chat_messages(request, number):
     except ChatUser.DoesNotExist:
         return JsonResponse({'error': 'User not found'}, status=404)
 
-    messages = ChatMessage.objects.filter(
-        Q(sender=current_user, receiver=other_user) |
-        Q(sender=other_user, receiver=current_user)
-    ).order_by('timestamp')
+    messages, next_cursor = get_message_page(
+        current_user.id,
+        other_user.id,
+        before=parse_cursor(request.GET.get('before')),
+        after=parse_cursor(request.GET.get('after')),
+        limit=parse_cursor(request.GET.get('limit')),
+    )
+    storage = ChatMessage._meta.get_field('attachment').storage
 
     data = [
         {
-            'id': msg.id,
-            'content': msg.content,
-            'is_sender': msg.sender_id == current_user.id,
-            'timestamp': msg.timestamp.strftime('%H:%M'),
-            'status': msg.status,
-            'attachment_url': msg.attachment.url if msg.attachment else None,
-            'attachment_type': msg.attachment_type,
+            'id': msg['id'],
+            'content': msg['content'],
+            'is_sender': msg['sender_id'] == current_user.id,
+            'timestamp': msg['timestamp'].strftime('%H:%M'),
+            'status': msg['status'],
+            'attachment_url': storage.url(msg['attachment']) if msg['attachment'] else None,
+            'attachment_type': msg['attachment_type'],
         }
         for msg in messages
     ]
 
-    return JsonResponse({'messages': data})
+    return JsonResponse({'messages': data, 'next_cursor': next_cursor})
+
+
+
+def changes_view(request):
+    """Changes for the logged-in user after ``?since=<seq>`` (HTTP twin of the ``resume`` action)."""
+    current_user = get_logged_in_user(request)
+    if not current_user:
+        return JsonResponse({'error': 'Not logged in'}, status=401)
+
+    since = parse_cursor(request.GET.get('since')) or 0
+    changes = changes_since(current_user.id, since)
+    if changes is None:
+        return JsonResponse({'resync': True, 'seq': current_seq()})
+    return JsonResponse({
+        'resync': False,
+        'changes': changes,
+        'seq': changes[-1]['seq'] if changes else since,
+    })
+
 
+def metrics_view(request):
+    """Process-local runtime metrics (send queue depth, overflows, ...); staff only."""
+    if not request.user.is_staff:
+        return JsonResponse({"error": "Forbidden"}, status=403)
+    return JsonResponse(metrics.snapshot())
 
 
 def upload_attachment(request):
@@ -428,51 +547,169 @@ def upload_attachment(request):
     if request.method != "POST":
         return JsonResponse({"error": "Invalid request"}, status=405)
 
-    sender_id = request.POST.get("sender_id")
+    current_user = get_logged_in_user(request)
+    if not current_user:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+
     receiver_id = request.POST.get("receiver_id")
     file = request.FILES.get("file")
     file_type = request.POST.get("file_type", "document")
 
-    if not all([sender_id, receiver_id, file]):
+    if not all([receiver_id, file]):
         return JsonResponse({"error": "Missing required fields"}, status=400)
 
-    sender = ChatUser.objects.get(id=sender_id)
-    receiver = ChatUser.objects.get(id=receiver_id)
+    if not user_cache.exists(receiver_id):
+        return JsonResponse({"error": "Unknown user"}, status=404)
+    sender_id, receiver_id = current_user.id, int(receiver_id)
+
+    with transaction.atomic():
+        msg, payload = create_attachment_message(request, sender_id, receiver_id, file, file_type)
+    broadcast_attachment(msg, payload)
+    return JsonResponse(attachment_response(msg, payload))
 
+
+def create_attachment_message(request, sender_id, receiver_id, file, file_type):
+    """Store ``file`` as an attachment message (call inside a transaction)."""
     msg = ChatMessage.objects.create(
-        sender=sender,
-        receiver=receiver,
+        sender_id=sender_id,
+        receiver_id=receiver_id,
         attachment=file,
         attachment_type=file_type,
         status="sent",
     )
-
+    record_message(msg)
     file_url = request.build_absolute_uri(msg.attachment.url)
+    payload = record_change(sender_id, receiver_id, message_payload(msg, attachment_url=file_url))
+    return msg, payload
 
-    # 🔥 Broadcast to both clients via Channels
+
+def broadcast_attachment(msg, payload):
+    # 🔥 Broadcast to both participants via Channels
     channel_layer = get_channel_layer()
-    async_to_sync(channel_layer.group_send)(
-        "global_chat",
-        {
-            "type": "chat_message",
-            "message": None,
-            "sender_id": sender.id,
-            "receiver_id": receiver.id,
-            "timestamp": str(msg.timestamp),
-            "status": msg.status,
-            "msg_id": msg.id,
-            "attachment_url": file_url,
-            "attachment_type": file_type,
-        }
+    async_to_sync(send_to_users)(
+        channel_layer,
+        [msg.sender_id, msg.receiver_id],
+        build_event("chat_message", payload)
     )
 
-    return JsonResponse({
+
+def attachment_response(msg, payload):
+    return {
         "msg_id": msg.id,
-        "attachment_url": file_url,
-        "attachment_type": file_type,
+        "attachment_url": payload["attachment_url"],
+        "attachment_type": msg.attachment_type,
         "timestamp": str(msg.timestamp),
         "status": msg.status,
-    })
+    }
+
+
+# ---------------------------
+# Resumable chunked uploads: POST /api/uploads/ -> PUT chunks -> POST .../complete/
+# ---------------------------
+def upload_error(exc):
+    body = {"error": str(exc)}
+    if exc.offset is not None:
+        body["offset"] = exc.offset
+    return JsonResponse(body, status=exc.status)
+
+
+def upload_state(upload):
+    return {
+        "upload_id": str(upload.id),
+        "offset": upload.received,
+        "size": upload.size,
+        "chunk_size": uploads.max_chunk_bytes(),
+        "completed": upload.message_id is not None,
+    }
+
+
+def upload_sessions_view(request):
+    """Open an upload: JSON ``{receiver_id, file_name, file_type, size, sha256}``."""
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request"}, status=405)
+    current_user = get_logged_in_user(request)
+    if not current_user:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+    try:
+        data = json.loads(request.body)
+    except ValueError:
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    if not isinstance(data, dict):
+        return JsonResponse({"error": "Invalid JSON"}, status=400)
+
+    receiver_id = data.get("receiver_id")
+    if not receiver_id or not user_cache.exists(receiver_id):
+        return JsonResponse({"error": "Unknown user"}, status=404)
+    try:
+        upload = uploads.open_session(
+            current_user.id, int(receiver_id), data.get("file_name"), data.get("file_type"),
+            data.get("size"), data.get("sha256"),
+        )
+    except uploads.UploadError as exc:
+        return upload_error(exc)
+    return JsonResponse(upload_state(upload), status=201)
+
+
+def upload_session_view(request, upload_id):
+    """``GET``: how much has arrived. ``PUT ?offset=N``: the request body is one chunk."""
+    current_user = get_logged_in_user(request)
+    if not current_user:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+    upload = UploadSession.objects.filter(pk=upload_id, sender_id=current_user.id).first()
+    if upload is None:
+        return JsonResponse({"error": "Unknown upload"}, status=404)
+
+    if request.method == "GET":
+        return JsonResponse(upload_state(upload))
+    if request.method != "PUT":
+        return JsonResponse({"error": "Invalid request"}, status=405)
+
+    offset = request.GET.get("offset", "")
+    length = request.META.get("CONTENT_LENGTH") or ""
+    if not (offset.isascii() and offset.isdigit() and length.isascii() and length.isdigit()):
+        return JsonResponse({"error": "offset and Content-Length are required"}, status=400)
+    try:
+        uploads.write_chunk(upload, int(offset), request, int(length))
+    except uploads.UploadError as exc:
+        return upload_error(exc)
+    return JsonResponse(upload_state(upload))
+
+
+def complete_upload_view(request, upload_id):
+    """Verify the checksum, then store and broadcast the attachment message (once)."""
+    if request.method != "POST":
+        return JsonResponse({"error": "Invalid request"}, status=405)
+    current_user = get_logged_in_user(request)
+    if not current_user:
+        return JsonResponse({"error": "Not logged in"}, status=401)
+
+    with transaction.atomic():
+        upload = (
+            UploadSession.objects.select_for_update()
+            .filter(pk=upload_id, sender_id=current_user.id).first()
+        )
+        if upload is None:
+            return JsonResponse({"error": "Unknown upload"}, status=404)
+        if upload.message_id:
+            # Retried completion: same message, no second broadcast.
+            msg = upload.message
+            url = request.build_absolute_uri(msg.attachment.url)
+            return JsonResponse(attachment_response(msg, {"attachment_url": url}))
+        try:
+            uploads.verify(upload)
+        except uploads.UploadError as exc:
+            return upload_error(exc)
+        with open(uploads.temp_path(upload), "rb") as fh:
+            msg, payload = create_attachment_message(
+                request, upload.sender_id, upload.receiver_id, File(fh, name=upload.file_name),
+                upload.file_type,
+            )
+        upload.message = msg
+        upload.save(update_fields=["message", "updated_at"])
+        transaction.on_commit(lambda: uploads.discard_temp_file(upload))
+
+    broadcast_attachment(msg, payload)
+    return JsonResponse(attachment_response(msg, payload))
 
 
 
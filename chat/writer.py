@@ -0,0 +1,129 @@
+"""Write-behind buffer that persists WebSocket messages in batches.
+
+Instead of one INSERT (and, on SQLite, one fsync) per message, messages are
+collected for ``CHAT_WRITE_BATCH_DELAY`` seconds or ``CHAT_WRITE_BATCH_SIZE``
+rows and stored with a single ``bulk_create``. Callers still await their own
+saved ``ChatMessage`` so the id and timestamp can go back for the "sent" tick.
+"""
+import asyncio
+import weakref
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+
+from .changefeed import record_message_changes
+from .conversations import record_messages
+from .dbexec import db_sync_to_async
+from .models import ChatMessage, conversation_key
+
+
+class MessageWriter:
+    def __init__(self, batch_size=None, max_delay=None):
+        self.batch_size = batch_size or getattr(settings, "CHAT_WRITE_BATCH_SIZE", 100)
+        self.max_delay = max_delay if max_delay is not None else getattr(
+            settings, "CHAT_WRITE_BATCH_DELAY", 0.005
+        )
+        self.pending = []  # [(ChatMessage, Future)]
+        self.flushes = set()
+        self._timer = None
+
+    async def save(self, message):
+        """Queue an unsaved ChatMessage and wait until its batch is written."""
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((message, future))
+        if len(self.pending) >= self.batch_size:
+            self._start_flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_delay, self._start_flush)
+        return await future
+
+    def _start_flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self.pending:
+            return
+        batch, self.pending = self.pending, []
+        task = asyncio.ensure_future(self._flush(batch))
+        self.flushes.add(task)
+        task.add_done_callback(self.flushes.discard)
+
+    async def _flush(self, batch):
+        try:
+            results = await db_sync_to_async(write_batch)([msg for msg, _ in batch])
+        except Exception as exc:  # noqa: BLE001 - handed to every waiting sender
+            results = [exc] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def close(self, timeout=None):
+        """Flush everything queued, waiting at most ``timeout`` seconds."""
+        if timeout is None:
+            timeout = getattr(settings, "CHAT_WRITE_FLUSH_TIMEOUT", 2.0)
+        self._start_flush()
+        if not self.flushes:
+            return True
+        _, not_done = await asyncio.wait(set(self.flushes), timeout=timeout)
+        return not not_done
+
+
+def write_batch(messages):
+    """Insert messages in one transaction; fall back to row-by-row on errors.
+
+    Returns one entry per message: the saved instance or the exception that
+    row raised, so a single bad receiver id does not fail the whole batch.
+    Conversation summaries are updated in the same transaction.
+    """
+    for msg in messages:
+        if not msg.conversation_key:
+            msg.conversation_key = conversation_key(msg.sender_id, msg.receiver_id)
+    if connection.features.can_return_rows_from_bulk_insert:
+        try:
+            with transaction.atomic():
+                saved = ChatMessage.objects.bulk_create(messages)
+                record_messages(saved)
+                record_message_changes(saved)
+            return saved
+        except IntegrityError:
+            pass
+    results = []
+    for msg in messages:
+        try:
+            msg.pk = None
+            with transaction.atomic():
+                msg.save(force_insert=True)
+                record_messages([msg])
+                record_message_changes([msg])
+            results.append(msg)
+        except IntegrityError as exc:
+            results.append(exc)
+    return results
+
+
+_writers = weakref.WeakKeyDictionary()
+
+
+def get_message_writer():
+    """Process-wide writer for the running event loop."""
+    loop = asyncio.get_running_loop()
+    writer = _writers.get(loop)
+    if writer is None:
+        writer = _writers[loop] = MessageWriter()
+    return writer
+
+
+async def flush_message_writer(timeout=None):
+    """Flush the running loop's writer, if it has one (process shutdown)."""
+    writer = _writers.get(asyncio.get_running_loop())
+    if writer is None:
+        return True
+    return await writer.close(timeout)
+
+
+def write_behind_enabled():
+    return getattr(settings, "CHAT_WRITE_BEHIND", False)
@@ -9,11 +9,13 @@ os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chat_app.settings')
 django.setup()
 
 import chat.routing
+from chat.lifespan import lifespan
 
 application = ProtocolTypeRouter({
     'http': get_asgi_application(),
     'websocket': AuthMiddlewareStack(
         URLRouter(
             chat.routing.websocket_urlpatterns
-        ))
+        )),
+    'lifespan': lifespan,
 })
\ No newline at end of file
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
+import os
+from datetime import timedelta
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -124,12 +126,35 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 ASGI_APPLICATION = 'chat_app.asgi.application'
 
-CHANNEL_LAYERS = {
-    "default": {
-        "BACKEND": "channels.layers.InMemoryChannelLayer"
-    }
+# Channel layer
+# The in-memory layer only works inside one process. Set CHAT_REDIS_HOSTS to a
+# comma separated list of redis:// URLs to share the layer between several ASGI
+# workers; channels_redis shards channels and groups across every host listed.
+CHAT_REDIS_HOSTS = [
+    host.strip() for host in os.environ.get('CHAT_REDIS_HOSTS', '').split(',') if host.strip()
+]
+
+CHANNEL_LAYER_CONFIG = {
+    "expiry": int(os.environ.get('CHAT_CHANNEL_EXPIRY', 60)),  # seconds an undelivered message lives
+    "group_expiry": int(os.environ.get('CHAT_GROUP_EXPIRY', 86400)),  # seconds a group membership lives
+    "capacity": int(os.environ.get('CHAT_CHANNEL_CAPACITY', 100)),  # queued messages per channel
 }
 
+if CHAT_REDIS_HOSTS:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": CHAT_REDIS_HOSTS, **CHANNEL_LAYER_CONFIG},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels.layers.InMemoryChannelLayer",
+            "CONFIG": CHANNEL_LAYER_CONFIG,
+        }
+    }
+
 STATIC_URL = '/static/'
 STATICFILES_DIRS = [
     BASE_DIR / "static", 
@@ -138,4 +163,109 @@ STATICFILES_DIRS = [
     BASE_DIR / "static",
 ]
 
-STATIC_URL = '/static/'
\ No newline at end of file
+STATIC_URL = '/static/'
+
+# Write-behind persistence for WebSocket messages. When enabled, messages are
+# buffered for CHAT_WRITE_BATCH_DELAY seconds or CHAT_WRITE_BATCH_SIZE rows and
+# saved with one bulk_create; disabled means one INSERT per message.
+CHAT_WRITE_BEHIND = os.environ.get('CHAT_WRITE_BEHIND', '0') == '1'
+CHAT_WRITE_BATCH_SIZE = 100
+CHAT_WRITE_BATCH_DELAY = 0.005
+CHAT_WRITE_FLUSH_TIMEOUT = 2.0  # max seconds shutdown (ASGI lifespan) waits for pending writes
+
+# Threads for the database work consumers still run synchronously (transactions).
+# 0 keeps channels' single thread-sensitive thread; N > 0 uses a pool of N
+# threads with one connection each (pointless on SQLite, which has one writer).
+CHAT_DB_EXECUTOR_WORKERS = int(os.environ.get('CHAT_DB_EXECUTOR_WORKERS', 0))
+
+# Presence (online flag + last_seen) lives in memory; dirty users are written
+# back to ChatUser in one UPDATE every CHAT_PRESENCE_FLUSH_INTERVAL seconds.
+CHAT_PRESENCE_FLUSH_INTERVAL = 5
+
+# Each socket follows only the presence of users it subscribed to (chat list +
+# open conversation), capped at this many users.
+CHAT_PRESENCE_MAX_SUBSCRIPTIONS = 500
+
+# Presence changes reaching a socket are batched for this many seconds into one
+# "presence_digest" frame (latest state per user); 0 sends each change at once.
+CHAT_PRESENCE_DIGEST_WINDOW = 0.25
+
+# A user goes offline only when their last socket (tab/device) has been closed
+# for this many seconds, so reloads and quick reconnects do not flap.
+CHAT_PRESENCE_GRACE_PERIOD = 5
+
+# With Redis, a socket whose worker sent no heartbeat for it (clients send one
+# every 20 s) in this many seconds is treated as closed, e.g. after a crash;
+# presence reads then answer offline for a user with no socket left.
+CHAT_PRESENCE_CONNECTION_TTL = 60
+
+# JSON encoder for WebSocket frames: "orjson", "json" (stdlib) or "auto".
+CHAT_JSON_BACKEND = os.environ.get('CHAT_JSON_BACKEND', 'auto')
+
+# Allow clients to negotiate the binary chat.msgpack.v1 subprotocol (needs msgpack).
+# Off by default: when on, every group event is encoded twice (JSON + msgpack)
+# and carries both frames through the channel layer, binary clients or not.
+CHAT_MSGPACK_ENABLED = os.environ.get('CHAT_MSGPACK_ENABLED', '0') == '1'
+
+# Typing indicators go only to the counterpart, at most once per
+# CHAT_TYPING_INTERVAL seconds per sender and conversation, and clients drop
+# them after CHAT_TYPING_TTL seconds without a refresh. They never hit the DB.
+CHAT_TYPING_INTERVAL = 2
+CHAT_TYPING_TTL = 5
+
+# Longest text message accepted over the WebSocket (longer frames get an error).
+CHAT_MESSAGE_MAX_LENGTH = 4096
+
+# How many known ChatUser ids the message hot path keeps for receiver validation.
+CHAT_USER_ID_CACHE_SIZE = 10000
+
+# How many recent (sender, client_msg_id) pairs answer retried sends without a query.
+CHAT_CLIENT_MSG_ID_CACHE_SIZE = 10000
+
+# Per-connection outbound queue. A client that falls further behind than this is
+# either closed with code 4008 so it reconnects ("close") or loses frames ("drop").
+CHAT_SEND_QUEUE_MAX_MESSAGES = 200
+CHAT_SEND_QUEUE_MAX_BYTES = 1024 * 1024
+CHAT_SEND_QUEUE_POLICY = 'close'
+
+# Conversation history is served in keyset pages of CHAT_HISTORY_PAGE_SIZE
+# messages (clients may ask for up to CHAT_HISTORY_MAX_PAGE_SIZE).
+CHAT_HISTORY_PAGE_SIZE = 50
+CHAT_HISTORY_MAX_PAGE_SIZE = 200
+
+# Newest CHAT_HOT_CACHE_MESSAGES messages of active conversations, kept in
+# memory (up to CHAT_HOT_CACHE_MAX_BYTES) to serve the newest history page.
+# Process-local, so it is off when several workers share a Redis channel layer.
+CHAT_HOT_CACHE_ENABLED = not CHAT_REDIS_HOSTS
+CHAT_HOT_CACHE_MESSAGES = CHAT_HISTORY_PAGE_SIZE
+CHAT_HOT_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Change feed replayed to reconnecting clients ("resume" / /api/changes/).
+# Entries older than the retention are removed by `manage.py prune_change_feed`;
+# a client that missed more than CHAT_RESUME_MAX_CHANGES changes (keep this
+# below CHAT_SEND_QUEUE_MAX_MESSAGES) reloads instead.
+CHAT_CHANGE_FEED_RETENTION = timedelta(days=7)
+CHAT_RESUME_MAX_CHANGES = 100
+
+# Resumable attachment uploads (/api/uploads/): chunks of at most
+# CHAT_UPLOAD_CHUNK_SIZE bytes are streamed into a temp file under
+# CHAT_UPLOAD_TEMP_DIR; sessions idle for CHAT_UPLOAD_SESSION_TTL are removed
+# by `manage.py prune_upload_sessions`.
+CHAT_UPLOAD_TEMP_DIR = BASE_DIR / 'tmp' / 'chat_uploads'
+CHAT_UPLOAD_CHUNK_SIZE = 1024 * 1024
+CHAT_UPLOAD_MAX_BYTES = 100 * 1024 * 1024
+CHAT_UPLOAD_SESSION_TTL = timedelta(hours=24)
+
+# Token buckets per WebSocket action: (tokens per second, burst). "connection"
+# limits one socket, "user" all sockets of a user (shared through Redis when
+# CHAT_REDIS_HOSTS is set). Over the limit the client gets an error frame.
+CHAT_RATE_LIMITS = {
+    "send_message": {"connection": (5, 20), "user": (10, 40)},
+    "mark_read": {"connection": (2, 10), "user": (5, 20)},
+    "get_presence": {"connection": (5, 30), "user": (10, 60)},
+    "get_presence_bulk": {"connection": (1, 5), "user": (2, 10)},
+    "heartbeat": {"connection": (0.5, 3)},
+    "resume": {"connection": (0.2, 3)},
+    "typing": {"connection": (5, 10)},
+    "default": {"connection": (10, 50)},
+}